@@ -11,9 +11,15 @@ else
 fi
 
 set -e
+# Workers write their metrics here so /metrics can aggregate them, must be emptied on start
+export PROMETHEUS_MULTIPROC_DIR="${PROMETHEUS_MULTIPROC_DIR:-/tmp/rmmtxauthz_metrics}"
+rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+# MediaMTX auth hook traffic can come in via this socket (through a local proxy/sidecar), set empty to disable
+export RMMTX_UDS_PATH="${RMMTX_UDS_PATH-/run/rmmtxauthz/auth.sock}"
 if [ "$#" -eq 0 ]; then
   # FIXME: can we know the traefik/nginx internal docker ip easily ?
-  exec gunicorn "rmmtxauthz.web.application:get_app()" --bind 0.0.0.0:8005 --forwarded-allow-ips='*' -w 4 -k uvicorn.workers.UvicornWorker
+  exec gunicorn "rmmtxauthz.web.application:get_app()" -c python:rmmtxauthz.gunicornconf --bind 0.0.0.0:8005 --forwarded-allow-ips='*' -w 4 -k uvicorn.workers.UvicornWorker
 else
   exec "$@"
 fi
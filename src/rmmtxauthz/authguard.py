@@ -0,0 +1,101 @@
+"""Shed repeated failing MediaMTX auth requests in memory before they reach the DB"""
+
+from __future__ import annotations
+from typing import Optional, ClassVar, Dict, Tuple
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+from .config import RMMTXSettings
+from .metrics import MTX_AUTH_SHED
+
+LOGGER = logging.getLogger(__name__)
+ClientKey = Tuple[str, str]  # (ip, username)
+
+
+@dataclass
+class TokenBucket:
+    """Failures allowed for a client, refills over time"""
+
+    tokens: float
+    updated: float
+
+
+@dataclass
+class AuthGuard:
+    """Bounded negative cache for unknown usernames and failure token buckets per ip+user"""
+
+    negative_ttl: float = field(default_factory=lambda: RMMTXSettings.singleton().authguard_negative_ttl)
+    max_entries: int = field(default_factory=lambda: RMMTXSettings.singleton().authguard_max_entries)
+    burst: float = field(default_factory=lambda: RMMTXSettings.singleton().authguard_failure_burst)
+    refill_rate: float = field(default_factory=lambda: RMMTXSettings.singleton().authguard_failure_refill)
+    unknown: "OrderedDict[str, float]" = field(init=False, default_factory=OrderedDict)
+    buckets: "OrderedDict[ClientKey, TokenBucket]" = field(init=False, default_factory=OrderedDict)
+    counters: Dict[str, int] = field(
+        init=False, default_factory=lambda: {"shed_unknown": 0, "shed_throttled": 0, "failures": 0}
+    )
+
+    _singleton: ClassVar[Optional["AuthGuard"]] = None
+
+    @classmethod
+    def singleton(cls) -> "AuthGuard":
+        """Return singleton"""
+        if not AuthGuard._singleton:
+            AuthGuard._singleton = AuthGuard()
+        return AuthGuard._singleton
+
+    def is_unknown(self, username: str) -> bool:
+        """Is the username cached as not existing, counts as shed if so"""
+        expires = self.unknown.get(username)
+        if expires is None:
+            return False
+        if expires < time.monotonic():
+            del self.unknown[username]
+            return False
+        self.counters["shed_unknown"] += 1
+        MTX_AUTH_SHED.labels("unknown").inc()
+        return True
+
+    def remember_unknown(self, username: str) -> None:
+        """Cache the username as not existing"""
+        self.unknown[username] = time.monotonic() + self.negative_ttl
+        self.unknown.move_to_end(username)
+        while len(self.unknown) > self.max_entries:
+            self.unknown.popitem(last=False)
+
+    def _refilled(self, client: ClientKey, now: float) -> Optional[TokenBucket]:
+        """Get bucket for client with tokens refilled up to now"""
+        bucket = self.buckets.get(client)
+        if bucket is None:
+            return None
+        bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.refill_rate)
+        bucket.updated = now
+        return bucket
+
+    def is_throttled(self, client: ClientKey) -> bool:
+        """Has the client used up its failures, counts as shed if so"""
+        bucket = self._refilled(client, time.monotonic())
+        if bucket is None or bucket.tokens >= 1.0:
+            return False
+        self.counters["shed_throttled"] += 1
+        MTX_AUTH_SHED.labels("throttled").inc()
+        return True
+
+    def record_failure(self, client: ClientKey) -> None:
+        """Client failed auth, take a token"""
+        now = time.monotonic()
+        self.counters["failures"] += 1
+        bucket = self._refilled(client, now)
+        if bucket is None:
+            bucket = TokenBucket(self.burst, now)
+            self.buckets[client] = bucket
+        bucket.tokens = max(0.0, bucket.tokens - 1.0)
+        self.buckets.move_to_end(client)
+        while len(self.buckets) > self.max_entries:
+            self.buckets.popitem(last=False)
+
+    @property
+    def shed(self) -> int:
+        """Total requests rejected without checking credentials"""
+        return self.counters["shed_unknown"] + self.counters["shed_throttled"]
@@ -2,6 +2,7 @@
 
 from typing import ClassVar, Optional, Annotated, NamedTuple, Dict
 import logging
+from pathlib import Path
 
 from pydantic import Field
 from pydantic.types import StringConstraints
@@ -23,13 +24,29 @@ class Protocol(NamedTuple):
 class DBSettings(BaseSettings):
     """Database settings"""
 
-    driver: str = "postgresql"
+    driver: str = "postgresql+asyncpg"
     host: str = "localhost"
     port: int = 5432
     user: str = "rmmtx"
     password: str = "<PASSWORD>"  # pragma: allowlist secret
     database: str = "rmmtx"
     echo: bool = False
+    nullpool: bool = Field(
+        default=False, description="Do not pool connections, needed if the engine is used from several event loops"
+    )
+    # Per worker, so the server sees up to workers * (pool_size + max_overflow) connections
+    pool_size: int = Field(default=5, description="Connections kept open per worker")
+    max_overflow: int = Field(default=10, description="Extra connections opened per worker under load")
+    pool_timeout: float = Field(default=10.0, description="Seconds to wait for a free connection before erroring")
+    pool_recycle: int = Field(default=1800, description="Reconnect connections older than this many seconds, -1=never")
+    ping_idle: float = Field(
+        default=10.0,
+        description="Ping connections that have been idle longer than this many seconds on checkout, "
+        + "0=ping always, -1=never",
+    )
+    migration_lock_timeout: float = Field(
+        default=60.0, description="Seconds to wait for another instance to finish migrating before erroring"
+    )
 
     model_config = SettingsConfigDict(env_prefix="RMMTX_DATABASE_", extra="ignore")
 
@@ -72,10 +89,17 @@ class RMMTXSettings(BaseSettings):  # pylint: disable=too-few-public-methods
     reload: bool = True
     log_level: UCStr = Field(default="INFO", alias="LOG_LEVEL")
     rmcn: str = Field(default="rasenmaeher", description="expected CN for RASENMAEHERs mTLS cert")
+    gzip_minimum_size: int = Field(default=1024, description="Responses larger than this many bytes are gzipped")
 
     api_username: str = Field(default="rmmtxauthz", description="Username for *this* integration to use")
     api_password: str = Field(default="CHANGEME", description="Password for *this* integration to use")
     api_url: str = Field(default="https://mediamtx:9997", description="URL for the MediaMTX control API")
+    api_pool_limit: int = Field(default=20, description="Max simultaneous connections to the MediaMTX control API")
+    api_keepalive_timeout: float = Field(default=30.0, description="Seconds to keep idle control API connections")
+    api_connect_timeout: float = Field(default=5.0, description="Control API connect timeout in seconds")
+    api_total_timeout: float = Field(default=15.0, description="Control API total request timeout in seconds")
+    api_page_size: int = Field(default=100, description="Items per page when listing paths from the control API")
+    api_prefetch_pages: int = Field(default=4, description="How many path list pages to fetch concurrently")
 
     mtx_address: str = Field(default="__REQUEST_HOSTNAME__", description="Public address for MediaMTX server")
     mtx_hls_port: int = Field(default=9888, description="HLS stream port")
@@ -84,6 +108,34 @@ class RMMTXSettings(BaseSettings):  # pylint: disable=too-few-public-methods
     mtx_rtmps_port: int = Field(default=1936, description="RTMPs stream port")
     mtx_srt_port: int = Field(default=8890, description="SRT stream port")
     mtx_protocols: str = Field(default="hls,webrtc,rtsps,rtmps,srt", description="Which protocols to generate URLs for")
+    mtx_snapshot_interval: float = Field(
+        default=5.0, description="Seconds between background refreshes of the active paths snapshot"
+    )
+
+    credindex_refresh_interval: float = Field(
+        default=60.0,
+        description="Seconds between incremental refreshes of the in-memory credential index, changes made by other "
+        + "workers are normally seen immediately via the change bus",
+    )
+    credshm_enabled: bool = Field(
+        default=False,
+        description="Share one credential table between workers via a memory-mapped file, only one worker "
+        + "refreshes it from the DB",
+    )
+    credshm_dir: Path = Field(default=Path("/dev/shm/rmmtxauthz"), description="Where the shared table lives")
+    credshm_leader_retry: float = Field(
+        default=5.0, description="Seconds between attempts to take over refreshing the shared table"
+    )
+    changebus_enabled: bool = Field(default=True, description="Listen for cross-worker changes with LISTEN/NOTIFY")
+    changebus_reconnect_delay: float = Field(default=2.0, description="Seconds to wait before reconnecting listener")
+
+    authguard_negative_ttl: float = Field(default=30.0, description="Seconds to remember that a username is unknown")
+    authguard_max_entries: int = Field(default=10000, description="Max unknown usernames and failing clients tracked")
+    authguard_failure_burst: float = Field(default=5.0, description="Failed auths per ip+user before throttling")
+    authguard_failure_refill: float = Field(default=0.2, description="Failed auths per second allowed after burst")
+
+    healthcheck_cache_ttl: float = Field(default=5.0, description="Seconds to reuse the result of a deep healthcheck")
+    healthcheck_timeout: float = Field(default=2.0, description="Timeout in seconds for each deep healthcheck probe")
 
     model_config = SettingsConfigDict(env_prefix="RMMTX_", extra="ignore")
 
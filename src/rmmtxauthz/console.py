@@ -1,16 +1,23 @@
-"""CLI entrypoints for rmmtxauthz"""
+"""CLI entrypoints for rmmtxauthz
 
+Docker runs the healthcheck command often so module level imports are kept to the standard library, click and
+libadvian logging, subcommands import the heavy stuff (pydantic, SQLAlchemy, FastAPI) when they need it.
+"""
+
+from typing import Optional
 import logging
 import json
 import asyncio
+import http.client
+import os
+import uuid
+from pathlib import Path
+from urllib.parse import urlencode, urlsplit
 
 import click
-import aiohttp
 from libadvian.logging import init_logging
 
 from rmmtxauthz import __version__
-from .config import RMMTXSettings
-from .web.application import get_app_no_init
 
 LOGGER = logging.getLogger(__name__)
 
@@ -22,8 +29,8 @@ LOGGER = logging.getLogger(__name__)
 def cli_group(ctx: click.Context, verbose: int) -> None:
     """CLI helpers for RASENMAEHER developers"""
     _ = ctx
-    config = RMMTXSettings.singleton()
-    loglevel = getattr(logging, config.log_level.upper(), 30)
+    # Same as RMMTXSettings.log_level but without loading the settings
+    loglevel = getattr(logging, os.environ.get("LOG_LEVEL", "INFO").upper(), 30)
     if verbose == 1:
         loglevel = 20
     if verbose >= 2:
@@ -36,6 +43,8 @@ def cli_group(ctx: click.Context, verbose: int) -> None:
 @click.pass_context
 def print_config(ctx: click.Context) -> None:
     """Print the currently resolved config"""
+    from .config import RMMTXSettings  # pylint: disable=C0415
+
     conf = RMMTXSettings.singleton()
     click.echo(repr(conf))
     ctx.exit(0)
@@ -45,6 +54,8 @@ def print_config(ctx: click.Context) -> None:
 @click.pass_context
 def dump_openapi(ctx: click.Context) -> None:
     """Dump autogenerated openapi spec as JSON"""
+    from .web.application import get_app_no_init  # pylint: disable=C0415
+
     app = get_app_no_init()
     click.echo(json.dumps(app.openapi()))
     ctx.exit(0)
@@ -54,26 +65,81 @@ def dump_openapi(ctx: click.Context) -> None:
 @click.option("--host", default="localhost", help="The host to connect to")
 @click.option("--port", default=8005, help="The port to connect to")
 @click.option("--timeout", default=2.0, help="The timeout in seconds")
+@click.option("--deep/--shallow", default=False, help="Also check DB and MediaMTX, default is liveness only")
 @click.pass_context
-def do_http_healthcheck(ctx: click.Context, host: str, port: int, timeout: float) -> None:
+def do_http_healthcheck(ctx: click.Context, host: str, port: int, timeout: float, deep: bool) -> None:
     """
     Do a GET request to the healthcheck api and dump results to stdout
     """
+    if "://" not in host:
+        host = f"http://{host}"
+    parsed = urlsplit(host)
+    connection_class = http.client.HTTPSConnection if parsed.scheme == "https" else http.client.HTTPConnection
+    connection = connection_class(parsed.netloc, port, timeout=timeout)
+    try:
+        connection.request("GET", "/api/v1/healthcheck?" + urlencode({"deep": "true" if deep else "false"}))
+        resp = connection.getresponse()
+        body = resp.read()
+    except (OSError, http.client.HTTPException) as exc:
+        LOGGER.error("Healthcheck request failed: {}".format(exc))
+        ctx.exit(1)
+    finally:
+        connection.close()
+    if resp.status != 200:
+        ctx.exit(int(resp.status))
+    payload = json.loads(body)
+    click.echo(json.dumps(payload))
+    ctx.exit(0 if payload["healthy"] else 1)
+
+
+@cli_group.command(name="reconcile")
+@click.argument("rosterfile", type=click.Path(exists=True, dir_okay=False, path_type=Path))
+@click.option(
+    "--prefix-length",
+    type=click.IntRange(min=1),
+    help="Bucket by this many first characters of uuid, default 2 and at most 4",
+)
+@click.option("--revoke-unknown", is_flag=True, help="Revoke users that are not in the roster")
+@click.option("--dry-run", is_flag=True, help="Only report the mismatching buckets")
+@click.pass_context
+def do_reconcile(
+    ctx: click.Context, rosterfile: Path, prefix_length: Optional[int], revoke_unknown: bool, dry_run: bool
+) -> None:
+    """
+    Make the users match a RASENMAEHER roster, ROSTERFILE is JSON list of objects with keys
+    uuid, callsign, is_rmadmin and revoked. Only buckets whose digests differ are touched.
+    """
+    # pylint: disable=C0415
+    from .db.roster import RosterRow, DEFAULT_PREFIX_LENGTH, MAX_PREFIX_LENGTH, roster_digests, db_digests
+    from .db.roster import mismatched_buckets, reconcile
+
+    if prefix_length is None:
+        prefix_length = DEFAULT_PREFIX_LENGTH
+    if prefix_length > MAX_PREFIX_LENGTH:
+        raise click.BadParameter(f"at most {MAX_PREFIX_LENGTH}", param_hint="--prefix-length")
 
     async def doit() -> int:
         """The actual work"""
-        nonlocal host, port, timeout
-        if "://" not in host:
-            host = f"http://{host}"
-        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as session:
-            async with session.get(f"{host}:{port}/api/v1/healthcheck") as resp:
-                if resp.status != 200:
-                    return int(resp.status)
-                payload = await resp.json()
-                click.echo(json.dumps(payload))
-                if not payload["healthy"]:
-                    return 1
-        return 0
+        rows = [
+            RosterRow(
+                uuid.UUID(item["uuid"]),
+                item["callsign"],
+                bool(item.get("is_rmadmin", False)),
+                bool(item.get("revoked", False)),
+            )
+            for item in json.loads(rosterfile.read_text(encoding="utf-8"))
+        ]
+        mismatched = mismatched_buckets(await db_digests(prefix_length), roster_digests(rows, prefix_length))
+        click.echo(json.dumps({"mismatched": mismatched}))
+        if dry_run or not mismatched:
+            return 0
+        result = await reconcile(rows, mismatched, prefix_length, revoke_unknown)
+        report = {
+            key: [str(rmuuid) for rmuuid in getattr(result, key)]
+            for key in ("created", "updated", "revoked", "unknown")
+        }
+        click.echo(json.dumps({**report, "conflicts": {str(key): val for key, val in result.conflicts.items()}}))
+        return 1 if result.conflicts else 0
 
     ctx.exit(asyncio.get_event_loop().run_until_complete(doit()))
 
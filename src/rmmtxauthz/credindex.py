@@ -0,0 +1,191 @@
+"""Worker-local in-memory index of MediaMTX credentials for the auth hot path"""
+
+from __future__ import annotations
+from typing import Optional, ClassVar, Dict, Union
+import asyncio
+import datetime
+import logging
+import uuid
+from dataclasses import dataclass, field
+
+import sqlalchemy as sa
+from sqlmodel import col
+
+from .config import RMMTXSettings
+from .db.engine import EngineWrapper
+from .db.user import User
+from .db.product import Product
+from .db.changebus import Change, RESYNC
+from .db.authlookup import Credential, KIND_USER, KIND_PRODUCT
+
+LOGGER = logging.getLogger(__name__)
+# Re-read rows this much older than the newest seen "updated" so that transactions committing out of order are not lost
+REFRESH_OVERLAP = datetime.timedelta(seconds=30)
+REFRESH_TASK_NAME = "credindex_refresh"
+
+
+@dataclass
+class CredentialIndex:
+    """Users and products keyed by username/CN, loaded at startup and refreshed incrementally"""
+
+    users: Dict[str, Credential] = field(default_factory=dict)
+    products: Dict[str, Credential] = field(default_factory=dict)
+    usernames: Dict[uuid.UUID, str] = field(default_factory=dict)  # user pk -> username, to notice renames
+    loaded: bool = field(default=False)
+    high_water: Optional[datetime.datetime] = field(default=None)
+    _refreshing: bool = field(init=False, default=False)
+    _refresh_pending: bool = field(init=False, default=False)
+
+    _singleton: ClassVar[Optional["CredentialIndex"]] = None
+
+    @classmethod
+    def singleton(cls) -> "CredentialIndex":
+        """Return singleton"""
+        if not CredentialIndex._singleton:
+            CredentialIndex._singleton = CredentialIndex()
+        return CredentialIndex._singleton
+
+    def lookup_user(self, username: str) -> Optional[Credential]:
+        """Get user credential, None if we do not know about it"""
+        return self.users.get(username)
+
+    def lookup_product(self, certcn: str) -> Optional[Credential]:
+        """Get product credential, None if we do not know about it"""
+        return self.products.get(certcn)
+
+    def store(self, name: str, cred: Credential) -> None:
+        """Store credential resolved elsewhere"""
+        if cred.kind == KIND_PRODUCT:
+            self.products[name] = cred
+        else:
+            self.users[name] = cred
+
+    @classmethod
+    def _put_user(
+        cls,
+        users: Dict[str, Credential],
+        usernames: Dict[uuid.UUID, str],
+        pk: uuid.UUID,
+        username: str,
+        cred: Credential,
+    ) -> None:
+        """Store user credential, if the user was renamed the old username stops working"""
+        previous = usernames.get(pk)
+        if previous is not None and previous != username:
+            users.pop(previous, None)
+        usernames[pk] = username
+        users[username] = cred
+
+    def update_user(self, dbuser: User) -> None:
+        """Update the index from user object"""
+        self._put_user(
+            self.users,
+            self.usernames,
+            dbuser.pk,
+            dbuser.username,
+            Credential(KIND_USER, dbuser.mtxpassword, dbuser.is_rmadmin, dbuser.deleted is not None),
+        )
+        self._bump_high_water(dbuser.updated)
+
+    def update_product(self, dbproduct: Product) -> None:
+        """Update the index from product object"""
+        self.products[dbproduct.certcn] = Credential(
+            KIND_PRODUCT, dbproduct.mtxpassword, False, dbproduct.deleted is not None
+        )
+        self._bump_high_water(dbproduct.updated)
+
+    def update(self, obj: Union[User, Product]) -> None:
+        """Update the index from either type"""
+        if isinstance(obj, Product):
+            return self.update_product(obj)
+        return self.update_user(obj)
+
+    def _bump_high_water(self, updated: Optional[datetime.datetime]) -> None:
+        """Keep track of the newest change we have seen"""
+        if updated is None:
+            return
+        if self.high_water is None or updated > self.high_water:
+            self.high_water = updated
+
+    async def load(self) -> None:
+        """(Re-)load everything"""
+        self.high_water = None
+        users: Dict[str, Credential] = {}
+        products: Dict[str, Credential] = {}
+        usernames: Dict[uuid.UUID, str] = {}
+        await self._fetch_into(users, products, usernames)
+        self.users = users
+        self.products = products
+        self.usernames = usernames
+        self.loaded = True
+        LOGGER.info("Credential index loaded, {} users and {} products".format(len(users), len(products)))
+
+    async def refresh(self) -> bool:
+        """Fetch rows changed since last refresh, on DB errors keep serving the last good snapshot"""
+        try:
+            if not self.loaded:
+                await self.load()
+                return True
+            await self._fetch_into(self.users, self.products, self.usernames)
+        except Exception as exc:  # pylint: disable=W0703
+            LOGGER.warning("Credential index refresh failed, serving last snapshot: {}".format(exc))
+            return False
+        return True
+
+    async def _fetch_into(
+        self, users: Dict[str, Credential], products: Dict[str, Credential], usernames: Dict[uuid.UUID, str]
+    ) -> None:
+        """Read rows changed since high water mark (or everything) into the given mappings"""
+        since = self.high_water - REFRESH_OVERLAP if self.high_water else None
+        async with EngineWrapper.get_session() as session:
+            ustmt = sa.select(
+                col(User.pk),
+                col(User.username),
+                col(User.mtxpassword),
+                col(User.is_rmadmin),
+                col(User.deleted),
+                col(User.updated),
+            )
+            pstmt = sa.select(col(Product.certcn), col(Product.mtxpassword), col(Product.deleted), col(Product.updated))
+            if since:
+                ustmt = ustmt.where(col(User.updated) >= since)
+                pstmt = pstmt.where(col(Product.updated) >= since)
+            for pk, username, password, is_rmadmin, deleted, updated in await session.execute(ustmt):
+                self._put_user(
+                    users, usernames, pk, username, Credential(KIND_USER, password, is_rmadmin, deleted is not None)
+                )
+                self._bump_high_water(updated)
+            for certcn, password, deleted, updated in await session.execute(pstmt):
+                products[certcn] = Credential(KIND_PRODUCT, password, False, deleted is not None)
+                self._bump_high_water(updated)
+
+    async def on_change(self, change: Change) -> bool:
+        """Change bus subscriber, bursts of changes are coalesced into as few refreshes as possible.
+        Returns True if this call refreshed the index, False if the change was irrelevant or left for the
+        refresh already running"""
+        if change.table not in (User.__tablename__, Product.__tablename__, RESYNC):
+            return False
+        if self._refreshing:
+            self._refresh_pending = True
+            return False
+        self._refreshing = True
+        refreshed = False
+        try:
+            while True:
+                self._refresh_pending = False
+                refreshed = await self.refresh() or refreshed
+                if not self._refresh_pending:
+                    break
+        finally:
+            self._refreshing = False
+        return refreshed
+
+    async def refresh_loop(self) -> None:
+        """Periodically refresh until cancelled"""
+        interval = RMMTXSettings.singleton().credindex_refresh_interval
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                await self.refresh()
+        except asyncio.CancelledError:
+            LOGGER.debug("Credential index refresher cancelled")
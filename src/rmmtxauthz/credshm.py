@@ -0,0 +1,295 @@
+"""Credential table shared by all workers through a memory-mapped file
+
+One worker (whoever holds the flock on the leader lock file) keeps the CredentialIndex fresh and publishes it as a
+read-only hash table file, the other workers mmap the file and look credentials up from it without locks or DB
+queries. Publishing writes a new file and renames it over the old one, then flags the old mapping stale so readers
+switch to the new generation on their next lookup.
+
+File layout, little-endian:
+ header: magic, format version, stale flag, generation, slot count, record count
+ slots: (crc32 of name, record offset) * slot count, open addressing with linear probing, offset 0 is empty
+ records: kind, flags, name length, password length, name, password
+"""
+
+from __future__ import annotations
+from typing import Optional, ClassVar, Dict, List, Tuple, TextIO
+import asyncio
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from libadvian.tasks import TaskMaster
+
+from .config import RMMTXSettings
+from .credindex import CredentialIndex
+from .db.authlookup import Credential, KIND_USER, KIND_PRODUCT
+from .db.changebus import ChangeBus, Change, LISTENER_TASK_NAME
+
+LOGGER = logging.getLogger(__name__)
+LEADER_TASK_NAME = "credshm_leader"
+FOLLOWER_TASK_NAME = "credshm_follower"
+TABLE_FILENAME = "credentials.table"
+LOCK_FILENAME = "leader.lock"
+
+MAGIC = b"RMCT"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<4sBBxxQII")
+SLOT = struct.Struct("<II")
+RECORD = struct.Struct("<BBHH")
+STALE_OFFSET = 5
+KINDS = (KIND_USER, KIND_PRODUCT)
+FLAG_ADMIN = 1
+FLAG_DELETED = 2
+MAX_FIELD_BYTES = 0xFFFF
+REOPEN_INTERVAL = 1.0  # Seconds between attempts to open the table while there is none
+
+
+def _pack_record(name: str, cred: Credential) -> Optional[bytes]:
+    """One record, None if it does not fit the layout"""
+    bname, bpassword = name.encode("utf-8"), cred.password.encode("utf-8")
+    if len(bname) > MAX_FIELD_BYTES or len(bpassword) > MAX_FIELD_BYTES:
+        LOGGER.warning("Not sharing credential for {}, too long".format(name[:64]))
+        return None
+    flags = (FLAG_ADMIN if cred.is_rmadmin else 0) | (FLAG_DELETED if cred.deleted else 0)
+    return RECORD.pack(KINDS.index(cred.kind), flags, len(bname), len(bpassword)) + bname + bpassword
+
+
+def build_table(entries: List[Tuple[str, Credential]], generation: int) -> bytes:
+    """Serialize (name, credential) pairs, a name may appear once per kind"""
+    records: List[Tuple[int, bytes]] = []
+    for name, cred in entries:
+        record = _pack_record(name, cred)
+        if record is not None:
+            records.append((zlib.crc32(name.encode("utf-8")), record))
+    nslots = 8
+    while nslots < 2 * len(records):
+        nslots *= 2
+    slots = [(0, 0)] * nslots
+    body = bytearray()
+    offset = HEADER.size + SLOT.size * nslots
+    for crc, record in records:
+        idx = crc & (nslots - 1)
+        while slots[idx][1]:
+            idx = (idx + 1) & (nslots - 1)
+        slots[idx] = (crc, offset + len(body))
+        body += record
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, 0, generation, nslots, len(records))
+    return header + b"".join(SLOT.pack(*slot) for slot in slots) + bytes(body)
+
+
+@dataclass
+class CredentialTable:
+    """Read-only view over a serialized table"""
+
+    buffer: mmap.mmap
+    generation: int = field(init=False, default=0)
+    nslots: int = field(init=False, default=0)
+    count: int = field(init=False, default=0)
+
+    def __post_init__(self) -> None:
+        """Validate the header"""
+        magic, version, _, self.generation, self.nslots, self.count = HEADER.unpack_from(self.buffer, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError("Not a credential table")
+
+    @property
+    def stale(self) -> bool:
+        """Has a newer generation replaced this one"""
+        return bool(self.buffer[STALE_OFFSET])
+
+    def _record_at(self, offset: int, bname: bytes) -> Optional[Credential]:
+        """Credential of the record if it is for the name"""
+        kind, flags, name_len, password_len = RECORD.unpack_from(self.buffer, offset)
+        start = offset + RECORD.size
+        if self.buffer[start : start + name_len] != bname:
+            return None
+        password = self.buffer[start + name_len : start + name_len + password_len].decode("utf-8")
+        return Credential(KINDS[kind], password, bool(flags & FLAG_ADMIN), bool(flags & FLAG_DELETED))
+
+    def lookup(self, name: str) -> Dict[str, Credential]:
+        """Credentials for the name keyed by kind"""
+        bname = name.encode("utf-8")
+        crc = zlib.crc32(bname)
+        mask = self.nslots - 1
+        idx = crc & mask
+        found: Dict[str, Credential] = {}
+        while True:
+            slot_crc, offset = SLOT.unpack_from(self.buffer, HEADER.size + idx * SLOT.size)
+            if not offset:
+                return found
+            if slot_crc == crc and (cred := self._record_at(offset, bname)):
+                found[cred.kind] = cred
+            idx = (idx + 1) & mask
+
+    def close(self) -> None:
+        """Unmap"""
+        self.buffer.close()
+
+
+@dataclass
+class SharedCredentials:
+    """Leader election, publishing and lookups of the shared credential table"""
+
+    directory: Path = field(default_factory=lambda: RMMTXSettings.singleton().credshm_dir)
+    is_leader: bool = field(default=False)
+    table: Optional[CredentialTable] = field(default=None)
+    _lockfile: Optional[TextIO] = field(init=False, default=None)
+    _opened: float = field(init=False, default=0.0)
+    _publishing: asyncio.Lock = field(init=False, default_factory=asyncio.Lock)
+
+    _singleton: ClassVar[Optional["SharedCredentials"]] = None
+
+    @classmethod
+    def singleton(cls) -> "SharedCredentials":
+        """Return singleton"""
+        if not SharedCredentials._singleton:
+            SharedCredentials._singleton = SharedCredentials()
+        return SharedCredentials._singleton
+
+    @property
+    def table_path(self) -> Path:
+        """Where the current generation is"""
+        return self.directory / TABLE_FILENAME
+
+    @property
+    def following(self) -> bool:
+        """Should lookups go to the shared table"""
+        return not self.is_leader and RMMTXSettings.singleton().credshm_enabled
+
+    def try_lead(self) -> bool:
+        """Become the leader if nobody holds the lock, the lock goes away with our process"""
+        if self.is_leader:
+            return True
+        # The table holds passwords, keep it to our own user
+        self.directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+        self.directory.chmod(0o700)
+        lockfile = (self.directory / LOCK_FILENAME).open("a", encoding="utf-8")
+        try:
+            fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lockfile.close()
+            return False
+        self._lockfile = lockfile
+        self.is_leader = True
+        LOGGER.info("Process {} is now the shared credential table leader".format(os.getpid()))
+        return True
+
+    def release(self) -> None:
+        """Stop leading and unmap"""
+        if self._lockfile:
+            fcntl.flock(self._lockfile.fileno(), fcntl.LOCK_UN)
+            self._lockfile.close()
+            self._lockfile = None
+        self.is_leader = False
+        if self.table:
+            self.table.close()
+            self.table = None
+
+    def publish(self, index: CredentialIndex) -> int:
+        """Write the index as new generation and swap it in, returns the generation"""
+        return self._write_generation(list(index.users.items()) + list(index.products.items()))
+
+    async def publish_async(self, index: CredentialIndex) -> int:
+        """Like publish but serializes and writes in a thread so lookups are not blocked meanwhile"""
+        async with self._publishing:
+            entries = list(index.users.items()) + list(index.products.items())
+            return await asyncio.to_thread(self._write_generation, entries)
+
+    def _write_generation(self, entries: List[Tuple[str, Credential]]) -> int:
+        """Write the entries as new generation and swap it in, returns the generation"""
+        assert self.is_leader
+        previous: Optional[CredentialTable] = None
+        try:
+            with self.table_path.open("r+b") as fpntr:
+                previous = CredentialTable(mmap.mmap(fpntr.fileno(), 0))
+        except (OSError, ValueError, struct.error):
+            LOGGER.debug("No previous shared credential table")
+        generation = previous.generation + 1 if previous else 1
+        tmppath = self.directory / f".{TABLE_FILENAME}.{os.getpid()}"
+        tmppath.unlink(missing_ok=True)
+        with os.fdopen(os.open(tmppath, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600), "wb") as fpntr:
+            fpntr.write(build_table(entries, generation))
+        os.replace(tmppath, self.table_path)
+        if previous is not None:
+            previous.buffer[STALE_OFFSET] = 1
+            previous.close()
+        LOGGER.debug("Published shared credential table generation {}, {} entries".format(generation, len(entries)))
+        return generation
+
+    def _open(self) -> Optional[CredentialTable]:
+        """Map the current generation"""
+        if self.table:
+            self.table.close()
+            self.table = None
+        self._opened = time.monotonic()
+        try:
+            with self.table_path.open("rb") as fpntr:
+                self.table = CredentialTable(mmap.mmap(fpntr.fileno(), 0, access=mmap.ACCESS_READ))
+        except (OSError, ValueError, struct.error) as exc:
+            LOGGER.debug("Shared credential table not available: {}".format(exc))
+        return self.table
+
+    def lookup(self, name: str) -> Dict[str, Credential]:
+        """Credentials for the name keyed by kind, empty if not found or there is no table yet"""
+        table = self.table
+        if table is None or table.stale:
+            if table is None and time.monotonic() - self._opened < REOPEN_INTERVAL:
+                return {}
+            table = self._open()
+            if table is None:
+                return {}
+        return table.lookup(name)
+
+    async def start(self, index: CredentialIndex) -> None:
+        """Lead if nobody else does, otherwise keep trying in the background in case the leader goes away"""
+        if self.try_lead():
+            await self._start_leading(index)
+            return
+        TaskMaster.singleton().create_task(self._follow(index), name=FOLLOWER_TASK_NAME)
+
+    async def _start_leading(self, index: CredentialIndex) -> None:
+        """Load, publish and start keeping the table fresh"""
+        await index.refresh()
+        await self.publish_async(index)
+
+        async def on_change(change: Change) -> None:
+            """Refresh and publish, once per burst of changes"""
+            if await index.on_change(change):
+                await self.publish_async(index)
+
+        if RMMTXSettings.singleton().changebus_enabled:
+            bus = ChangeBus.singleton()
+            bus.subscribe(on_change)
+            TaskMaster.singleton().create_task(bus.run(), name=LISTENER_TASK_NAME)
+        TaskMaster.singleton().create_task(self._lead(index), name=LEADER_TASK_NAME)
+
+    async def _lead(self, index: CredentialIndex) -> None:
+        """Periodically refresh and publish until cancelled"""
+        interval = RMMTXSettings.singleton().credindex_refresh_interval
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                if await index.refresh():
+                    await self.publish_async(index)
+        except asyncio.CancelledError:
+            LOGGER.debug("Shared credential table leader cancelled")
+        finally:
+            self.release()
+
+    async def _follow(self, index: CredentialIndex) -> None:
+        """Try to take over leadership until cancelled"""
+        interval = RMMTXSettings.singleton().credshm_leader_retry
+        try:
+            while not self.try_lead():
+                await asyncio.sleep(interval)
+        except asyncio.CancelledError:
+            LOGGER.debug("Shared credential table follower cancelled")
+            self.release()
+            return
+        await self._start_leading(index)
@@ -0,0 +1,52 @@
+"""Single round-trip credential resolution for the MediaMTX auth hook"""
+
+from __future__ import annotations
+from typing import Dict, NamedTuple
+import logging
+
+import sqlalchemy as sa
+from sqlmodel import col
+
+from .engine import EngineWrapper
+from .user import User
+from .product import Product
+
+LOGGER = logging.getLogger(__name__)
+KIND_USER = "user"
+KIND_PRODUCT = "product"
+
+
+class Credential(NamedTuple):
+    """What the auth hook needs to know about a username/CN"""
+
+    kind: str  # KIND_USER or KIND_PRODUCT
+    password: str
+    is_rmadmin: bool
+    deleted: bool  # Only ever True for CredentialIndex entries, resolve_credentials returns active rows only
+
+
+# Built once so SQLAlchemy compiles it once, asyncpg then prepares it once per connection.
+# Only active rows so both halves are index-only scans on the partial covering indexes, deleted names
+# resolve to nothing which is denied just the same
+CREDENTIALS_STATEMENT: sa.CompoundSelect[str, str, bool] = sa.union_all(
+    sa.select(
+        sa.literal_column(f"'{KIND_PRODUCT}'", sa.String).label("kind"),
+        col(Product.mtxpassword).label("password"),
+        sa.false().label("is_rmadmin"),
+    ).where(col(Product.certcn) == sa.bindparam("name"), col(Product.deleted).is_(None)),
+    sa.select(
+        sa.literal_column(f"'{KIND_USER}'", sa.String).label("kind"),
+        col(User.mtxpassword).label("password"),
+        col(User.is_rmadmin).label("is_rmadmin"),
+    ).where(col(User.username) == sa.bindparam("name"), col(User.deleted).is_(None)),
+)
+
+
+async def resolve_credentials(name: str) -> Dict[str, Credential]:
+    """Look up active products and users matching the name in one statement, result is keyed by kind.
+    Deleted rows are not returned at all so deleted is always False here"""
+    engine = EngineWrapper.singleton().engine
+    assert engine
+    async with engine.connect() as connection:
+        result = await connection.execute(CREDENTIALS_STATEMENT, {"name": name})
+        return {row.kind: Credential(row.kind, row.password, row.is_rmadmin, False) for row in result}
@@ -9,11 +9,12 @@ import datetime
 
 
 from libadvian.binpackers import b64_to_uuid, ensure_utf8, ensure_str
-from sqlmodel import Field, SQLModel, select
+from sqlmodel import Field, SQLModel, select, col
 import sqlalchemy as sa
 
 from .errors import NotFound, Deleted
 from .engine import EngineWrapper
+from .changebus import notifying
 
 utcnow = sa.func.current_timestamp()  # pylint: disable=invalid-name,not-callable  # not-callable is false-positive
 
@@ -40,9 +41,9 @@ class ORMBaseModel(SQLModel, table=False):
                 getpk = b64_to_uuid(ensure_utf8(pkin))
             except ValueError:
                 getpk = uuid.UUID(ensure_str(pkin))
-        with EngineWrapper.get_session() as session:
+        async with EngineWrapper.get_session() as session:
             statement = select(cls).where(cls.pk == getpk)
-            obj = session.exec(statement).first()
+            obj = (await session.exec(statement)).first()
         if not obj:
             raise NotFound()
         if obj.deleted and not allow_deleted:
@@ -50,10 +51,17 @@ class ORMBaseModel(SQLModel, table=False):
         return obj
 
     async def delete(self) -> bool:
-        """override delete method to set the deleted timestamp instead of removing the row"""
-        with EngineWrapper.get_session() as session:
-            self.deleted = datetime.datetime.now(datetime.UTC)
-            session.add(self)
-            session.commit()
-            session.refresh(self)
+        """override delete method to set the deleted timestamp instead of removing the row, the timestamps come
+        from the DB clock like the column defaults do"""
+        cls = type(self)
+        statement = (
+            sa.update(cls)
+            .where(col(cls.pk) == self.pk)
+            .values(deleted=utcnow, updated=utcnow)
+            .returning(col(cls.pk), col(cls.deleted), col(cls.updated))
+        )
+        async with EngineWrapper.get_session() as session:
+            row = (await session.execute(notifying(statement, str(self.__tablename__)))).one()
+            await session.commit()
+        self.deleted, self.updated = row.deleted, row.updated
         return True
@@ -0,0 +1,134 @@
+"""Cross-worker change notifications over Postgres LISTEN/NOTIFY"""
+
+from __future__ import annotations
+from typing import Optional, ClassVar, List, Callable, Awaitable, NamedTuple, Any, Union
+import asyncio
+import json
+import logging
+from dataclasses import dataclass, field
+
+import asyncpg
+import sqlalchemy as sa
+from sqlmodel.ext.asyncio.session import AsyncSession
+from libadvian.tasks import TaskMaster
+
+from ..config import DBSettings, RMMTXSettings
+
+LOGGER = logging.getLogger(__name__)
+CHANNEL = "rmmtxauthz_changes"
+LISTENER_TASK_NAME = "changebus_listener"
+# Table name used for the synthetic change sent after (re)connecting, subscribers should do a full resync
+RESYNC = "__resync__"
+
+
+class Change(NamedTuple):
+    """A row was changed"""
+
+    table: str
+    pk: str
+
+
+Subscriber = Callable[[Change], Awaitable[Any]]
+
+
+async def notify_change(session: AsyncSession, table: str, pk: Any) -> None:
+    """Queue notification in the sessions transaction, it is delivered when the transaction commits"""
+    payload = json.dumps({"table": table, "pk": str(pk)})
+    await session.execute(sa.text("SELECT pg_notify(:channel, :payload)"), {"channel": CHANNEL, "payload": payload})
+
+
+def notifying(dml: Union[sa.Insert, sa.Update], table: str) -> sa.Select[Any]:
+    """Wrap INSERT/UPDATE ... RETURNING so that every returned row is also notified, all in one statement"""
+    changed = dml.cte(f"changed_{table}")
+    payload = sa.func.json_build_object("table", table, "pk", sa.cast(changed.c.pk, sa.Text))
+    return sa.select(changed, sa.func.pg_notify(CHANNEL, sa.cast(payload, sa.Text)).label("notified"))
+
+
+@dataclass
+class ChangeBus:
+    """Keep one listener connection per worker and dispatch the changes to in-process subscribers"""
+
+    subscribers: List[Subscriber] = field(default_factory=list)
+    connection: Optional[asyncpg.Connection] = field(default=None)
+    _lost: asyncio.Event = field(init=False, default_factory=asyncio.Event)
+
+    _singleton: ClassVar[Optional["ChangeBus"]] = None
+
+    @classmethod
+    def singleton(cls) -> "ChangeBus":
+        """Return singleton"""
+        if not ChangeBus._singleton:
+            ChangeBus._singleton = ChangeBus()
+        return ChangeBus._singleton
+
+    def subscribe(self, subscriber: Subscriber) -> None:
+        """Add subscriber"""
+        if subscriber not in self.subscribers:
+            self.subscribers.append(subscriber)
+
+    async def dispatch(self, change: Change) -> None:
+        """Call all subscribers, errors are logged and swallowed"""
+        for subscriber in self.subscribers:
+            try:
+                await subscriber(change)
+            except Exception:  # pylint: disable=W0703
+                LOGGER.exception("Subscriber {} failed for {}".format(subscriber, change))
+
+    def _on_notify(self, conn: Any, pid: int, channel: str, payload: str) -> None:
+        """asyncpg listener callback"""
+        _ = conn, pid, channel
+        try:
+            parsed = json.loads(payload)
+            change = Change(table=str(parsed["table"]), pk=str(parsed["pk"]))
+        except (ValueError, KeyError) as exc:
+            LOGGER.error("Invalid change payload {!r}: {}".format(payload, exc))
+            return
+        TaskMaster.singleton().create_task(self.dispatch(change))
+
+    def _on_terminate(self, conn: Any) -> None:
+        """asyncpg termination callback"""
+        _ = conn
+        LOGGER.warning("Change listener connection lost")
+        self._lost.set()
+
+    async def connect(self) -> None:
+        """Open the listener connection"""
+        cnf = DBSettings.singleton()
+        self.connection = await asyncpg.connect(
+            host=cnf.host, port=cnf.port, user=cnf.user, password=cnf.password, database=cnf.database
+        )
+        self._lost.clear()
+        self.connection.add_termination_listener(self._on_terminate)
+        await self.connection.add_listener(CHANNEL, self._on_notify)
+        LOGGER.debug("Listening for changes on {}".format(CHANNEL))
+
+    async def close(self) -> None:
+        """Close the listener connection"""
+        if self.connection is None:
+            return
+        conn, self.connection = self.connection, None
+        try:
+            await conn.close(timeout=1.0)
+        except Exception:  # pylint: disable=W0703
+            conn.terminate()
+
+    async def run(self) -> None:
+        """Keep listening until cancelled, reconnect with backoff, resync subscribers after each (re)connect
+        since notifications sent while we were not listening are lost"""
+        backoff = RMMTXSettings.singleton().changebus_reconnect_delay
+        try:
+            while True:
+                try:
+                    await self.connect()
+                except (OSError, asyncpg.PostgresError) as exc:
+                    LOGGER.warning("Could not connect change listener: {}, retrying in {}s".format(exc, backoff))
+                    await asyncio.sleep(backoff)
+                    continue
+                await self.dispatch(Change(RESYNC, ""))
+                await self._lost.wait()
+                await self.close()
+                await asyncio.sleep(backoff)
+        except asyncio.CancelledError:
+            LOGGER.debug("Change listener cancelled")
+        finally:
+            await self.close()
@@ -1,53 +1,54 @@
-"""Ensure all models are defined and then create tables"""
+"""Ensure all models are defined and then migrate the schema"""
 
 import logging
-from pathlib import Path
-import tempfile
-import asyncio
-import random
+import time
 
-import filelock
-from sqlmodel import SQLModel
 import sqlalchemy as sa
-from sqlalchemy.schema import CreateSchema, DropSchema
+from sqlmodel import SQLModel
+from sqlalchemy.schema import DropSchema
 
 from .engine import EngineWrapper
+from .migrations import migrate, current_version, SCHEMA, SCHEMA_VERSION
 
-# Import all models to ensure ORM can create all tables
-from .base import ORMBaseModel
-from .user import User
-
-_ = User
 LOGGER = logging.getLogger(__name__)
+# pg_advisory_lock key for schema changes, any bigint works as long as every instance uses the same one
+MIGRATION_LOCK_KEY = 0x726D6D7478617A  # "rmmtxaz"
 
 
-async def init_db() -> None:
-    """Create schemas and tables, normally one should use migration manager"""
-    # Random sleep to avoid race conditions
-    lockpath = Path(tempfile.gettempdir()) / "dbinit.lock"
-    lock = filelock.FileLock(lockpath)
+async def init_db() -> int:
+    """Create schemas and tables or migrate them to current version, returns the schema version.
+    When the schema is current this is one query, otherwise workers and containers take turns via an advisory lock
+    and whoever gets it after the first one finds nothing left to do"""
+    started = time.perf_counter()
     wrapper = EngineWrapper.singleton()
     assert wrapper.engine
-    engine = wrapper.engine
-    try:
-        await asyncio.sleep(random.random() * 2)  # nosec
-        lock.acquire(timeout=0.0)
-        LOGGER.debug("Acquiring session")
-        with engine.connect() as connection:
-            if not sa.inspect(connection).has_schema(ORMBaseModel.__table_args__["schema"]):
-                LOGGER.debug("Creating schema {}".format(ORMBaseModel.__table_args__["schema"]))
-                connection.execute(CreateSchema(ORMBaseModel.__table_args__["schema"]))
-                connection.commit()
-                LOGGER.debug("Creating tables")
-                SQLModel.metadata.create_all(connection)
-                connection.commit()
-    except filelock.Timeout:
-        LOGGER.warning("Someone has already locked {}".format(lockpath))
-        LOGGER.debug("Sleeping for ~5s and then recursing")
-        await asyncio.sleep(5.0 + random.random())  # nosec
-        return await init_db()
-    finally:
-        lock.release()
+    async with wrapper.engine.connect() as connection:
+        version = await current_version(connection)
+        await connection.commit()
+        if version < SCHEMA_VERSION:
+            LOGGER.debug("Schema is at version {}, waiting for the migration lock".format(version))
+            # Session level lock so it is held across the per-migration commits, the lock_timeout only applies
+            # while waiting for it
+            timeout_ms = int(wrapper.settings.migration_lock_timeout * 1000)
+            await connection.execute(sa.text(f"SET LOCAL lock_timeout = {timeout_ms}"))
+            await connection.execute(sa.select(sa.func.pg_advisory_lock(MIGRATION_LOCK_KEY)))
+            await connection.commit()
+            try:
+                version = await migrate(connection)
+            finally:
+                # A failed migration leaves the transaction aborted, unlocking needs a fresh one
+                await connection.rollback()
+                try:
+                    await connection.execute(sa.select(sa.func.pg_advisory_unlock(MIGRATION_LOCK_KEY)))
+                    await connection.commit()
+                except sa.exc.DBAPIError:
+                    # Do not let a connection still holding the lock go back to the pool
+                    await connection.invalidate()
+                    raise
+    if version > SCHEMA_VERSION:
+        LOGGER.warning("Schema version {} is newer than ours ({})".format(version, SCHEMA_VERSION))
+    LOGGER.info("Schema is at version {}, DB ready in {:.1f}ms".format(version, (time.perf_counter() - started) * 1000))
+    return version
 
 
 async def drop_db() -> None:
@@ -56,10 +57,10 @@ async def drop_db() -> None:
     assert wrapper.engine
     engine = wrapper.engine
     LOGGER.debug("Acquiring session")
-    with engine.connect() as connection:
+    async with engine.connect() as connection:
         LOGGER.debug("Dropping tables")
-        SQLModel.metadata.drop_all(connection)
-        connection.commit()
-        LOGGER.debug("Dropping schema {}".format(ORMBaseModel.__table_args__["schema"]))
-        connection.execute(DropSchema(ORMBaseModel.__table_args__["schema"]))
-        connection.commit()
+        await connection.run_sync(SQLModel.metadata.drop_all)
+        await connection.commit()
+        LOGGER.debug("Dropping schema {}".format(SCHEMA))
+        await connection.execute(DropSchema(SCHEMA))
+        await connection.commit()
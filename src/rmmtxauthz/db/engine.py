@@ -1,24 +1,67 @@
 """Engine stuff"""
 
-from typing import ClassVar, Optional, Any
+from typing import ClassVar, Optional, Any, Dict
 import logging
+import time
 from dataclasses import dataclass, field
 
-from sqlmodel import Session, create_engine
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import NullPool, AsyncAdaptedQueuePool, ConnectionPoolEntry
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from ..config import DBSettings
+from ..metrics import DB_QUERY_DURATION, DB_POOL_CHECKOUT_WAIT, DB_POOL_IN_USE, DB_POOL_OVERFLOW, DB_POOL_PINGS
 
 
 LOGGER = logging.getLogger(__name__)
 
 
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """Queue pool that observes how long checkouts wait and publishes usage once the pool state has changed,
+    the checkin event fires before the connection is back in the pool so it would count one too many"""
+
+    def _publish_stats(self) -> None:
+        """Publish pool usage"""
+        DB_POOL_IN_USE.set(self.checkedout())
+        DB_POOL_OVERFLOW.set(max(0, self.overflow()))
+
+    def _do_get(self) -> ConnectionPoolEntry:
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_CHECKOUT_WAIT.observe(time.perf_counter() - started)
+            self._publish_stats()
+
+    def _do_return_conn(self, record: ConnectionPoolEntry) -> None:
+        super()._do_return_conn(record)
+        self._publish_stats()
+
+
+def _before_cursor_execute(conn: Any, cursor: Any, statement: str, parameters: Any, context: Any, *args: Any) -> None:
+    """Stash statement start time on the execution context, it goes away with the statement even if that fails"""
+    _ = conn, cursor, statement, parameters, args
+    if context is not None:
+        context.rmmtx_query_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn: Any, cursor: Any, statement: str, parameters: Any, context: Any, *args: Any) -> None:
+    """Observe statement duration, labelled by the statement verb"""
+    _ = conn, cursor, parameters, args
+    started = getattr(context, "rmmtx_query_started", None)
+    if started is None:
+        return
+    verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "UNKNOWN"
+    DB_QUERY_DURATION.labels(verb).observe(time.perf_counter() - started)
+
+
 @dataclass
 class EngineWrapper:
     """Handle engine singletons"""
 
     settings: DBSettings = field(default_factory=DBSettings.singleton)
-    # FIXME: correct typing
-    engine: Optional[Any] = field(default=None)
+    engine: Optional[AsyncEngine] = field(default=None)
 
     _singleton: ClassVar[Optional["EngineWrapper"]] = None
 
@@ -32,17 +75,46 @@ class EngineWrapper:
 
     def __post_init__(self) -> None:
         """create one engine"""
-        self.engine = create_engine(
-            self.settings.dsn,
-            pool_pre_ping=True,
-            echo=self.settings.echo,
-        )
+        cnf = self.settings
+        pool_args: Dict[str, Any] = {"poolclass": NullPool}
+        if not cnf.nullpool:
+            pool_args = {
+                "poolclass": InstrumentedPool,
+                "pool_size": cnf.pool_size,
+                "max_overflow": cnf.max_overflow,
+                "pool_timeout": cnf.pool_timeout,
+            }
+        self.engine = create_async_engine(cnf.dsn, echo=cnf.echo, pool_recycle=cnf.pool_recycle, **pool_args)
+        sa.event.listen(self.engine.sync_engine, "before_cursor_execute", _before_cursor_execute)
+        sa.event.listen(self.engine.sync_engine, "after_cursor_execute", _after_cursor_execute)
+        sa.event.listen(self.engine.sync_engine, "checkout", self._pool_checkout)
+        sa.event.listen(self.engine.sync_engine, "checkin", self._pool_checkin)
+
+    def _pool_checkout(self, dbapi_connection: Any, connection_record: Any, connection_proxy: Any) -> None:
+        """Ping connections that have been idle for a while instead of on every checkout,
+        a failed ping makes the pool replace the connection"""
+        _ = connection_proxy
+        idle = time.monotonic() - connection_record.info.get("checked_in", time.monotonic())
+        ping_idle = self.settings.ping_idle
+        if 0 <= ping_idle <= idle:
+            try:
+                dbapi_connection.ping()
+            except Exception as exc:  # pylint: disable=W0703
+                DB_POOL_PINGS.labels("failed").inc()
+                LOGGER.warning("Connection idle for {:.1f}s failed ping, reconnecting: {}".format(idle, exc))
+                raise sa.exc.DisconnectionError() from exc
+            DB_POOL_PINGS.labels("ok").inc()
+
+    def _pool_checkin(self, dbapi_connection: Any, connection_record: Any) -> None:
+        """Remember when the connection went idle"""
+        _ = dbapi_connection
+        connection_record.info["checked_in"] = time.monotonic()
 
     @classmethod
-    def get_session(cls) -> Session:
+    def get_session(cls) -> AsyncSession:
         """Get a session from wrapper singleton"""
         return cls.singleton().session()
 
-    def session(self) -> Session:
-        """Get a session"""
-        return Session(self.engine)
+    def session(self) -> AsyncSession:
+        """Get a session, objects are not expired on commit since we cannot lazy-load attributes in async"""
+        return AsyncSession(self.engine, expire_on_commit=False)
@@ -0,0 +1,112 @@
+"""Read-only lookups for the request hot path, skipping the ORM
+
+The statements are compiled to SQL once per dialect and run with exec_driver_sql, so there is no per-call
+compilation or cache key generation, the asyncpg adapter prepares each of them once per connection and keeps them
+in its statement cache. Rows come back as plain named tuples instead of hydrated SQLModel instances.
+"""
+
+from __future__ import annotations
+from typing import Any, Dict, NamedTuple, Optional, Sequence, Tuple, Union
+import datetime
+import logging
+import uuid
+
+import sqlalchemy as sa
+from sqlmodel import col
+
+from .engine import EngineWrapper
+from .errors import NotFound, Deleted
+from .user import User
+from .product import Product
+
+LOGGER = logging.getLogger(__name__)
+
+
+class UserRecord(NamedTuple):
+    """The parts of User the request handlers need"""
+
+    pk: uuid.UUID
+    rmuuid: uuid.UUID
+    username: str
+    mtxpassword: str
+    is_rmadmin: bool
+    deleted: Optional[datetime.datetime]
+
+
+class ProductRecord(NamedTuple):
+    """The parts of Product the request handlers need"""
+
+    pk: uuid.UUID
+    certcn: str
+    mtxpassword: str
+    deleted: Optional[datetime.datetime]
+
+
+USER_COLUMNS = tuple(col(getattr(User, name)) for name in UserRecord._fields)
+PRODUCT_COLUMNS = tuple(col(getattr(Product, name)) for name in ProductRecord._fields)
+
+STATEMENTS: Dict[str, sa.Select[Any]] = {
+    "user_by_username": sa.select(*USER_COLUMNS).where(col(User.username) == sa.bindparam("value")),
+    "user_by_rmuuid": sa.select(*USER_COLUMNS).where(col(User.rmuuid) == sa.bindparam("value")),
+    "user_by_pk": sa.select(*USER_COLUMNS).where(col(User.pk) == sa.bindparam("value")),
+    "product_by_cn": sa.select(*PRODUCT_COLUMNS).where(col(Product.certcn) == sa.bindparam("value")),
+    "product_by_pk": sa.select(*PRODUCT_COLUMNS).where(col(Product.pk) == sa.bindparam("value")),
+}
+# (statement name, dialect name) -> (SQL, bind parameter names in positional order)
+_COMPILED: Dict[Tuple[str, str], Tuple[str, Sequence[str]]] = {}
+
+
+def compiled(name: str, dialect: sa.Dialect) -> Tuple[str, Sequence[str]]:
+    """SQL string and positional parameter order of the named statement, compiled on first use"""
+    key = (name, dialect.name)
+    if key not in _COMPILED:
+        compiledsql = STATEMENTS[name].compile(dialect=dialect)
+        _COMPILED[key] = (str(compiledsql), tuple(compiledsql.positiontup or ()))
+    return _COMPILED[key]
+
+
+async def _fetch_one(name: str, value: Any) -> Optional[Tuple[Any, ...]]:
+    """Run the named statement, return the first row as tuple"""
+    engine = EngineWrapper.singleton().engine
+    assert engine
+    sql, order = compiled(name, engine.dialect)
+    bound = {"value": value}
+    params = tuple(bound[key] for key in order) if engine.dialect.positional else bound
+    async with engine.connect() as connection:
+        row = (await connection.exec_driver_sql(sql, params)).first()
+    return tuple(row) if row is not None else None
+
+
+def _check(row: Optional[Tuple[Any, ...]], allow_deleted: bool) -> Tuple[Any, ...]:
+    """Raise like the ORM getters do"""
+    if row is None:
+        raise NotFound()
+    if row[-1] is not None and not allow_deleted:
+        raise Deleted()
+    return row
+
+
+async def user_by_username(username: str, allow_deleted: bool = False) -> UserRecord:
+    """Get user by username"""
+    return UserRecord(*_check(await _fetch_one("user_by_username", username), allow_deleted))
+
+
+async def user_by_rmuuid(rmuuid: Union[str, uuid.UUID], allow_deleted: bool = False) -> UserRecord:
+    """Get user by RASENMAEHER UUID"""
+    rmuuid = rmuuid if isinstance(rmuuid, uuid.UUID) else uuid.UUID(rmuuid)
+    return UserRecord(*_check(await _fetch_one("user_by_rmuuid", rmuuid), allow_deleted))
+
+
+async def user_by_pk(pk: uuid.UUID, allow_deleted: bool = False) -> UserRecord:
+    """Get user by pk"""
+    return UserRecord(*_check(await _fetch_one("user_by_pk", pk), allow_deleted))
+
+
+async def product_by_cn(certcn: str, allow_deleted: bool = False) -> ProductRecord:
+    """Get product by certificate CN"""
+    return ProductRecord(*_check(await _fetch_one("product_by_cn", certcn), allow_deleted))
+
+
+async def product_by_pk(pk: uuid.UUID, allow_deleted: bool = False) -> ProductRecord:
+    """Get product by pk"""
+    return ProductRecord(*_check(await _fetch_one("product_by_pk", pk), allow_deleted))
@@ -0,0 +1,90 @@
+"""Versioned schema migrations, the applied version is kept in schema_version table"""
+
+from __future__ import annotations
+from typing import Callable, Sequence
+import logging
+from dataclasses import dataclass
+
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import AsyncConnection
+from sqlalchemy.schema import CreateSchema
+from sqlmodel import SQLModel
+
+from .base import ORMBaseModel
+from .user import User, CREATED_PK_INDEX, USERNAME_ACTIVE_INDEX, RMUUID_ACTIVE_INDEX
+from .product import Product, CERTCN_ACTIVE_INDEX
+
+_ = User, Product
+LOGGER = logging.getLogger(__name__)
+SCHEMA = str(ORMBaseModel.__table_args__["schema"])
+
+VERSION_TABLE = sa.Table(
+    "schema_version",
+    SQLModel.metadata,
+    sa.Column("version", sa.Integer, primary_key=True),
+    sa.Column("description", sa.String, nullable=False),
+    sa.Column("applied", sa.DateTime(timezone=True), nullable=False, server_default=sa.func.now()),
+    schema=SCHEMA,
+)
+
+
+@dataclass(frozen=True)
+class Migration:
+    """One schema version, apply is run with run_sync and must be idempotent since databases created
+    before versioning have parts of the later versions already"""
+
+    version: int
+    description: str
+    apply: Callable[[sa.Connection], None]
+
+
+def _create_indexes(indexes: Sequence[sa.Index]) -> Callable[[sa.Connection], None]:
+    """Migration step creating indexes unless they exist"""
+
+    def apply(connection: sa.Connection) -> None:
+        for index in indexes:
+            index.create(connection, checkfirst=True)
+
+    return apply
+
+
+MIGRATIONS = (
+    Migration(1, "Tables", lambda connection: SQLModel.metadata.create_all(connection, checkfirst=True)),
+    Migration(
+        2,
+        "Keyset pagination index and partial covering indexes for auth lookups",
+        _create_indexes((CREATED_PK_INDEX, USERNAME_ACTIVE_INDEX, RMUUID_ACTIVE_INDEX, CERTCN_ACTIVE_INDEX)),
+    ),
+)
+SCHEMA_VERSION = MIGRATIONS[-1].version
+
+
+async def current_version(connection: AsyncConnection) -> int:
+    """Version the DB is at, 0 if not versioned yet"""
+    has_table = await connection.run_sync(lambda conn: sa.inspect(conn).has_table(VERSION_TABLE.name, schema=SCHEMA))
+    if not has_table:
+        return 0
+    version = (await connection.execute(sa.select(sa.func.max(VERSION_TABLE.c.version)))).scalar()
+    return int(version or 0)
+
+
+async def migrate(connection: AsyncConnection) -> int:
+    """Bring the schema up to SCHEMA_VERSION, each migration is committed separately. Returns the version"""
+    version = await current_version(connection)
+    await connection.commit()
+    if version >= SCHEMA_VERSION:
+        return version
+    await connection.execute(CreateSchema(SCHEMA, if_not_exists=True))
+    await connection.run_sync(lambda conn: VERSION_TABLE.create(conn, checkfirst=True))
+    await connection.commit()
+    for migration in MIGRATIONS:
+        if migration.version <= version:
+            continue
+        LOGGER.info("Applying schema migration {}: {}".format(migration.version, migration.description))
+        await connection.run_sync(migration.apply)
+        await connection.execute(
+            sa.insert(VERSION_TABLE).values(version=migration.version, description=migration.description)
+        )
+        await connection.commit()
+        version = migration.version
+    return version
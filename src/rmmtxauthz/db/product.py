@@ -3,13 +3,17 @@
 from __future__ import annotations
 from typing import Self
 import logging
+import uuid
 
-from sqlmodel import Field, select
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlmodel import Field, select, col
 
 from .base import ORMBaseModel
 from .engine import EngineWrapper
 from .errors import NotFound, Deleted
 from .user import generate_code
+from .changebus import notifying
 
 LOGGER = logging.getLogger(__name__)
 
@@ -27,11 +31,40 @@ class Product(ORMBaseModel, table=True):
     @classmethod
     async def by_cn(cls, certcn: str, allow_deleted: bool = False) -> Self:
         """Get by certcn"""
-        with EngineWrapper.get_session() as session:
+        async with EngineWrapper.get_session() as session:
             statement = select(cls).where(cls.certcn == certcn)
-            obj = session.exec(statement).first()
+            obj = (await session.exec(statement)).first()
         if not obj:
             raise NotFound()
         if obj.deleted and not allow_deleted:
             raise Deleted()
         return obj
+
+    @classmethod
+    async def upsert(cls, certcn: str) -> Self:
+        """Create the product or get the existing one, only an actual insert writes a row or notifies"""
+        statement = (
+            pg_insert(cls)
+            .values(pk=uuid.uuid4(), certcn=certcn, mtxpassword=generate_code())
+            .on_conflict_do_nothing(index_elements=[col(cls.certcn)])
+            .returning(*sa.inspect(Product).columns)
+        )
+        async with EngineWrapper.get_session() as session:
+            result = await session.scalars(
+                select(cls).from_statement(notifying(statement, cls.__tablename__)),
+                execution_options={"populate_existing": True},
+            )
+            obj = result.one_or_none()
+            if obj is None:
+                obj = (await session.exec(select(cls).where(cls.certcn == certcn))).one()
+            await session.commit()
+        return obj
+
+
+# Active products only and covering the auth columns so auth lookups can be index-only scans
+CERTCN_ACTIVE_INDEX = sa.Index(
+    "ix_products_certcn_active",
+    col(Product.certcn),
+    postgresql_include=["mtxpassword"],
+    postgresql_where=col(Product.deleted).is_(None),
+)
@@ -0,0 +1,206 @@
+"""Reconcile users with the RASENMAEHER roster using per-bucket digests"""
+
+from __future__ import annotations
+from typing import Any, Dict, List, NamedTuple, Sequence, Iterable, Tuple, Set
+import hashlib
+import logging
+import uuid
+from dataclasses import dataclass, field
+
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from sqlmodel import col, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from .base import utcnow
+from .engine import EngineWrapper
+from .user import User
+from .changebus import notifying
+
+LOGGER = logging.getLogger(__name__)
+DEFAULT_PREFIX_LENGTH = 2
+MAX_PREFIX_LENGTH = 4
+
+
+class RosterRow(NamedTuple):
+    """What both sides agree a user looks like"""
+
+    rmuuid: uuid.UUID
+    callsign: str
+    is_rmadmin: bool
+    revoked: bool
+
+
+def roster_line(row: RosterRow) -> str:
+    """Canonical line hashed into the bucket digest, must match ROSTER_LINE"""
+    return f"{row.rmuuid}|{row.callsign}|{int(row.is_rmadmin)}|{int(row.revoked)}"
+
+
+def bucket_of(rmuuid: uuid.UUID, prefix_length: int) -> str:
+    """Bucket key for the user"""
+    return str(rmuuid)[:prefix_length]
+
+
+def roster_digests(rows: Iterable[RosterRow], prefix_length: int = DEFAULT_PREFIX_LENGTH) -> Dict[str, str]:
+    """sha256 over the sorted canonical lines of each non-empty bucket"""
+    buckets: Dict[str, List[str]] = {}
+    for row in sorted(rows, key=lambda row: str(row.rmuuid)):
+        buckets.setdefault(bucket_of(row.rmuuid, prefix_length), []).append(roster_line(row))
+    return {key: hashlib.sha256("\n".join(lines).encode("utf-8")).hexdigest() for key, lines in buckets.items()}
+
+
+def mismatched_buckets(ours: Dict[str, str], theirs: Dict[str, str]) -> List[str]:
+    """Buckets that differ or exist only on one side"""
+    return sorted(key for key in set(ours) | set(theirs) if ours.get(key) != theirs.get(key))
+
+
+# Same as roster_line() but computed by Postgres so only the digests leave the DB
+ROSTER_LINE = sa.func.concat_ws(
+    "|",
+    sa.cast(col(User.rmuuid), sa.Text),
+    col(User.username),
+    sa.case((col(User.is_rmadmin), "1"), else_="0"),
+    sa.case((col(User.deleted).is_(None), "0"), else_="1"),
+)
+
+
+async def db_digests(prefix_length: int = DEFAULT_PREFIX_LENGTH) -> Dict[str, str]:
+    """Bucket digests of the users table"""
+    bucket = sa.func.left(sa.cast(col(User.rmuuid), sa.Text), prefix_length)
+    aggregated = sa.func.string_agg(
+        ROSTER_LINE, aggregate_order_by(sa.literal("\n"), sa.cast(col(User.rmuuid), sa.Text).collate("C"))
+    )
+    digest = sa.func.encode(sa.func.sha256(sa.func.convert_to(aggregated, "UTF8")), "hex")
+    statement = sa.select(bucket.label("bucket"), digest.label("digest")).group_by(bucket)
+    async with EngineWrapper.get_session() as session:
+        return {row.bucket: row.digest for row in await session.execute(statement)}
+
+
+@dataclass
+class ReconcileResult:
+    """What was done"""
+
+    created: List[uuid.UUID] = field(default_factory=list)
+    updated: List[uuid.UUID] = field(default_factory=list)
+    revoked: List[uuid.UUID] = field(default_factory=list)
+    unknown: List[uuid.UUID] = field(default_factory=list)
+    conflicts: Dict[uuid.UUID, str] = field(default_factory=dict)
+    changed: List[User] = field(default_factory=list)
+
+
+def _row_of(dbuser: User) -> RosterRow:
+    """Roster view of a DB user"""
+    return RosterRow(dbuser.rmuuid, dbuser.username, dbuser.is_rmadmin, dbuser.deleted is not None)
+
+
+def _plan(
+    theirs: Sequence[RosterRow], ours: Dict[uuid.UUID, RosterRow], prefix_length: int, buckets: Sequence[str]
+) -> Tuple[List[RosterRow], List[RosterRow], List[uuid.UUID]]:
+    """Split roster rows of the buckets into (missing here, different here) and list our users RM does not have"""
+    wanted = set(buckets)
+    missing: List[RosterRow] = []
+    different: List[RosterRow] = []
+    seen = set()
+    for row in theirs:
+        if bucket_of(row.rmuuid, prefix_length) not in wanted:
+            continue
+        seen.add(row.rmuuid)
+        current = ours.get(row.rmuuid)
+        if current is None:
+            missing.append(row)
+        elif current != row:
+            different.append(row)
+    return missing, different, [rmuuid for rmuuid in ours if rmuuid not in seen]
+
+
+async def _create_missing(
+    session: AsyncSession, missing: Sequence[RosterRow], result: ReconcileResult
+) -> Set[uuid.UUID]:
+    """Insert users we do not have, in bulk unless some username is taken then one by one"""
+    rows = [(row.rmuuid, row.callsign, row.is_rmadmin) for row in missing]
+    try:
+        async with session.begin_nested():
+            created = await User.upsert_many(session, rows, update_admin=False)
+    except sa.exc.IntegrityError:
+        created = []
+        for userrow in rows:
+            try:
+                async with session.begin_nested():
+                    created.extend(await User.upsert_many(session, [userrow], update_admin=False))
+            except sa.exc.IntegrityError:
+                LOGGER.warning("Could not create {}, username taken".format(userrow))
+                result.conflicts[userrow[0]] = "username taken"
+    result.created = [dbuser.rmuuid for dbuser in created]
+    result.changed.extend(created)
+    return set(result.created)
+
+
+async def _update_different(
+    session: AsyncSession, different: Sequence[RosterRow], ours: Dict[uuid.UUID, RosterRow], result: ReconcileResult
+) -> None:
+    """Overwrite our users that differ from the roster, one savepoint each so a taken username only fails that user"""
+    for row in different:
+        deleted: Any = None
+        if row.revoked:
+            # Keep the original revocation time
+            deleted = col(User.deleted) if ours[row.rmuuid].revoked else utcnow
+        statement = (
+            sa.update(User)
+            .where(col(User.rmuuid) == row.rmuuid)
+            .values(username=row.callsign, is_rmadmin=row.is_rmadmin, deleted=deleted, updated=utcnow)
+            .returning(*sa.inspect(User).columns)
+        )
+        try:
+            async with session.begin_nested():
+                updated = await session.scalars(
+                    select(User).from_statement(notifying(statement, User.__tablename__)),
+                    execution_options={"populate_existing": True},
+                )
+                result.changed.extend(updated.all())
+                result.updated.append(row.rmuuid)
+        except sa.exc.IntegrityError:
+            LOGGER.warning("Could not update {} to {}, username taken".format(row.rmuuid, row))
+            result.conflicts[row.rmuuid] = "username taken"
+
+
+async def reconcile(
+    theirs: Sequence[RosterRow],
+    buckets: Sequence[str],
+    prefix_length: int = DEFAULT_PREFIX_LENGTH,
+    revoke_unknown: bool = False,
+) -> ReconcileResult:
+    """Make users in the given buckets match the roster rows, in one transaction. Our users in the buckets that
+    the roster does not have are reported as unknown and only revoked if revoke_unknown is set"""
+    result = ReconcileResult()
+    if not buckets:
+        return result
+    bucket = sa.func.left(sa.cast(col(User.rmuuid), sa.Text), prefix_length)
+    async with EngineWrapper.get_session() as session:
+        ours = {
+            dbuser.rmuuid: _row_of(dbuser)
+            for dbuser in (await session.exec(select(User).where(bucket.in_(buckets)))).all()
+        }
+        missing, different, result.unknown = _plan(theirs, ours, prefix_length, buckets)
+
+        created = await _create_missing(session, missing, result)
+        to_revoke = [row.rmuuid for row in missing if row.revoked and row.rmuuid in created]
+
+        await _update_different(session, different, ours, result)
+
+        if revoke_unknown:
+            to_revoke.extend(result.unknown)
+        revoked = await User.revoke_many(session, to_revoke)
+        result.revoked = [dbuser.rmuuid for dbuser in revoked]
+        result.changed.extend(revoked)
+        await session.commit()
+    LOGGER.info(
+        "Reconciled {} buckets: {} created, {} updated, {} revoked, {} unknown, {} conflicts".format(
+            len(buckets),
+            len(result.created),
+            len(result.updated),
+            len(result.revoked),
+            len(result.unknown),
+            len(result.conflicts),
+        )
+    )
+    return result
@@ -1,22 +1,31 @@
 """Users"""
 
 from __future__ import annotations
-from typing import AsyncGenerator, Self
+from typing import AsyncGenerator, Self, Optional, Tuple, Sequence, List
+import datetime
 import logging
 import uuid
 import secrets
 import string
 
 
-from sqlmodel import Field, select
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlmodel import Field, select, col
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from .base import ORMBaseModel
+from .base import ORMBaseModel, utcnow
 from .engine import EngineWrapper
 from .errors import NotFound, Deleted
+from .changebus import notifying
 
 LOGGER = logging.getLogger(__name__)
 
 CODE_ALPHABET = string.ascii_uppercase + string.digits
+# Rows fetched per round trip from server-side cursors
+LIST_CHUNK_SIZE = 500
+UserCursor = Tuple[datetime.datetime, uuid.UUID]  # (created, pk) of the last user seen
+UserRow = Tuple[uuid.UUID, str, bool]  # (rmuuid, username, is_rmadmin)
 
 
 def generate_code(size: int = 12) -> str:
@@ -41,9 +50,9 @@ class User(ORMBaseModel, table=True):
     @classmethod
     async def by_username(cls, username: str, allow_deleted: bool = False) -> Self:
         """Get by username"""
-        with EngineWrapper.get_session() as session:
+        async with EngineWrapper.get_session() as session:
             statement = select(cls).where(cls.username == username)
-            obj = session.exec(statement).first()
+            obj = (await session.exec(statement)).first()
         if not obj:
             raise NotFound()
         if obj.deleted and not allow_deleted:
@@ -53,28 +62,148 @@ class User(ORMBaseModel, table=True):
     @classmethod
     async def by_rmuuid(cls, rmuuid: str | uuid.UUID, allow_deleted: bool = False) -> Self:
         """Get by username"""
-        with EngineWrapper.get_session() as session:
+        async with EngineWrapper.get_session() as session:
             statement = select(cls).where(cls.rmuuid == rmuuid)
-            obj = session.exec(statement).first()
+            obj = (await session.exec(statement)).first()
         if not obj:
             raise NotFound()
         if obj.deleted and not allow_deleted:
             raise Deleted()
         return obj
 
+    @classmethod
+    async def upsert(cls, rmuuid: str | uuid.UUID, username: str, is_rmadmin: Optional[bool] = None) -> Self:
+        """Create the user or get the existing one with one statement, if is_rmadmin is given it is also set.
+        Raises Deleted for revoked users"""
+        if not isinstance(rmuuid, uuid.UUID):
+            rmuuid = uuid.UUID(rmuuid)
+        async with EngineWrapper.get_session() as session:
+            users = await cls.upsert_many(
+                session,
+                [(rmuuid, username, bool(is_rmadmin))],
+                update_admin=is_rmadmin is not None,
+                return_existing=True,
+            )
+            await session.commit()
+        if not users or users[0].deleted:
+            raise Deleted()
+        return users[0]
+
+    @classmethod
+    async def upsert_many(
+        cls, session: AsyncSession, rows: Sequence[UserRow], update_admin: bool, return_existing: bool = False
+    ) -> List[Self]:
+        """INSERT ... ON CONFLICT (rmuuid) ... RETURNING in the sessions transaction, changes are notified by the
+        same statement. With update_admin existing active users get is_rmadmin from the row and are returned,
+        otherwise existing users are left as-is and only returned if return_existing is set"""
+        if not rows:
+            return []
+        statement = pg_insert(cls).values(
+            [
+                {
+                    "pk": uuid.uuid4(),
+                    "rmuuid": rmuuid,
+                    "username": username,
+                    "mtxpassword": generate_code(),
+                    "is_rmadmin": is_rmadmin,
+                }
+                for rmuuid, username, is_rmadmin in rows
+            ]
+        )
+        if update_admin:
+            statement = statement.on_conflict_do_update(
+                index_elements=[col(cls.rmuuid)],
+                set_={"is_rmadmin": statement.excluded.is_rmadmin, "updated": utcnow},
+                where=col(cls.deleted).is_(None),
+            )
+        elif return_existing:
+            # No-op update so that RETURNING includes the existing row
+            statement = statement.on_conflict_do_update(
+                index_elements=[col(cls.rmuuid)], set_={"is_rmadmin": col(cls.is_rmadmin)}
+            )
+        else:
+            statement = statement.on_conflict_do_nothing(index_elements=[col(cls.rmuuid)])
+        returning = notifying(statement.returning(*sa.inspect(User).columns), cls.__tablename__)
+        result = await session.scalars(
+            select(cls).from_statement(returning), execution_options={"populate_existing": True}
+        )
+        return list(result.all())
+
+    @classmethod
+    async def revoke_many(cls, session: AsyncSession, rmuuids: Sequence[uuid.UUID]) -> List[Self]:
+        """Mark active users deleted in the sessions transaction, returns the users that were revoked"""
+        if not rmuuids:
+            return []
+        statement = (
+            sa.update(cls)
+            .where(col(cls.rmuuid).in_(rmuuids), col(cls.deleted).is_(None))
+            .values(deleted=utcnow, updated=utcnow)
+            .returning(*sa.inspect(User).columns)
+        )
+        result = await session.scalars(
+            select(cls).from_statement(notifying(statement, cls.__tablename__)),
+            execution_options={"populate_existing": True},
+        )
+        return list(result.all())
+
+    @classmethod
+    async def count(cls, include_deleted: bool = False) -> int:
+        """Count users in the DB without loading them"""
+        statement = sa.select(sa.func.count()).select_from(cls)  # pylint: disable=not-callable
+        if not include_deleted:
+            statement = statement.where(col(cls.deleted).is_(None))
+        async with EngineWrapper.get_session() as session:
+            return int((await session.execute(statement)).scalar_one())
+
     @classmethod
     async def list(
         cls,
         include_deleted: bool = False,
     ) -> AsyncGenerator["User", None]:
         """List users, optionally including deleted users"""
-        with EngineWrapper.get_session() as session:
-            statement = select(cls)
-            if not include_deleted:
-                statement = statement.where(
-                    cls.deleted == None  # pylint: disable=C0121 ; # "is None" will create invalid query
-                )
-            results = session.exec(statement)
-            for result in results:
+        async for result in cls.page(limit=None, deleted=None if include_deleted else False):
+            yield result
+
+    @classmethod
+    async def page(
+        cls,
+        *,
+        after: Optional[UserCursor] = None,
+        limit: Optional[int] = 100,
+        is_rmadmin: Optional[bool] = None,
+        deleted: Optional[bool] = False,
+    ) -> AsyncGenerator["User", None]:
+        """Users ordered by (created, pk) starting after the given cursor, read through a server-side cursor
+        LIST_CHUNK_SIZE rows at a time. deleted=None means both deleted and active users"""
+        statement = select(cls).order_by(col(cls.created), col(cls.pk))
+        if after is not None:
+            statement = statement.where(sa.tuple_(col(cls.created), col(cls.pk)) > sa.tuple_(*after))
+        if is_rmadmin is not None:
+            statement = statement.where(col(cls.is_rmadmin).is_(is_rmadmin))
+        if deleted is not None:
+            statement = statement.where(col(cls.deleted).isnot(None) if deleted else col(cls.deleted).is_(None))
+        if limit is not None:
+            statement = statement.limit(limit)
+        statement = statement.execution_options(yield_per=min(limit or LIST_CHUNK_SIZE, LIST_CHUNK_SIZE))
+        async with EngineWrapper.get_session() as session:
+            results = await session.stream_scalars(statement)
+            async for result in results:
                 result.mtxpassword = "REDACTED"  # nosec  # pragma: allowlist secret
                 yield result
+
+
+# Keyset pagination order for User.page
+CREATED_PK_INDEX = sa.Index("ix_users_created_pk", col(User.created), col(User.pk))
+# Active users only and covering the auth columns so auth lookups can be index-only scans
+USERNAME_ACTIVE_INDEX = sa.Index(
+    "ix_users_username_active",
+    col(User.username),
+    postgresql_include=["mtxpassword", "is_rmadmin"],
+    postgresql_where=col(User.deleted).is_(None),
+)
+RMUUID_ACTIVE_INDEX = sa.Index(
+    "ix_users_rmuuid_active",
+    col(User.rmuuid),
+    postgresql_include=["username", "mtxpassword", "is_rmadmin"],
+    postgresql_where=col(User.deleted).is_(None),
+)
@@ -0,0 +1,134 @@
+"""Apply many RM user lifecycle events in one transaction"""
+
+from __future__ import annotations
+from typing import Dict, List, Optional, Sequence, Tuple
+import logging
+import uuid
+from dataclasses import dataclass, field
+
+import sqlalchemy as sa
+from sqlmodel import col
+
+from .engine import EngineWrapper
+from .user import User, UserRow
+
+LOGGER = logging.getLogger(__name__)
+OPERATIONS = ("created", "updated", "promoted", "demoted", "revoked")
+
+
+@dataclass
+class PendingUser:
+    """What the batch wants to happen to one user, entries for the same user are folded in order"""
+
+    rmuuid: uuid.UUID
+    callsign: str
+    entries: List[int] = field(default_factory=list)
+    is_rmadmin: Optional[bool] = field(default=None)  # None means leave as-is
+    revoke: bool = field(default=False)
+
+
+def fold_entries(entries: Sequence[Tuple[str, str, str]], errors: Dict[int, str]) -> Dict[uuid.UUID, PendingUser]:
+    """Fold (operation, uuid, callsign) entries into final state per user, invalid entries go to errors"""
+    pending: Dict[uuid.UUID, PendingUser] = {}
+    for idx, (operation, rawuuid, callsign) in enumerate(entries):
+        if operation not in OPERATIONS:
+            errors[idx] = f"unknown operation {operation}"
+            continue
+        try:
+            rmuuid = uuid.UUID(rawuuid)
+        except ValueError:
+            errors[idx] = "invalid uuid"
+            continue
+        puser = pending.setdefault(rmuuid, PendingUser(rmuuid=rmuuid, callsign=callsign))
+        if puser.revoke:
+            errors[idx] = "revoked earlier in batch"
+            continue
+        puser.entries.append(idx)
+        if operation == "promoted":
+            puser.is_rmadmin = True
+        elif operation == "demoted":
+            puser.is_rmadmin = False
+        elif operation == "revoked":
+            puser.revoke = True
+    return pending
+
+
+def _fail(puser: PendingUser, errors: Dict[int, str], reason: str) -> None:
+    """Mark all entries of the user failed"""
+    for idx in puser.entries:
+        errors[idx] = reason
+
+
+@dataclass
+class BatchPlan:
+    """Bulk statements to run"""
+
+    insert_only: List[UserRow] = field(default_factory=list)
+    set_admin: Dict[bool, List[UserRow]] = field(default_factory=lambda: {True: [], False: []})
+    revoke: List[uuid.UUID] = field(default_factory=list)
+
+
+def plan_batch(
+    pending: Dict[uuid.UUID, PendingUser],
+    existing: Dict[uuid.UUID, bool],
+    taken: Dict[str, uuid.UUID],
+    errors: Dict[int, str],
+) -> BatchPlan:
+    """Plan the statements given existing users (rmuuid -> is deleted) and usernames in use (username -> rmuuid),
+    users that can not be changed go to errors"""
+    plan = BatchPlan()
+    for puser in pending.values():
+        if existing.get(puser.rmuuid):
+            _fail(puser, errors, "user is deleted")
+            continue
+        if puser.rmuuid not in existing:
+            owner = taken.get(puser.callsign)
+            if owner is not None and owner != puser.rmuuid:
+                _fail(puser, errors, "username taken")
+                continue
+            if puser.revoke and len(puser.entries) == 1:
+                _fail(puser, errors, "user not found")
+                continue
+            taken[puser.callsign] = puser.rmuuid
+        if puser.is_rmadmin is not None:
+            plan.set_admin[puser.is_rmadmin].append((puser.rmuuid, puser.callsign, puser.is_rmadmin))
+        elif puser.rmuuid not in existing:
+            plan.insert_only.append((puser.rmuuid, puser.callsign, False))
+        if puser.revoke:
+            plan.revoke.append(puser.rmuuid)
+    return plan
+
+
+async def apply_batch(entries: Sequence[Tuple[str, str, str]]) -> Tuple[Dict[int, str], List[User]]:
+    """Apply (operation, uuid, callsign) entries with bulk statements in one transaction, each statement also
+    notifies the rows it changed.
+    Returns errors keyed by entry index and the users that changed"""
+    errors: Dict[int, str] = {}
+    pending = fold_entries(entries, errors)
+    if not pending:
+        return errors, []
+    changed: Dict[uuid.UUID, User] = {}
+    async with EngineWrapper.get_session() as session:
+        statement = sa.select(col(User.rmuuid), col(User.username), col(User.deleted)).where(
+            sa.or_(
+                col(User.rmuuid).in_(pending.keys()),
+                col(User.username).in_({puser.callsign for puser in pending.values()}),
+            )
+        )
+        existing: Dict[uuid.UUID, bool] = {}
+        taken: Dict[str, uuid.UUID] = {}
+        for row in await session.execute(statement):
+            existing[row.rmuuid] = row.deleted is not None
+            taken[row.username] = row.rmuuid
+        plan = plan_batch(pending, existing, taken, errors)
+
+        for dbuser in await User.upsert_many(session, plan.insert_only, update_admin=False):
+            changed[dbuser.rmuuid] = dbuser
+        for rows in plan.set_admin.values():
+            for dbuser in await User.upsert_many(session, rows, update_admin=True):
+                changed[dbuser.rmuuid] = dbuser
+        for dbuser in await User.revoke_many(session, plan.revoke):
+            changed[dbuser.rmuuid] = dbuser
+        await session.commit()
+    LOGGER.debug("Batch of {} entries changed {} users".format(len(entries), len(changed)))
+    return errors, list(changed.values())
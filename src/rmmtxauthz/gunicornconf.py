@@ -0,0 +1,36 @@
+"""Gunicorn server hooks, use with: gunicorn -c python:rmmtxauthz.gunicornconf"""
+
+from typing import Any
+import os
+
+# Also listen on this Unix domain socket, meant for the MediaMTX auth hook traffic via a local proxy or sidecar
+UDS_PATH_ENV = "RMMTX_UDS_PATH"
+UDS_MODE_ENV = "RMMTX_UDS_MODE"
+
+
+def on_starting(server: Any) -> None:
+    """Add the Unix domain socket to the TCP binds given on the command line"""
+    path = os.environ.get(UDS_PATH_ENV)
+    if not path:
+        return
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    address = f"unix:{path}"
+    if address not in server.cfg.bind:
+        server.cfg.set("bind", [*server.cfg.bind, address])
+
+
+def when_ready(server: Any) -> None:
+    """Let the socket be used by the group too, gunicorn creates it according to umask"""
+    _ = server
+    path = os.environ.get(UDS_PATH_ENV)
+    if path and os.path.exists(path):
+        os.chmod(path, int(os.environ.get(UDS_MODE_ENV, "660"), 8))
+
+
+def child_exit(server: Any, worker: Any) -> None:
+    """Clean up the multiprocess metrics of dead workers"""
+    _ = server
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess  # pylint: disable=C0415
+
+        multiprocess.mark_process_dead(worker.pid)  # type: ignore[no-untyped-call]
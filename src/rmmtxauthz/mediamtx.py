@@ -1,22 +1,74 @@
 """MediaMTX control API abstraction"""
 
-from typing import Optional, ClassVar, Sequence, Dict, Any
+from typing import Optional, ClassVar, Sequence, Dict, Any, AsyncGenerator, Deque, Tuple, List, Mapping, Iterator
+import asyncio
+import hashlib
+import json
 import logging
-from dataclasses import dataclass
+import time
+from collections import deque
+from dataclasses import dataclass, field
 import ssl
 from pathlib import Path
 
 import aiohttp
+from libadvian.tasks import TaskMaster
 from libpvarki.mtlshelp.context import get_ca_context
 
-from .config import RMMTXSettings
+from .config import RMMTXSettings, Protocol
+from .metrics import MTX_API_DURATION
 
 LOGGER = logging.getLogger(__name__)
+POLLER_TASK_NAME = "mtx_paths_poller"
+REVALIDATE_TASK_NAME = "mtx_paths_revalidate"
+
+
+def path_item(name: str, insert_credentials: str, address: str, protocols: Mapping[str, Protocol]) -> Dict[str, Any]:
+    """Path and its url for each protocol"""
+    path = f"/{name}"
+    return {
+        "path": path,
+        "urls": {
+            pname: f"{pinfo.proto}://{insert_credentials}{address}:{pinfo.port}{path}"
+            for pname, pinfo in protocols.items()
+        },
+    }
+
+
+@dataclass(frozen=True)
+class PathsSnapshot:
+    """Active path names at some point in time, version changes whenever the names do"""
+
+    version: int
+    names: Tuple[str, ...]
+    fetched: float = field(default_factory=time.monotonic)
+    digest: str = field(init=False)
+
+    def __post_init__(self) -> None:
+        """Hash the names once so per-request content versions are cheap"""
+        object.__setattr__(self, "digest", hashlib.sha256("\n".join(self.names).encode("utf-8")).hexdigest())
+
+    @property
+    def age(self) -> float:
+        """Seconds since fetched"""
+        return time.monotonic() - self.fetched
+
+    def content_version(self, insert_credentials: str = "") -> str:
+        """Version of the rendered listing: path set, protocol config and the credentials put in the URLs"""
+        cnf = RMMTXSettings.singleton()
+        material = f"{self.digest}|{cnf.mtx_address}|{cnf.protocols!r}|{insert_credentials}"
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()[:32]
 
 
 @dataclass
 class MediaMTXControl:
-    """MediaMTX control API abstraction"""
+    """MediaMTX control API abstraction, keeps one keep-alive connection pool per worker"""
+
+    session: Optional[aiohttp.ClientSession] = field(default=None)
+    ssl_context: Optional[ssl.SSLContext] = field(default=None)
+    snapshot: Optional[PathsSnapshot] = field(default=None)
+    _loop: Optional[asyncio.AbstractEventLoop] = field(init=False, default=None)
+    _refresh_task: Optional["asyncio.Task[PathsSnapshot]"] = field(init=False, default=None)
 
     _singleton: ClassVar[Optional["MediaMTXControl"]] = None
 
@@ -27,35 +79,179 @@ class MediaMTXControl:
             MediaMTXControl._singleton = MediaMTXControl()
         return MediaMTXControl._singleton
 
-    def get_session(self) -> aiohttp.ClientSession:
-        """Get session"""
+    def get_ssl_context(self) -> Optional[ssl.SSLContext]:
+        """Build the SSL context once, None means aiohttp defaults"""
+        if self.ssl_context is None:
+            cadir = Path("/ca_public")
+            if cadir.is_dir():
+                self.ssl_context = get_ca_context(ssl.Purpose.SERVER_AUTH, cadir)
+        return self.ssl_context
+
+    async def start(self) -> None:
+        """Create the session for the current event loop, replacing any previous one"""
+        await self._discard_session()
         cnf = RMMTXSettings.singleton()
         auth = aiohttp.BasicAuth(login=cnf.api_username, password=cnf.api_password)
-        cadir = Path("/ca_public")
-        if cadir.is_dir():
-            ctx = get_ca_context(ssl.Purpose.SERVER_AUTH, cadir)
-            conn = aiohttp.TCPConnector(ssl=ctx)
-            return aiohttp.ClientSession(connector=conn, auth=auth, base_url=cnf.api_url, raise_for_status=True)
-        # Fallback
-        return aiohttp.ClientSession(auth=auth, base_url=cnf.api_url, raise_for_status=True)
+        ctx = self.get_ssl_context()
+        conn = aiohttp.TCPConnector(
+            ssl=ctx if ctx is not None else True,
+            limit=cnf.api_pool_limit,
+            keepalive_timeout=cnf.api_keepalive_timeout,
+        )
+        timeout = aiohttp.ClientTimeout(total=cnf.api_total_timeout, connect=cnf.api_connect_timeout)
+        self.session = aiohttp.ClientSession(
+            connector=conn, auth=auth, base_url=cnf.api_url, raise_for_status=True, timeout=timeout
+        )
+        self._loop = asyncio.get_running_loop()
 
-    async def get_paths(self, insert_credentials: str = "") -> Sequence[Dict[str, Any]]:
-        """Get active paths and generate their corresponding urls for each protocol
+    async def close(self) -> None:
+        """Close the session and its connections"""
+        await self._discard_session()
+
+    async def _discard_session(self) -> None:
+        """Close the session in the loop it belongs to, one whose loop is already closed can only be dropped"""
+        session, loop = self.session, self._loop
+        self.session = None
+        if session is None or session.closed:
+            return
+        if loop is None or loop is asyncio.get_running_loop():
+            await session.close()
+        elif loop.is_closed():
+            session.detach()
+        else:
+            asyncio.run_coroutine_threadsafe(session.close(), loop)
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        """Get the session, (re)creating it if needed, sessions are bound to the loop they were created in"""
+        if self.session is None or self.session.closed or self._loop is not asyncio.get_running_loop():
+            await self.start()
+        assert self.session
+        return self.session
+
+    async def get_paths_page(self, page: int) -> Dict[str, Any]:
+        """Get one page of the paths list"""
+        cnf = RMMTXSettings.singleton()
+        session = await self.get_session()
+        started = time.perf_counter()
+        async with session.get("/v3/paths/list", params={"page": page, "itemsPerPage": cnf.api_page_size}) as resp:
+            payload: Dict[str, Any] = await resp.json()
+        MTX_API_DURATION.labels("paths_list_page").observe(time.perf_counter() - started)
+        return payload
+
+    async def ping(self) -> None:
+        """Check that the control API answers, raises on errors"""
+        session = await self.get_session()
+        started = time.perf_counter()
+        async with session.get("/v3/paths/list", params={"page": 0, "itemsPerPage": 1}) as resp:
+            await resp.read()
+        MTX_API_DURATION.labels("ping").observe(time.perf_counter() - started)
+
+    async def iter_path_names(self) -> AsyncGenerator[str, None]:
+        """Walk all pages of active paths, once pageCount is known the following pages are prefetched concurrently
+        (up to api_prefetch_pages at a time) while the current one is consumed"""
+        first = await self.get_paths_page(0)
+        page_count = int(first.get("pageCount", 1))
+        window = max(1, RMMTXSettings.singleton().api_prefetch_pages)
+        pending: Deque["asyncio.Task[Dict[str, Any]]"] = deque()
+        next_page = 1
+
+        def schedule() -> None:
+            """Keep the prefetch window full"""
+            nonlocal next_page
+            while next_page < page_count and len(pending) < window:
+                pending.append(asyncio.create_task(self.get_paths_page(next_page)))
+                next_page += 1
+
+        try:
+            schedule()
+            for plitem in first["items"]:
+                yield str(plitem["name"])
+            del first
+            while pending:
+                payload = await pending.popleft()
+                schedule()
+                for plitem in payload["items"]:
+                    yield str(plitem["name"])
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _fetch_snapshot(self) -> PathsSnapshot:
+        """Fetch all path names and swap in new snapshot"""
+        started = time.perf_counter()
+        names = tuple([name async for name in self.iter_path_names()])
+        MTX_API_DURATION.labels("get_paths").observe(time.perf_counter() - started)
+        previous = self.snapshot
+        version = 1
+        if previous is not None:
+            version = previous.version if previous.names == names else previous.version + 1
+        self.snapshot = PathsSnapshot(version=version, names=names)
+        return self.snapshot
+
+    async def refresh_snapshot(self) -> PathsSnapshot:
+        """Refresh the snapshot, concurrent callers share the same fetch"""
+        task = self._refresh_task
+        if task is None or task.done() or task.get_loop() is not asyncio.get_running_loop():
+            task = asyncio.get_running_loop().create_task(self._fetch_snapshot())
+            self._refresh_task = task
+        return await asyncio.shield(task)
+
+    async def _revalidate(self) -> None:
+        """Background refresh, keep serving the stale snapshot on errors"""
+        try:
+            await self.refresh_snapshot()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+            LOGGER.warning("Could not refresh paths snapshot, serving stale: {}".format(exc))
+        except Exception:  # pylint: disable=W0703
+            LOGGER.exception("Unexpected error refreshing paths snapshot, serving stale")
+
+    async def get_snapshot(self) -> PathsSnapshot:
+        """Get the snapshot, only the very first call waits for MediaMTX. Stale snapshots are returned as-is
+        while a refresh is started in the background"""
+        snapshot = self.snapshot
+        if snapshot is None:
+            return await self.refresh_snapshot()
+        if snapshot.age > RMMTXSettings.singleton().mtx_snapshot_interval:
+            taskmaster = TaskMaster.singleton()
+            if not taskmaster.exists(REVALIDATE_TASK_NAME) and not taskmaster.exists(POLLER_TASK_NAME):
+                taskmaster.create_task(self._revalidate(), name=REVALIDATE_TASK_NAME)
+        return snapshot
+
+    async def poll_loop(self) -> None:
+        """Keep the snapshot fresh until cancelled"""
+        interval = RMMTXSettings.singleton().mtx_snapshot_interval
+        try:
+            while True:
+                await self._revalidate()
+                await asyncio.sleep(interval)
+        except asyncio.CancelledError:
+            LOGGER.debug("Paths poller cancelled")
+
+    @classmethod
+    def render_paths(cls, snapshot: PathsSnapshot, insert_credentials: str = "") -> List[Dict[str, Any]]:
+        """Generate the urls for each protocol for paths in the snapshot
         insert_credentials MUST be in format: username:password@"""
-        ret = []
         cnf = RMMTXSettings.singleton()
         protocols = cnf.protocols
-        async with self.get_session() as session:
-            resp = await session.get("/v3/paths/list", params={"itemsPerPage": 1000})
-            payload = await resp.json()
-            for plitem in payload["items"]:
-                path = f"/{plitem['name']}"
-                item = {
-                    "path": path,
-                    "urls": {},
-                }
-                for pname, pinfo in protocols.items():
-                    url = f"{pinfo.proto}://{insert_credentials}{cnf.mtx_address}:{pinfo.port}{path}"
-                    item["urls"][pname] = url  # type: ignore[index]
-                ret.append(item)
-        return ret
+        return [path_item(name, insert_credentials, cnf.mtx_address, protocols) for name in snapshot.names]
+
+    @classmethod
+    def iter_ndjson(cls, snapshot: PathsSnapshot, insert_credentials: str = "", batch: int = 100) -> Iterator[bytes]:
+        """Render the snapshot as newline delimited JSON one batch of paths at a time, so memory use does not
+        depend on how many paths there are"""
+        cnf = RMMTXSettings.singleton()
+        protocols = cnf.protocols
+        lines: List[str] = []
+        for name in snapshot.names:
+            lines.append(json.dumps(path_item(name, insert_credentials, cnf.mtx_address, protocols)))
+            if len(lines) >= batch:
+                yield ("\n".join(lines) + "\n").encode("utf-8")
+                lines = []
+        if lines:
+            yield ("\n".join(lines) + "\n").encode("utf-8")
+
+    async def get_paths(self, insert_credentials: str = "") -> Sequence[Dict[str, Any]]:
+        """Get active paths from the snapshot and generate their corresponding urls for each protocol
+        insert_credentials MUST be in format: username:password@"""
+        return self.render_paths(await self.get_snapshot(), insert_credentials)
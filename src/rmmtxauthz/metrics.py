@@ -0,0 +1,110 @@
+"""Prometheus metrics, aggregated over gunicorn workers when PROMETHEUS_MULTIPROC_DIR is set"""
+
+from typing import Any, Awaitable, Callable, MutableMapping
+import logging
+import os
+import time
+
+from prometheus_client import Histogram, Counter, Gauge, CollectorRegistry, REGISTRY, generate_latest
+from prometheus_client import multiprocess
+
+LOGGER = logging.getLogger(__name__)
+
+# Auth decisions are mostly in-memory so we need finer buckets at the low end than the defaults
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+HTTP_REQUEST_DURATION = Histogram(
+    "rmmtxauthz_http_request_duration_seconds",
+    "HTTP request latency by route",
+    ["method", "route", "status"],
+    buckets=FAST_BUCKETS,
+)
+MTX_AUTH_DURATION = Histogram(
+    "rmmtxauthz_mtx_auth_duration_seconds",
+    "MediaMTX auth hook latency by decision and the check branch that made it",
+    ["decision", "branch"],
+    buckets=FAST_BUCKETS,
+)
+MTX_AUTH_SHED = Counter(
+    "rmmtxauthz_mtx_auth_shed_total",
+    "MediaMTX auth requests rejected without checking credentials",
+    ["reason"],
+)
+DB_QUERY_DURATION = Histogram(
+    "rmmtxauthz_db_query_duration_seconds",
+    "DB statement execution time",
+    ["statement"],
+    buckets=FAST_BUCKETS,
+)
+DB_POOL_CHECKOUT_WAIT = Histogram(
+    "rmmtxauthz_db_pool_checkout_wait_seconds",
+    "Time spent waiting for a connection from the pool",
+    buckets=FAST_BUCKETS,
+)
+DB_POOL_IN_USE = Gauge(
+    "rmmtxauthz_db_pool_in_use",
+    "Connections checked out from the pool, summed over live workers",
+    multiprocess_mode="livesum",
+)
+DB_POOL_OVERFLOW = Gauge(
+    "rmmtxauthz_db_pool_overflow",
+    "Connections opened beyond pool_size, summed over live workers",
+    multiprocess_mode="livesum",
+)
+DB_POOL_PINGS = Counter(
+    "rmmtxauthz_db_pool_pings_total",
+    "Liveness pings of idle connections on checkout",
+    ["result"],
+)
+MTX_API_DURATION = Histogram(
+    "rmmtxauthz_mtx_api_duration_seconds",
+    "MediaMTX control API call latency",
+    ["operation"],
+    buckets=FAST_BUCKETS,
+)
+
+
+def render_latest() -> bytes:
+    """Render metrics of this process, or all workers in multiprocess mode"""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)  # type: ignore[no-untyped-call]
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+
+Scope = MutableMapping[str, Any]
+Message = MutableMapping[str, Any]
+Receive = Callable[[], Awaitable[Message]]
+Send = Callable[[Message], Awaitable[None]]
+ASGIApp = Callable[[Scope, Receive, Send], Awaitable[None]]
+
+
+class MetricsMiddleware:  # pylint: disable=too-few-public-methods
+    """Pure ASGI middleware observing request latency per route template"""
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            # Use the template so path parameters do not explode cardinality
+            route_path = getattr(route, "path", "__unmatched__")
+            HTTP_REQUEST_DURATION.labels(scope["method"], route_path, str(status)).observe(
+                time.perf_counter() - started
+            )
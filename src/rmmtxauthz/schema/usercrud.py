@@ -0,0 +1,170 @@
+"""Schemas for the RM user management routes"""
+
+from typing import Dict, List, Optional, Literal
+import datetime
+import uuid
+
+from pydantic import Field, BaseModel, ConfigDict
+from libpvarki.schemas.product import UserCRUDRequest
+
+# asyncpg allows 32767 bind parameters per statement, the bulk upserts use 5 per user
+BATCH_MAX_ENTRIES = 1000
+
+
+class UserListItem(BaseModel):
+    """User as seen in listings, without credentials"""
+
+    rmuuid: uuid.UUID = Field(description="RASENMAEHER user UUID")
+    username: str = Field(description="MediaMTX username")
+    is_rmadmin: bool = Field(description="User has admin role in RASENMAEHER")
+    created: datetime.datetime = Field(description="Creation timestamp")
+    updated: datetime.datetime = Field(description="Last update timestamp")
+    deleted: Optional[datetime.datetime] = Field(description="Revocation timestamp", default=None)
+
+    model_config = ConfigDict(from_attributes=True)
+
+
+class UserListResponse(BaseModel):
+    """One page of users"""
+
+    items: List[UserListItem] = Field(description="Users on this page")
+    next_cursor: Optional[str] = Field(description="Pass as cursor to get the next page, null on last page")
+
+    model_config = ConfigDict(
+        json_schema_extra={
+            "examples": [
+                {
+                    "items": [
+                        {
+                            "rmuuid": "2a4c1b43-fb6e-4a52-8cb4-1d1a3c1f1f11",
+                            "username": "KOIRA11a",
+                            "is_rmadmin": False,
+                            "created": "2024-05-01T10:00:00Z",
+                            "updated": "2024-05-01T10:00:00Z",
+                            "deleted": None,
+                        },
+                    ],
+                    "next_cursor": "MjAyNC0wNS0wMVQxMDowMDowMCswMDowMHwyYTRjMWI0My1mYjZl",
+                },
+            ],
+        },
+    )
+
+
+class UserBatchEntry(BaseModel):
+    """One lifecycle event"""
+
+    operation: Literal["created", "updated", "promoted", "demoted", "revoked"] = Field(
+        description="Same as the single user endpoint of the same name"
+    )
+    user: UserCRUDRequest = Field(description="The user")
+
+    model_config = ConfigDict(extra="forbid")
+
+
+class UserBatchRequest(BaseModel):
+    """Lifecycle events applied in order in one transaction"""
+
+    entries: List[UserBatchEntry] = Field(description="Events in order", max_length=BATCH_MAX_ENTRIES)
+
+    model_config = ConfigDict(
+        extra="forbid",
+        json_schema_extra={
+            "examples": [
+                {
+                    "entries": [
+                        {
+                            "operation": "created",
+                            "user": {
+                                "uuid": "2a4c1b43-fb6e-4a52-8cb4-1d1a3c1f1f11",
+                                "callsign": "KOIRA11a",
+                                "x509cert": "-----BEGIN CERTIFICATE-----\\nMIIEwjCC...\\n-----END CERTIFICATE-----\\n",
+                            },
+                        },
+                        {
+                            "operation": "promoted",
+                            "user": {
+                                "uuid": "2a4c1b43-fb6e-4a52-8cb4-1d1a3c1f1f11",
+                                "callsign": "KOIRA11a",
+                                "x509cert": "-----BEGIN CERTIFICATE-----\\nMIIEwjCC...\\n-----END CERTIFICATE-----\\n",
+                            },
+                        },
+                    ],
+                },
+            ],
+        },
+    )
+
+
+class UserBatchResult(BaseModel):
+    """Result of one lifecycle event"""
+
+    operation: str = Field(description="Operation of the entry")
+    uuid: str = Field(description="User UUID of the entry")
+    success: bool = Field(description="Was the entry applied")
+    error: Optional[str] = Field(description="Why not", default=None)
+
+
+class UserBatchResponse(BaseModel):
+    """Results in the same order as the entries"""
+
+    results: List[UserBatchResult] = Field(description="Per entry results")
+
+
+class RosterEntry(BaseModel):
+    """User as RASENMAEHER sees it"""
+
+    uuid: str = Field(description="User UUID")
+    callsign: str = Field(description="Callsign")
+    is_rmadmin: bool = Field(description="Has admin role", default=False)
+    revoked: bool = Field(description="Has been revoked", default=False)
+
+
+class RosterDigestRequest(BaseModel):
+    """Digests of the RASENMAEHER roster per rmuuid prefix bucket.
+
+    Digest is hex sha256 over lines "uuid|callsign|is_rmadmin|revoked" (booleans as 1/0, uuid lowercase)
+    of users in the bucket, sorted by uuid and joined with newlines. Empty buckets are omitted."""
+
+    prefix_length: int = Field(description="Bucket by this many first characters of uuid", default=2, ge=1, le=4)
+    buckets: Dict[str, str] = Field(description="bucket -> digest")
+
+    model_config = ConfigDict(
+        extra="forbid",
+        json_schema_extra={
+            "examples": [
+                {
+                    "prefix_length": 2,
+                    "buckets": {"2a": "9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08"},
+                },
+            ],
+        },
+    )
+
+
+class RosterDigestResponse(BaseModel):
+    """Buckets that differ, send their rows to apply"""
+
+    prefix_length: int = Field(description="Bucket prefix length used")
+    mismatched: List[str] = Field(description="Buckets that differ or exist only on one side")
+
+
+class RosterApplyRequest(BaseModel):
+    """Full rows of the mismatched buckets"""
+
+    prefix_length: int = Field(description="Bucket prefix length used", default=2, ge=1, le=4)
+    buckets: List[str] = Field(description="Buckets being reconciled")
+    users: List[RosterEntry] = Field(description="All RASENMAEHER users in those buckets")
+    revoke_unknown: bool = Field(description="Revoke users in the buckets RASENMAEHER does not have", default=False)
+
+    model_config = ConfigDict(extra="forbid")
+
+
+class RosterApplyResponse(BaseModel):
+    """What was changed"""
+
+    created: List[uuid.UUID] = Field(description="Users created")
+    updated: List[uuid.UUID] = Field(description="Users changed to match the roster")
+    revoked: List[uuid.UUID] = Field(description="Users revoked")
+    unknown: List[uuid.UUID] = Field(description="Users in the buckets that the roster does not have")
+    conflicts: Dict[uuid.UUID, str] = Field(description="Users that could not be changed and why")
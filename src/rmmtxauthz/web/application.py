@@ -3,15 +3,21 @@
 from typing import AsyncGenerator
 import asyncio
 import logging
+import time
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
+from fastapi.middleware.gzip import GZipMiddleware
 from libadvian.logging import init_logging
 from libadvian.tasks import TaskMaster
 
 from rmmtxauthz import __version__
 from ..db.dbinit import init_db
 from ..config import RMMTXSettings
+from ..db.changebus import ChangeBus, LISTENER_TASK_NAME
+from ..credindex import CredentialIndex, REFRESH_TASK_NAME
+from ..credshm import SharedCredentials
+from ..mediamtx import MediaMTXControl, POLLER_TASK_NAME
 from .usercrud import crudrouter
 from .mediamtx import mtxrouter
 from .instructions import router as irouter
@@ -21,6 +27,8 @@ from .userdirect import userrouter
 from .userproxy import userrouterproxy
 from .description import router as descriptionsrouter
 from .description import router_v2 as descriptionsrouterv2
+from .metrics import metricsrouter
+from ..metrics import MetricsMiddleware
 
 LOGGER = logging.getLogger(__name__)
 
@@ -29,13 +37,30 @@ LOGGER = logging.getLogger(__name__)
 async def app_lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
     """Manage lifespan stuff like DB initialization"""
     _ = app
+    started = time.perf_counter()
     LOGGER.debug("DB startup")
     await asyncio.gather(
         init_db(),
     )
+    index = CredentialIndex.singleton()
+    if RMMTXSettings.singleton().credshm_enabled:
+        # One worker refreshes and publishes, the rest read the shared table
+        await SharedCredentials.singleton().start(index)
+    else:
+        await index.refresh()
+        TaskMaster.singleton().create_task(index.refresh_loop(), name=REFRESH_TASK_NAME)
+        if RMMTXSettings.singleton().changebus_enabled:
+            bus = ChangeBus.singleton()
+            bus.subscribe(index.on_change)
+            TaskMaster.singleton().create_task(bus.run(), name=LISTENER_TASK_NAME)
+    mtxcontrol = MediaMTXControl.singleton()
+    await mtxcontrol.start()
+    TaskMaster.singleton().create_task(mtxcontrol.poll_loop(), name=POLLER_TASK_NAME)
+    LOGGER.info("Startup done in {:.1f}ms".format((time.perf_counter() - started) * 1000))
     yield None
     LOGGER.debug("Cleanup")
     await TaskMaster.singleton().stop_lingering_tasks()  # Make sure tasks get finished
+    await MediaMTXControl.singleton().close()
 
 
 def get_app_no_init() -> FastAPI:
@@ -57,6 +82,9 @@ def get_app_no_init() -> FastAPI:
     app.include_router(userrouterproxy, prefix="/api/v1/proxy", tags=["proxyuser"])
 
     app.include_router(descriptionsrouterv2, prefix="/api/v2", tags=["description"])
+    app.include_router(metricsrouter, tags=["metrics"])
+    app.add_middleware(GZipMiddleware, minimum_size=RMMTXSettings.singleton().gzip_minimum_size)
+    app.add_middleware(MetricsMiddleware)
     return app
 
 
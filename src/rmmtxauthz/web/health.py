@@ -1,21 +1,103 @@
 """Health check"""
 
+from __future__ import annotations
+from typing import Optional, ClassVar, List, Any, Awaitable
+import asyncio
 import logging
+import time
+from dataclasses import dataclass, field
 
+import sqlalchemy as sa
 from fastapi import APIRouter
 from libpvarki.schemas.product import ProductHealthCheckResponse
 
+from ..config import RMMTXSettings
+from ..db.engine import EngineWrapper
 from ..db.user import User
+from ..authguard import AuthGuard
+from ..mediamtx import MediaMTXControl
 
 LOGGER = logging.getLogger(__name__)
 
 hrouter = APIRouter()
 
 
+async def ping_db() -> None:
+    """Round trip to the DB"""
+    engine = EngineWrapper.singleton().engine
+    assert engine
+    async with engine.connect() as connection:
+        await connection.execute(sa.text("SELECT 1"))
+
+
+@dataclass
+class DeepHealth:
+    """Result of the deep healthcheck"""
+
+    healthy: bool
+    users_count: Optional[int]
+    errors: List[str]
+    checked: float = field(default_factory=time.monotonic)
+
+    @property
+    def age(self) -> float:
+        """Seconds since checked"""
+        return time.monotonic() - self.checked
+
+
+@dataclass
+class HealthProbe:
+    """Runs the DB and MediaMTX probes concurrently, the result is reused for healthcheck_cache_ttl seconds"""
+
+    result: Optional[DeepHealth] = field(default=None)
+    _task: Optional["asyncio.Task[DeepHealth]"] = field(init=False, default=None)
+
+    _singleton: ClassVar[Optional["HealthProbe"]] = None
+
+    @classmethod
+    def singleton(cls) -> "HealthProbe":
+        """Return singleton"""
+        if not HealthProbe._singleton:
+            HealthProbe._singleton = HealthProbe()
+        return HealthProbe._singleton
+
+    async def _check(self) -> DeepHealth:
+        """Run all probes, each with its own timeout"""
+        timeout = RMMTXSettings.singleton().healthcheck_timeout
+        probes: List[Awaitable[Any]] = [User.count(), ping_db(), MediaMTXControl.singleton().ping()]
+        results = await asyncio.gather(
+            *(asyncio.wait_for(probe, timeout) for probe in probes),
+            return_exceptions=True,
+        )
+        errors: List[str] = []
+        for name, res in zip(("users count", "DB ping", "MediaMTX API"), results):
+            if isinstance(res, BaseException):
+                LOGGER.warning("Healthcheck probe '{}' failed: {!r}".format(name, res))
+                errors.append(f"{name} failed: {type(res).__name__}")
+        users_count = results[0] if isinstance(results[0], int) else None
+        self.result = DeepHealth(healthy=not errors, users_count=users_count, errors=errors)
+        return self.result
+
+    async def deep(self) -> DeepHealth:
+        """Get cached result or check, concurrent callers share the same check"""
+        if self.result is not None and self.result.age < RMMTXSettings.singleton().healthcheck_cache_ttl:
+            return self.result
+        task = self._task
+        if task is None or task.done() or task.get_loop() is not asyncio.get_running_loop():
+            task = asyncio.get_running_loop().create_task(self._check())
+            self._task = task
+        return await asyncio.shield(task)
+
+
 @hrouter.get("/healthcheck")
-async def request_healthcheck() -> ProductHealthCheckResponse:
-    """Check that we are healthy, return accordingly"""
-    users_count = 0
-    async for _user in User.list():
-        users_count += 1
-    return ProductHealthCheckResponse(healthy=True, extra=f"DB works, {users_count} users found")
+async def request_healthcheck(deep: bool = True) -> ProductHealthCheckResponse:
+    """Check that we are healthy, return accordingly. With deep=false only check that the process answers"""
+    shed = AuthGuard.singleton().shed
+    if not deep:
+        return ProductHealthCheckResponse(healthy=True, extra=f"alive, {shed} auth requests shed")
+    result = await HealthProbe.singleton().deep()
+    if not result.healthy:
+        return ProductHealthCheckResponse(healthy=False, extra=", ".join(result.errors))
+    return ProductHealthCheckResponse(
+        healthy=True, extra=f"DB works, {result.users_count} users found, {shed} auth requests shed"
+    )
@@ -1,9 +1,11 @@
 """Instructions API"""
 
 from __future__ import annotations
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional, ClassVar
+import asyncio
 import logging
 import json
+from dataclasses import dataclass, field
 from pathlib import Path
 
 from fastapi import APIRouter, Depends, Request, HTTPException
@@ -14,9 +16,11 @@ from libpvarki.schemas.product import UserCRUDRequest
 from ..db.user import User
 from ..db.errors import NotFound
 from .usercrud import comes_from_rm, create_user
-from ..mediamtx import MediaMTXControl
+from ..mediamtx import MediaMTXControl, PathsSnapshot
 
 LOGGER = logging.getLogger(__name__)
+# Placeholder put in the URLs when pre-rendering, replaced with the users credentials
+CREDENTIALS_MARKER = "\x00CREDENTIALS\x00"
 
 router = APIRouter(dependencies=[Depends(MTLSHeader(auto_error=True))])
 
@@ -32,23 +36,75 @@ async def get_asset(file_path: str) -> FileResponse:
     return FileResponse(path=str(assetpath))
 
 
-@router.post("/instructions/{language}")
-async def user_intructions(user: UserCRUDRequest, request: Request, language: str) -> Dict[str, Any]:
-    """return user instructions"""
-    comes_from_rm(request)
+@dataclass
+class InstructionsCache:
+    """Parsed rune template (re-parsed when its mtime changes) and the streams fragment pre-rendered per snapshot"""
+
+    template_path: Path = field(default=Path("/opt/templates/mediamtx.json"))
+    template: Optional[List[Dict[str, Any]]] = field(default=None)
+    template_mtime: Optional[int] = field(default=None)
+    streams_key: Optional[str] = field(default=None)
+    streams_parts: List[str] = field(default_factory=list)
+
+    _singleton: ClassVar[Optional["InstructionsCache"]] = None
+
+    @classmethod
+    def singleton(cls) -> "InstructionsCache":
+        """Return singleton"""
+        if not InstructionsCache._singleton:
+            InstructionsCache._singleton = InstructionsCache()
+        return InstructionsCache._singleton
+
+    def get_template(self) -> Optional[List[Dict[str, Any]]]:
+        """Get parsed template, None if the file is missing"""
+        try:
+            mtime = self.template_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+        if self.template is None or mtime != self.template_mtime:
+            LOGGER.debug("Parsing {}".format(self.template_path))
+            self.template = json.loads(self.template_path.read_text(encoding="utf-8"))
+            self.template_mtime = mtime
+        return self.template
+
+    def render_streams(self, snapshot: PathsSnapshot, credentials: str) -> str:
+        """Streams list HTML with the credentials inserted, the HTML is built once per snapshot version"""
+        key = snapshot.content_version()
+        if key != self.streams_key:
+            streams = MediaMTXControl.render_paths(snapshot, insert_credentials=CREDENTIALS_MARKER)
+            fragments = ["<ul>\n"]
+            for streamdict in streams:
+                fragments.append(f"<li>{streamdict['path']}<ul>")
+                for pname, purl in streamdict["urls"].items():
+                    fragments.append(f'<li><a href="{purl}">{pname}</a></li>')
+                fragments.append("</ul></li>\n")
+            fragments.append("<ul>\n")
+            self.streams_parts = "".join(fragments).split(CREDENTIALS_MARKER)
+            self.streams_key = key
+        return credentials.join(self.streams_parts)
+
+
+async def get_or_create_user(user: UserCRUDRequest) -> User:
+    """Get the user, create if not found"""
     try:
-        dbuser = await User.by_rmuuid(user.uuid)
+        return await User.by_rmuuid(user.uuid)
     except NotFound:
-        dbuser = await create_user(user)
+        return await create_user(user)
 
-    instructions_json_file = Path("/opt/templates/mediamtx.json")
 
-    if not instructions_json_file.is_file():
+@router.post("/instructions/{language}")
+async def user_intructions(user: UserCRUDRequest, request: Request, language: str) -> Dict[str, Any]:
+    """return user instructions"""
+    comes_from_rm(request)
+    cache = InstructionsCache.singleton()
+    template = cache.get_template()
+    if template is None:
         reason = "mediamtx json rune is missing from server."
         LOGGER.error("{} : {}".format(request.url, reason))
         raise HTTPException(status_code=500, detail=reason)
 
-    instructions_data = json.loads(instructions_json_file.read_text(encoding="utf-8"))
+    dbuser, snapshot = await asyncio.gather(get_or_create_user(user), MediaMTXControl.singleton().get_snapshot())
+    instructions_data = list(template)
     instructions_data.append(
         {
             "type": "Component",
@@ -63,19 +119,11 @@ async def user_intructions(user: UserCRUDRequest, request: Request, language: st
             "body": dbuser.mtxpassword,
         }
     )
-    streams = await MediaMTXControl.singleton().get_paths(insert_credentials=f"{dbuser.username}:{dbuser.mtxpassword}@")
-    streams_content = "<ul>\n"
-    for streamdict in streams:
-        streams_content += f"<li>{streamdict['path']}<ul>"
-        for pname, purl in streamdict["urls"].items():
-            streams_content += f'<li><a href="{purl}">{pname}</a></li>'
-        streams_content += "</ul></li>\n"
-    streams_content += "<ul>\n"
     instructions_data.append(
         {
             "type": "Component",
             "name": "StreamsList",
-            "body": streams_content,
+            "body": cache.render_streams(snapshot, f"{dbuser.username}:{dbuser.mtxpassword}@"),
         }
     )
 
@@ -9,8 +9,9 @@ from libpvarki.schemas.generic import OperationResultResponse
 
 from .usercrud import comes_from_rm
 from ..db.product import Product
-from ..db.errors import NotFound
-from ..db.engine import EngineWrapper
+from ..db.errors import Deleted
+from ..db.hotlookup import product_by_cn
+from ..credindex import CredentialIndex
 from ..schema.interop import ProductAddRequest, ProductAuthzResponse
 
 LOGGER = logging.getLogger(__name__)
@@ -25,15 +26,11 @@ async def add_product(
 ) -> OperationResultResponse:
     """Product needs interop privileges. This can only be called by RASENMAEHER"""
     comes_from_rm(request)
-    try:
-        exists = await Product.by_cn(product.certcn)
-        if exists:
-            LOGGER.info("Product {} already exists".format(product.certcn))
-    except NotFound:
-        with EngineWrapper.singleton().get_session() as session:
-            dbproduct = Product(certcn=product.certcn)
-            session.add(dbproduct)
-            session.commit()
+    dbproduct = await Product.upsert(product.certcn)
+    if dbproduct.deleted:
+        LOGGER.warning("Product {} has been deleted".format(product.certcn))
+        raise Deleted()
+    CredentialIndex.singleton().update_product(dbproduct)
     result = OperationResultResponse(success=True)
     return result
 
@@ -44,6 +41,6 @@ async def get_authz(
 ) -> ProductAuthzResponse:
     """Get authz info for the product"""
     payload = request.state.mtlsdn
-    product = await Product.by_cn(payload.get("CN"))
+    product = await product_by_cn(payload.get("CN"))
     result = ProductAuthzResponse(type="basic", username=product.certcn, password=product.mtxpassword)
     return result
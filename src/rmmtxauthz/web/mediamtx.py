@@ -1,15 +1,19 @@
 """MediaMTX auth routes"""
 
-from typing import Optional
+from typing import Optional, Dict
 import logging
+import time
 
 from fastapi import APIRouter, HTTPException, Response
 
-from ..db.errors import NotFound, Deleted
-from ..db.user import User
-from ..db.product import Product
+from ..db.authlookup import Credential, KIND_USER, KIND_PRODUCT
+from ..db.authlookup import resolve_credentials as db_resolve_credentials
 from ..schema.mediamtx import MTXAuthReq
 from ..config import RMMTXSettings
+from ..credindex import CredentialIndex
+from ..credshm import SharedCredentials
+from ..authguard import AuthGuard
+from ..metrics import MTX_AUTH_DURATION
 
 LOGGER = logging.getLogger(__name__)
 
@@ -32,54 +36,114 @@ def check_apiuser(authreq: MTXAuthReq) -> Optional[Response]:
     return Response(status_code=204)
 
 
-async def check_productuser(authreq: MTXAuthReq) -> Optional[Response]:
+async def resolve_credentials(authreq: MTXAuthReq) -> Optional[Dict[str, Credential]]:
+    """Get product and user credentials for the name from the index (or the shared table if another worker keeps
+    it), on miss ask DB in a single round-trip unless we recently found out the name does not exist in which case
+    return None"""
+    assert authreq.user
+    shared = SharedCredentials.singleton()
+    following = shared.following
+    index = CredentialIndex.singleton()
+    found: Dict[str, Credential] = {}
+    if following:
+        found = shared.lookup(authreq.user)
+    else:
+        if product := index.lookup_product(authreq.user):
+            found[KIND_PRODUCT] = product
+        if user := index.lookup_user(authreq.user):
+            found[KIND_USER] = user
+    if found:
+        return found
+    guard = AuthGuard.singleton()
+    if guard.is_unknown(authreq.user):
+        return None
+    found = await db_resolve_credentials(authreq.user)
+    if not found:
+        guard.remember_unknown(authreq.user)
+    # Followers do not refresh their own index so anything stored there would go stale
+    if not following:
+        for cred in found.values():
+            index.store(authreq.user, cred)
+    return found
+
+
+def check_productuser(authreq: MTXAuthReq, creds: Dict[str, Credential]) -> Optional[Response]:
     """Check if the user is a product that requested interop"""
     if not authreq.user or not authreq.password:
         LOGGER.debug("No user/password, returning 401")
         raise HTTPException(status_code=401)
-    try:
-        dbproduct = await Product.by_cn(authreq.user)
-        if authreq.password != dbproduct.mtxpassword:
-            LOGGER.error("Wrong password for {}".format(authreq.user))
-            raise HTTPException(status_code=403)
-        return Response(status_code=204)
-    except (NotFound, Deleted):
-        pass
-    return None
+    cred = creds.get(KIND_PRODUCT)
+    if cred is None or cred.deleted:
+        return None
+    if authreq.password != cred.password:
+        LOGGER.error("Wrong password for {}".format(authreq.user))
+        raise HTTPException(status_code=403)
+    return Response(status_code=204)
 
 
-async def check_rmuser(authreq: MTXAuthReq) -> Optional[Response]:
+def check_rmuser(authreq: MTXAuthReq, creds: Dict[str, Credential]) -> Optional[Response]:
     """Check RM user credentials"""
     if not authreq.user or not authreq.password:
         LOGGER.debug("No user/password, returning 401")
         raise HTTPException(status_code=401)
-    try:
-        dbuser = await User.by_username(authreq.user)
-        if authreq.password != dbuser.mtxpassword:
-            LOGGER.error("Wrong password for {}".format(authreq.user))
-            raise HTTPException(status_code=403)
-        # Operations that require admin privileges
-        if authreq.action in ("api", "metrics", "pprof") and not dbuser.is_rmadmin:
-            LOGGER.error("{} is not admin requesting {}".format(authreq.user, authreq.action))
-            raise HTTPException(status_code=403)
-        return Response(status_code=204)
-    except (NotFound, Deleted) as exc:
-        LOGGER.error("Invalid user {}: {}".format(authreq.user, exc))
-        raise HTTPException(status_code=403) from exc
+    cred = creds.get(KIND_USER)
+    if cred is None:
+        LOGGER.error("Invalid user {}: not found".format(authreq.user))
+        raise HTTPException(status_code=403)
+    if cred.deleted:
+        LOGGER.error("Invalid user {}: deleted".format(authreq.user))
+        raise HTTPException(status_code=403)
+    if authreq.password != cred.password:
+        LOGGER.error("Wrong password for {}".format(authreq.user))
+        raise HTTPException(status_code=403)
+    # Operations that require admin privileges
+    if authreq.action in ("api", "metrics", "pprof") and not cred.is_rmadmin:
+        LOGGER.error("{} is not admin requesting {}".format(authreq.user, authreq.action))
+        raise HTTPException(status_code=403)
+    return Response(status_code=204)
 
 
 @mtxrouter.post("/auth")
 async def get_auth(authreq: MTXAuthReq) -> Response:
     """Check if username and password match and return empty ok if so"""
     LOGGER.debug("Processing {}".format(authreq))
-    if not authreq.user or not authreq.password:
-        LOGGER.debug("No user/password, returning 401")
-        raise HTTPException(status_code=401)
-    if resp := check_apiuser(authreq):
-        return resp
-    if resp := await check_productuser(authreq):
-        return resp
-    if resp := await check_rmuser(authreq):
-        return resp
-    LOGGER.error("Fell through the checks, this should not happen")
-    raise HTTPException(status_code=403)
+    started = time.perf_counter()
+    branch, decision = "precheck", 500
+    try:
+        if not authreq.user or not authreq.password:
+            LOGGER.debug("No user/password, returning 401")
+            raise HTTPException(status_code=401)
+        branch = "check_apiuser"
+        if resp := check_apiuser(authreq):
+            decision = resp.status_code
+            return resp
+        branch = "shed"
+        guard = AuthGuard.singleton()
+        client = (authreq.ip or "", authreq.user)
+        if guard.is_throttled(client):
+            LOGGER.debug("Too many failures from {}, returning 403".format(client))
+            raise HTTPException(status_code=403)
+        try:
+            creds = await resolve_credentials(authreq)
+            if creds is None:
+                LOGGER.debug("{} is cached as unknown, returning 403".format(authreq.user))
+                raise HTTPException(status_code=403)
+            branch = "check_productuser"
+            if resp := check_productuser(authreq, creds):
+                decision = resp.status_code
+                return resp
+            branch = "check_rmuser"
+            if resp := check_rmuser(authreq, creds):
+                decision = resp.status_code
+                return resp
+            LOGGER.error("Fell through the checks, this should not happen")
+            raise HTTPException(status_code=403)
+        except HTTPException as exc:
+            if exc.status_code == 403:
+                guard.record_failure(client)
+            raise
+    except HTTPException as exc:
+        decision = exc.status_code
+        raise
+    finally:
+        MTX_AUTH_DURATION.labels(str(decision), branch).observe(time.perf_counter() - started)
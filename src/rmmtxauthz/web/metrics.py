@@ -0,0 +1,19 @@
+"""Prometheus metrics endpoint, behind mTLS like the API since it shows auth decision counts and DB timings"""
+
+import logging
+
+from fastapi import APIRouter, Depends, Response
+from libpvarki.middleware import MTLSHeader
+from prometheus_client import CONTENT_TYPE_LATEST
+
+from ..metrics import render_latest
+
+LOGGER = logging.getLogger(__name__)
+
+metricsrouter = APIRouter(dependencies=[Depends(MTLSHeader(auto_error=True))])
+
+
+@metricsrouter.get("/metrics", include_in_schema=False)
+async def get_metrics() -> Response:
+    """Metrics in Prometheus text format"""
+    return Response(content=render_latest(), media_type=CONTENT_TYPE_LATEST)
@@ -1,16 +1,25 @@
 """ "User actions"""
 
+from typing import Literal, List, Optional
+import base64
+import binascii
+import contextlib
+import datetime
 import logging
+import uuid
 
-from fastapi import APIRouter, Depends, Request, HTTPException
+from fastapi import APIRouter, Depends, Request, HTTPException, Query
 from libpvarki.middleware import MTLSHeader
 from libpvarki.schemas.product import UserCRUDRequest
 from libpvarki.schemas.generic import OperationResultResponse
 
 from ..config import RMMTXSettings
-from ..db.engine import EngineWrapper
-from ..db.errors import NotFound
-from ..db.user import User
+from ..db.user import User, UserCursor
+from ..db.userbatch import apply_batch
+from ..db.roster import RosterRow, db_digests, mismatched_buckets, reconcile
+from ..credindex import CredentialIndex
+from ..schema.usercrud import UserListItem, UserListResponse, UserBatchRequest, UserBatchResponse, UserBatchResult
+from ..schema.usercrud import RosterDigestRequest, RosterDigestResponse, RosterApplyRequest, RosterApplyResponse
 
 LOGGER = logging.getLogger(__name__)
 
@@ -25,13 +34,10 @@ def comes_from_rm(request: Request) -> None:
 
 
 async def create_user(user: UserCRUDRequest) -> User:
-    """Be more dry"""
-    with EngineWrapper.singleton().get_session() as session:
-        dbuser = User(rmuuid=user.uuid, username=user.callsign)
-        session.add(dbuser)
-        session.commit()
-        session.refresh(dbuser)
-        return dbuser
+    """Be more dry, returns the existing user if there is one"""
+    dbuser = await User.upsert(user.uuid, user.callsign)
+    CredentialIndex.singleton().update_user(dbuser)
+    return dbuser
 
 
 @crudrouter.post("/created")
@@ -57,6 +63,7 @@ async def user_revoked(
     comes_from_rm(request)
     dbuser = await User.by_rmuuid(user.uuid)
     await dbuser.delete()
+    CredentialIndex.singleton().update_user(dbuser)
     result = OperationResultResponse(success=True)
     return result
 
@@ -68,15 +75,8 @@ async def user_promoted(
 ) -> OperationResultResponse:
     """Device cert was promoted to admin privileges"""
     comes_from_rm(request)
-    try:
-        dbuser = await User.by_rmuuid(user.uuid)
-    except NotFound:
-        LOGGER.warning("User '{}' did not exist, creating transparently".format(user.callsign))
-        dbuser = await create_user(user)
-    with EngineWrapper.singleton().get_session() as session:
-        dbuser.is_rmadmin = True
-        session.add(dbuser)
-        session.commit()
+    dbuser = await User.upsert(user.uuid, user.callsign, is_rmadmin=True)
+    CredentialIndex.singleton().update_user(dbuser)
     result = OperationResultResponse(success=True)
     return result
 
@@ -88,15 +88,8 @@ async def user_demoted(
 ) -> OperationResultResponse:
     """Device cert was demoted to standard privileges"""
     comes_from_rm(request)
-    try:
-        dbuser = await User.by_rmuuid(user.uuid)
-    except NotFound:
-        LOGGER.warning("User '{}' did not exist, creating transparently".format(user.callsign))
-        dbuser = await create_user(user)
-    with EngineWrapper.singleton().get_session() as session:
-        dbuser.is_rmadmin = False
-        session.add(dbuser)
-        session.commit()
+    dbuser = await User.upsert(user.uuid, user.callsign, is_rmadmin=False)
+    CredentialIndex.singleton().update_user(dbuser)
     result = OperationResultResponse(success=True)
     return result
 
@@ -108,12 +101,116 @@ async def user_updated(
 ) -> OperationResultResponse:
     """Device callsign updated"""
     comes_from_rm(request)
-    # We do not really care, but check that the user exists for create if not
-    try:
-        dbuser = await User.by_rmuuid(user.uuid)
-    except NotFound:
-        LOGGER.warning("User '{}' did not exist, creating transparently".format(user.callsign))
-        dbuser = await create_user(user)
-    _ = dbuser
+    # We do not really care, but create the user if it does not exist
+    await create_user(user)
     result = OperationResultResponse(success=True)
     return result
+
+
+@crudrouter.post("/batch")
+async def user_batch(
+    batch: UserBatchRequest,
+    request: Request,
+) -> UserBatchResponse:
+    """Apply many lifecycle events in one go, entries for the same user are applied in order"""
+    comes_from_rm(request)
+    errors, changed = await apply_batch(
+        [(entry.operation, entry.user.uuid, entry.user.callsign) for entry in batch.entries]
+    )
+    index = CredentialIndex.singleton()
+    for dbuser in changed:
+        index.update_user(dbuser)
+    return UserBatchResponse(
+        results=[
+            UserBatchResult(
+                operation=entry.operation, uuid=entry.user.uuid, success=idx not in errors, error=errors.get(idx)
+            )
+            for idx, entry in enumerate(batch.entries)
+        ]
+    )
+
+
+@crudrouter.post("/reconcile/digests")
+async def roster_digests(
+    digests: RosterDigestRequest,
+    request: Request,
+) -> RosterDigestResponse:
+    """Compare roster bucket digests, returns the buckets whose users should be sent to /reconcile/apply"""
+    comes_from_rm(request)
+    ours = await db_digests(digests.prefix_length)
+    return RosterDigestResponse(
+        prefix_length=digests.prefix_length, mismatched=mismatched_buckets(ours, digests.buckets)
+    )
+
+
+@crudrouter.post("/reconcile/apply")
+async def roster_apply(
+    roster: RosterApplyRequest,
+    request: Request,
+) -> RosterApplyResponse:
+    """Make users in the given buckets match the roster"""
+    comes_from_rm(request)
+    try:
+        rows = [
+            RosterRow(uuid.UUID(entry.uuid), entry.callsign, entry.is_rmadmin, entry.revoked) for entry in roster.users
+        ]
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail="Invalid uuid") from exc
+    result = await reconcile(rows, roster.buckets, roster.prefix_length, roster.revoke_unknown)
+    index = CredentialIndex.singleton()
+    for dbuser in result.changed:
+        index.update_user(dbuser)
+    return RosterApplyResponse(
+        created=result.created,
+        updated=result.updated,
+        revoked=result.revoked,
+        unknown=result.unknown,
+        conflicts=result.conflicts,
+    )
+
+
+def encode_cursor(cursor: UserCursor) -> str:
+    """Opaque page cursor"""
+    created, pk = cursor
+    return base64.urlsafe_b64encode(f"{created.isoformat()}|{pk}".encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(value: str) -> UserCursor:
+    """Parse page cursor, raises 400 if it is not one of ours"""
+    try:
+        created, pk = base64.urlsafe_b64decode(value.encode("ascii")).decode("utf-8").split("|")
+        return datetime.datetime.fromisoformat(created), uuid.UUID(pk)
+    except (ValueError, binascii.Error, UnicodeError) as exc:
+        raise HTTPException(status_code=400, detail="Invalid cursor") from exc
+
+
+@crudrouter.get("/list")
+async def user_list(
+    request: Request,
+    cursor: Optional[str] = Query(default=None, description="next_cursor from the previous page"),
+    limit: int = Query(default=100, ge=1, le=1000),
+    is_rmadmin: Optional[bool] = Query(default=None, description="Only admins (true) or non-admins (false)"),
+    deleted: Literal["exclude", "include", "only"] = Query(default="exclude", description="Revoked users"),
+) -> UserListResponse:
+    """Page through users ordered by creation time"""
+    comes_from_rm(request)
+    after = decode_cursor(cursor) if cursor else None
+    items: List[UserListItem] = []
+    last: Optional[User] = None
+    more = False
+    # Ask for one extra to know if there is a next page
+    users = User.page(
+        after=after,
+        limit=limit + 1,
+        is_rmadmin=is_rmadmin,
+        deleted={"exclude": False, "include": None, "only": True}[deleted],
+    )
+    async with contextlib.aclosing(users):
+        async for dbuser in users:
+            if len(items) >= limit:
+                more = True
+                break
+            items.append(UserListItem.model_validate(dbuser))
+            last = dbuser
+    next_cursor = encode_cursor((last.created, last.pk)) if more and last else None
+    return UserListResponse(items=items, next_cursor=next_cursor)
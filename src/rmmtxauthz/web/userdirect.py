@@ -1,17 +1,19 @@
 """APIs usable directly by the user with mTLS"""
 
-from typing import Dict, Any, Sequence
+from typing import Dict, Any, List
 import logging
 
-from fastapi import APIRouter, Depends, Request
+from fastapi import APIRouter, Depends, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from libpvarki.middleware import MTLSHeader
 
-from ..db.user import User
+from ..db.hotlookup import UserRecord, user_by_username
 from ..schema.userdirect import UserCredentials
 from ..mediamtx import MediaMTXControl
 from ..config import RMMTXSettings
 
 LOGGER = logging.getLogger(__name__)
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
 
 userrouter = APIRouter(dependencies=[Depends(MTLSHeader(auto_error=True))])
 
@@ -25,18 +27,58 @@ def get_callsign(request: Request) -> str:
 @userrouter.get("/credentials", response_model=UserCredentials)
 async def get_credentials(request: Request) -> UserCredentials:
     """Get my MediaMTX credentials"""
-    user = await User.by_username(get_callsign(request))
+    user = await user_by_username(get_callsign(request))
     return UserCredentials(username=user.username, password=user.mtxpassword)
 
 
-@userrouter.get("/streams")
-async def get_streams(request: Request) -> Sequence[Dict[str, Any]]:
-    """Get streams"""
-    user = await User.by_username(get_callsign(request))
+def etag_matches(request: Request, etag: str) -> bool:
+    """Check If-None-Match using weak comparison, only safe methods get conditional responses"""
+    if request.method not in ("GET", "HEAD"):
+        return False
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    wanted = etag.removeprefix("W/")
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == wanted:
+            return True
+    return False
+
+
+def wants_ndjson(request: Request) -> bool:
+    """Did the client opt in to newline delimited JSON streaming"""
+    if request.query_params.get("format") == "ndjson":
+        return True
+    return NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+async def streams_response(request: Request, user: UserRecord) -> Response:
+    """Streams listing for the user, 304 if the client already has this version. Streamed as one path per line
+    if the client asks for NDJSON"""
     conf = RMMTXSettings.singleton()
     if conf.mtx_address == "__REQUEST_HOSTNAME__":
         LOGGER.warning("Setting RMMTX_MTX_ADDRESS from the request header")
         conf.mtx_address = request.headers.get("host", "__REQUEST_HOSTNAME__:1234").split(":", 1)[0]
         LOGGER.info("Setting RMMTX_MTX_ADDRESS is now: {}".format(conf.mtx_address))
-    streams = await MediaMTXControl.singleton().get_paths(insert_credentials=f"{user.username}:{user.mtxpassword}@")
-    return streams
+    control = MediaMTXControl.singleton()
+    snapshot = await control.get_snapshot()
+    credentials = f"{user.username}:{user.mtxpassword}@"
+    ndjson = wants_ndjson(request)
+    version = snapshot.content_version(credentials) + ("-ndjson" if ndjson else "-json")
+    # Weak since the GZip middleware may change the representation
+    headers = {"ETag": f'W/"{version}"', "Cache-Control": "private, no-cache", "Vary": "Accept"}
+    if etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    if ndjson:
+        return StreamingResponse(
+            control.iter_ndjson(snapshot, credentials), media_type=NDJSON_MEDIA_TYPE, headers=headers
+        )
+    return JSONResponse(control.render_paths(snapshot, credentials), headers=headers)
+
+
+@userrouter.get("/streams", response_model=List[Dict[str, Any]])
+async def get_streams(request: Request) -> Response:
+    """Get streams, use Accept: application/x-ndjson or ?format=ndjson to get one path per line"""
+    user = await user_by_username(get_callsign(request))
+    return await streams_response(request, user)
@@ -1,18 +1,17 @@
 """APIs usable through proxy with RM"""
 
-from typing import Dict, Any, Sequence
+from typing import Dict, Any, List
 import logging
 
-from fastapi import APIRouter, Depends, Request
+from fastapi import APIRouter, Depends, Request, Response
 from libpvarki.middleware import MTLSHeader
 from libpvarki.schemas.product import UserCRUDRequest
 from rmmtxauthz.web.usercrud import comes_from_rm
 
 
-from ..db.user import User
+from ..db.hotlookup import user_by_username
 from ..schema.userdirect import UserCredentials
-from ..mediamtx import MediaMTXControl
-from ..config import RMMTXSettings
+from .userdirect import streams_response
 
 LOGGER = logging.getLogger(__name__)
 
@@ -23,19 +22,13 @@ userrouterproxy = APIRouter(dependencies=[Depends(MTLSHeader(auto_error=True))])
 async def get_credentials(request: Request, user_request: UserCRUDRequest) -> UserCredentials:
     """Get my MediaMTX credentials"""
     comes_from_rm(request)
-    user = await User.by_username(user_request.callsign)
+    user = await user_by_username(user_request.callsign)
     return UserCredentials(username=user.username, password=user.mtxpassword)
 
 
-@userrouterproxy.post("/streams")
-async def get_streams(request: Request, user_request: UserCRUDRequest) -> Sequence[Dict[str, Any]]:
-    """Get streams"""
+@userrouterproxy.post("/streams", response_model=List[Dict[str, Any]])
+async def get_streams(request: Request, user_request: UserCRUDRequest) -> Response:
+    """Get streams, use Accept: application/x-ndjson or ?format=ndjson to get one path per line"""
     comes_from_rm(request)
-    user = await User.by_username(user_request.callsign)
-    conf = RMMTXSettings.singleton()
-    if conf.mtx_address == "__REQUEST_HOSTNAME__":
-        LOGGER.warning("Setting RMMTX_MTX_ADDRESS from the request header")
-        conf.mtx_address = request.headers.get("host", "__REQUEST_HOSTNAME__:1234").split(":", 1)[0]
-        LOGGER.info("Setting RMMTX_MTX_ADDRESS is now: {}".format(conf.mtx_address))
-    streams = await MediaMTXControl.singleton().get_paths(insert_credentials=f"{user.username}:{user.mtxpassword}@")
-    return streams
+    user = await user_by_username(user_request.callsign)
+    return await streams_response(request, user)
@@ -55,6 +55,8 @@ def session_env_config(
         mpatch.setenv("LOG_LEVEL", "DEBUG")
         mpatch.setenv("DB_ECHO", "0")
         mpatch.setenv("RMMTX_API_PASSWORD", "pytestpasswd")
+        # TestClient runs the app in its own event loop, pooled asyncpg connections can't be shared between loops
+        mpatch.setenv("RMMTX_DATABASE_NULLPOOL", "1")
         yield None
 
 
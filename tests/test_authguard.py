@@ -0,0 +1,43 @@
+"""Test the auth failure shedding"""
+
+import pytest
+
+from rmmtxauthz.authguard import AuthGuard
+
+
+def test_negative_cache(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Unknown usernames are remembered for the TTL"""
+    now = 1000.0
+    monkeypatch.setattr("rmmtxauthz.authguard.time.monotonic", lambda: now)
+    guard = AuthGuard(negative_ttl=10.0, max_entries=2)
+    assert not guard.is_unknown("nosuchuser")
+    guard.remember_unknown("nosuchuser")
+    assert guard.is_unknown("nosuchuser")
+    assert guard.counters["shed_unknown"] == 1
+    now += 11.0
+    assert not guard.is_unknown("nosuchuser")
+
+
+def test_negative_cache_bounded() -> None:
+    """Oldest entries are dropped"""
+    guard = AuthGuard(negative_ttl=10.0, max_entries=2)
+    for name in ("a", "b", "c"):
+        guard.remember_unknown(name)
+    assert list(guard.unknown.keys()) == ["b", "c"]
+
+
+def test_throttling(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Clients get throttled after burst and recover with refill"""
+    now = 1000.0
+    monkeypatch.setattr("rmmtxauthz.authguard.time.monotonic", lambda: now)
+    guard = AuthGuard(burst=3.0, refill_rate=0.5)
+    client = ("10.0.0.1", "camera")
+    for _ in range(3):
+        assert not guard.is_throttled(client)
+        guard.record_failure(client)
+    assert guard.is_throttled(client)
+    assert not guard.is_throttled(("10.0.0.2", "camera"))
+    now += 2.0
+    assert not guard.is_throttled(client)
+    assert guard.counters == {"shed_unknown": 0, "shed_throttled": 1, "failures": 3}
+    assert guard.shed == 1
@@ -0,0 +1,242 @@
+"""Benchmark the MediaMTX auth hot path"""
+
+from typing import AsyncGenerator, Dict, List, Any, Tuple
+import http.client
+import json
+import logging
+import os
+import random
+import socket
+import statistics
+import tempfile
+import threading
+import time
+import uuid
+
+import pytest
+import pytest_asyncio
+import sqlalchemy as sa
+import uvicorn
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from rmmtxauthz.config import RMMTXSettings
+from rmmtxauthz.credindex import CredentialIndex
+from rmmtxauthz.authguard import AuthGuard
+from rmmtxauthz.db.engine import EngineWrapper
+from rmmtxauthz.db.user import User, generate_code
+from rmmtxauthz.db.product import Product
+from rmmtxauthz.db import hotlookup
+
+LOGGER = logging.getLogger(__name__)
+BENCH_USERS = int(os.environ.get("RMMTX_BENCH_USERS", "200"))
+BENCH_PRODUCTS = int(os.environ.get("RMMTX_BENCH_PRODUCTS", "20"))
+BENCH_REQUESTS = int(os.environ.get("RMMTX_BENCH_REQUESTS", "2000"))
+ACTIONS = ("read", "read", "read", "publish", "playback")
+PROTOCOLS = ("hls", "webrtc", "rtsp", "rtmp", "srt")
+
+# pylint: disable=W0621
+
+
+@pytest_asyncio.fixture(scope="module", loop_scope="session")
+async def seeded(dbinstance: None) -> AsyncGenerator[Tuple[List[User], List[Product]], None]:
+    """Seed users and products"""
+    _ = dbinstance
+    users = [User(rmuuid=uuid.uuid4(), username=f"bench_{generate_code(8)}") for _ in range(BENCH_USERS)]
+    products = [Product(certcn=f"bench{idx}.{generate_code(6)}.pvarki.fi") for idx in range(BENCH_PRODUCTS)]
+    async with EngineWrapper.singleton().get_session() as session:
+        session.add_all(users)
+        session.add_all(products)
+        await session.commit()
+    yield users, products
+
+
+def build_payloads(users: List[User], products: List[Product]) -> List[Tuple[Dict[str, Any], int]]:
+    """Realistic mix of MTXAuthReq payloads with the expected status code"""
+    rnd = random.Random(1234)  # nosec
+    cnf = RMMTXSettings.singleton()
+    ret: List[Tuple[Dict[str, Any], int]] = []
+    for idx in range(BENCH_REQUESTS):
+        base = {
+            "ip": f"10.{rnd.randint(0, 255)}.{rnd.randint(0, 255)}.{rnd.randint(1, 254)}",
+            "token": "",
+            "action": rnd.choice(ACTIONS),
+            "path": f"live/bench/{rnd.randint(0, 50)}",
+            "protocol": rnd.choice(PROTOCOLS),
+            "id": None,
+            "query": "",
+        }
+        dice = rnd.random()
+        if dice < 0.70:
+            user = rnd.choice(users)
+            ret.append(({**base, "user": user.username, "password": user.mtxpassword}, 204))
+        elif dice < 0.80:
+            product = rnd.choice(products)
+            ret.append(({**base, "user": product.certcn, "password": product.mtxpassword}, 204))
+        elif dice < 0.90:
+            user = rnd.choice(users)
+            ret.append(({**base, "user": user.username, "password": "wrongpassword"}, 403))  # pragma: allowlist secret
+        elif dice < 0.95:
+            ret.append(({**base, "user": f"nosuchuser{idx % 20}", "password": "whatever"}, 403))
+        else:
+            ret.append(({**base, "action": "api", "user": cnf.api_username, "password": cnf.api_password}, 204))
+    return ret
+
+
+def run_pass(client: TestClient, payloads: List[Tuple[Dict[str, Any], int]], queries: List[int]) -> Dict[str, float]:
+    """Replay the payloads and collect numbers"""
+    latencies: List[float] = []
+    queries_before = queries[0]
+    started = time.perf_counter()
+    for payload, expected in payloads:
+        req_start = time.perf_counter()
+        resp = client.post("/api/v1/mediamtx/auth", json=payload)
+        latencies.append(time.perf_counter() - req_start)
+        assert resp.status_code == expected, payload
+    elapsed = time.perf_counter() - started
+    pcts = statistics.quantiles(latencies, n=100)
+    return {
+        "requests": len(payloads),
+        "throughput_rps": len(payloads) / elapsed,
+        "p50_ms": pcts[49] * 1000,
+        "p95_ms": pcts[94] * 1000,
+        "p99_ms": pcts[98] * 1000,
+        "queries_per_request": (queries[0] - queries_before) / len(payloads),
+    }
+
+
+@pytest.mark.benchmark
+def test_auth_benchmark(
+    unauth_testclient: TestClient,
+    seeded: Tuple[List[User], List[Product]],
+    record_property: Any,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """Replay mixed auth requests with cold and warm credential index, report throughput, latency and DB load"""
+    payloads = build_payloads(*seeded)
+    queries = [0]
+
+    def count_query(*args: Any, **kwargs: Any) -> None:
+        _ = args, kwargs
+        queries[0] += 1
+
+    engine = EngineWrapper.singleton().engine
+    assert engine
+    sa.event.listen(engine.sync_engine, "before_cursor_execute", count_query)
+    try:
+        monkeypatch.setattr(CredentialIndex, "_singleton", CredentialIndex())
+        monkeypatch.setattr(AuthGuard, "_singleton", AuthGuard(negative_ttl=3600.0))
+        cold = run_pass(unauth_testclient, payloads, queries)
+        warm = run_pass(unauth_testclient, payloads, queries)
+    finally:
+        sa.event.remove(engine.sync_engine, "before_cursor_execute", count_query)
+
+    for name, result in (("cold", cold), ("warm", warm)):
+        LOGGER.info(
+            "auth benchmark {}: {requests} requests, {throughput_rps:.0f} req/s, p50 {p50_ms:.2f}ms, "
+            "p95 {p95_ms:.2f}ms, p99 {p99_ms:.2f}ms, {queries_per_request:.3f} queries/request".format(name, **result)
+        )
+        for key, value in result.items():
+            record_property(f"{name}_{key}", value)
+    # Every decision costs at most one round trip, once the index is warm nothing should hit the DB
+    assert cold["queries_per_request"] <= 1.0
+    assert warm["queries_per_request"] == 0.0
+
+
+@pytest.mark.benchmark
+@pytest.mark.asyncio(loop_scope="session")
+async def test_hot_lookup_benchmark(seeded: Tuple[List[User], List[Product]], record_property: Any) -> None:
+    """Compare worker CPU per lookup of the ORM getters and the precompiled hot lookups"""
+    users, _ = seeded
+    names = [dbuser.username for dbuser in users]
+    await hotlookup.user_by_username(names[0])  # compile outside the measurement
+
+    started = time.process_time()
+    for name in names:
+        await User.by_username(name)
+    orm_cpu = (time.process_time() - started) / len(names)
+
+    started = time.process_time()
+    for name in names:
+        await hotlookup.user_by_username(name)
+    hot_cpu = (time.process_time() - started) / len(names)
+
+    LOGGER.info("lookup CPU per call: ORM {:.3f}ms, hot {:.3f}ms".format(orm_cpu * 1000, hot_cpu * 1000))
+    record_property("orm_lookup_cpu_ms", orm_cpu * 1000)
+    record_property("hot_lookup_cpu_ms", hot_cpu * 1000)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP over a Unix domain socket"""
+
+    def __init__(self, socket_path: str) -> None:
+        super().__init__("localhost")
+        self.socket_path = socket_path
+
+    def connect(self) -> None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+def serve_in_thread(app: FastAPI, **kwargs: Any) -> Tuple[uvicorn.Server, threading.Thread]:
+    """Start uvicorn in a background thread and wait until it listens"""
+    server = uvicorn.Server(uvicorn.Config(app, lifespan="off", log_level="warning", access_log=False, **kwargs))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 10.0
+    while not server.started:
+        assert time.monotonic() < deadline, "server did not start"
+        time.sleep(0.01)
+    return server, thread
+
+
+def time_auth_requests(connection: http.client.HTTPConnection, count: int) -> List[float]:
+    """Keep-alive POSTs to the auth hook as the API user (no DB involved), returns latencies"""
+    cnf = RMMTXSettings.singleton()
+    body = json.dumps({"user": cnf.api_username, "password": cnf.api_password, "action": "api", "path": ""})
+    headers = {"Content-Type": "application/json"}
+    latencies: List[float] = []
+    for _ in range(count):
+        started = time.perf_counter()
+        connection.request("POST", "/api/v1/mediamtx/auth", body=body, headers=headers)
+        resp = connection.getresponse()
+        resp.read()
+        latencies.append(time.perf_counter() - started)
+        assert resp.status == 204
+    return latencies
+
+
+@pytest.mark.benchmark
+def test_uds_vs_tcp_benchmark(app_instance: FastAPI, record_property: Any) -> None:
+    """Compare auth hook latency over a Unix domain socket and over loopback TCP"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        sockpath = os.path.join(tmpdir, "auth.sock")
+        uds_server, uds_thread = serve_in_thread(app_instance, uds=sockpath)
+        tcp_server, tcp_thread = serve_in_thread(app_instance, host="127.0.0.1", port=0)
+        try:
+            port = tcp_server.servers[0].sockets[0].getsockname()[1]
+            connections: Dict[str, http.client.HTTPConnection] = {
+                "uds": UnixHTTPConnection(sockpath),
+                "tcp": http.client.HTTPConnection("127.0.0.1", port),
+            }
+            for connection in connections.values():
+                time_auth_requests(connection, 50)  # warm up
+            results = {name: time_auth_requests(connection, BENCH_REQUESTS) for name, connection in connections.items()}
+            for connection in connections.values():
+                connection.close()
+        finally:
+            uds_server.should_exit = True
+            tcp_server.should_exit = True
+            uds_thread.join(10.0)
+            tcp_thread.join(10.0)
+
+    for name, latencies in results.items():
+        pcts = statistics.quantiles(latencies, n=100)
+        LOGGER.info(
+            "auth over {}: {} requests, p50 {:.3f}ms, p95 {:.3f}ms, p99 {:.3f}ms".format(
+                name, len(latencies), pcts[49] * 1000, pcts[94] * 1000, pcts[98] * 1000
+            )
+        )
+        record_property(f"{name}_p50_ms", pcts[49] * 1000)
+        record_property(f"{name}_p95_ms", pcts[94] * 1000)
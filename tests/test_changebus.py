@@ -0,0 +1,44 @@
+"""Test the LISTEN/NOTIFY change bus"""
+
+from typing import List
+import asyncio
+import uuid
+
+import pytest
+
+from rmmtxauthz.db.user import User, generate_code
+from rmmtxauthz.db.engine import EngineWrapper
+from rmmtxauthz.db.changebus import ChangeBus, Change, notify_change, RESYNC
+
+
+@pytest.mark.asyncio
+async def test_notify_roundtrip(dbinstance: None) -> None:
+    """Committed changes reach subscribers, resync is sent on connect"""
+    _ = dbinstance
+    received: List[Change] = []
+
+    async def collect(change: Change) -> None:
+        received.append(change)
+
+    bus = ChangeBus()
+    bus.subscribe(collect)
+    task = asyncio.create_task(bus.run())
+    try:
+        for _ in range(50):
+            if bus.connection is not None:
+                break
+            await asyncio.sleep(0.1)
+        async with EngineWrapper.singleton().get_session() as session:
+            dbuser = User(rmuuid=uuid.uuid4(), username=f"bus_{generate_code(6)}")
+            session.add(dbuser)
+            await notify_change(session, User.__tablename__, dbuser.pk)
+            await session.commit()
+        for _ in range(50):
+            if len(received) >= 2:
+                break
+            await asyncio.sleep(0.1)
+    finally:
+        task.cancel()
+        await task
+    assert received[0].table == RESYNC
+    assert Change("users", str(dbuser.pk)) in received
@@ -1,11 +1,23 @@
 """Test CLI scripts"""
 
+from typing import Any, List
 import asyncio
+import http.server
+import json
+import logging
+import socket
+import subprocess  # nosec
+import sys
+import threading
 
 import pytest
+from click.testing import CliRunner
 from libadvian.binpackers import ensure_str
 
 from rmmtxauthz import __version__
+from rmmtxauthz.console import cli_group
+
+LOGGER = logging.getLogger(__name__)
 
 
 @pytest.mark.asyncio
@@ -22,3 +34,68 @@ async def test_version_cli() -> None:
     assert process.returncode == 0
     # Check output
     assert ensure_str(out[0]).strip().endswith(__version__)
+
+
+# Importing any of these just to parse the command line would make every CLI call slow
+HEAVY_MODULES = ("pydantic", "sqlalchemy", "sqlmodel", "fastapi", "aiohttp", "libpvarki")
+
+
+def test_cli_import_budget(record_property: Any) -> None:
+    """Importing the CLI does not pull in the heavy dependencies, the import time is only reported"""
+    code = (
+        "import json, sys, time\n"
+        "started = time.perf_counter()\n"
+        "import rmmtxauthz.console\n"
+        "elapsed = time.perf_counter() - started\n"
+        f"heavy = [name for name in {HEAVY_MODULES!r} if name in sys.modules]\n"
+        "print(json.dumps({'elapsed': elapsed, 'heavy': heavy}))\n"
+    )
+    proc = subprocess.run([sys.executable, "-c", code], capture_output=True, check=True, timeout=10)
+    result = json.loads(proc.stdout)
+    assert result["heavy"] == []
+    LOGGER.info("CLI import took {:.1f}ms".format(result["elapsed"] * 1000))
+    record_property("cli_import_ms", result["elapsed"] * 1000)
+
+
+@pytest.mark.parametrize("healthy,exitcode", [(True, 0), (False, 1)])
+def test_healthcheck_cli(healthy: bool, exitcode: int) -> None:
+    """Healthcheck command talks to the API with the stdlib client"""
+    paths: List[str] = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        """Fake healthcheck API"""
+
+        def do_GET(self) -> None:  # pylint: disable=C0103
+            """Answer the healthcheck"""
+            paths.append(self.path)
+            body = json.dumps({"healthy": healthy, "extra": "fake"}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args: Any) -> None:
+            """Quiet"""
+
+    server = http.server.HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        result = CliRunner().invoke(
+            cli_group, ["healthcheck", "--host", "127.0.0.1", "--port", str(server.server_address[1]), "--deep"]
+        )
+    finally:
+        server.shutdown()
+    assert result.exit_code == exitcode
+    assert json.loads(result.output)["healthy"] is healthy
+    assert paths == ["/api/v1/healthcheck?deep=true"]
+
+
+def test_healthcheck_cli_unreachable() -> None:
+    """Connection failure is a failed healthcheck"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    result = CliRunner().invoke(cli_group, ["healthcheck", "--host", "127.0.0.1", "--port", str(port)])
+    assert result.exit_code == 1
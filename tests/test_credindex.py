@@ -0,0 +1,118 @@
+"""Test the in-memory credential index"""
+
+import asyncio
+import uuid
+
+import pytest
+from fastapi.testclient import TestClient
+
+from rmmtxauthz.db.user import User, generate_code
+from rmmtxauthz.db.engine import EngineWrapper
+from rmmtxauthz.credindex import CredentialIndex
+from rmmtxauthz.db.changebus import Change
+
+
+@pytest.mark.asyncio
+async def test_load_and_refresh(dbinstance: None) -> None:
+    """Full load picks up existing users, incremental refresh picks up new ones"""
+    _ = dbinstance
+    async with EngineWrapper.singleton().get_session() as session:
+        first = User(rmuuid=uuid.uuid4(), username=f"idx_{generate_code(6)}")
+        session.add(first)
+        await session.commit()
+        await session.refresh(first)
+    index = CredentialIndex()
+    await index.load()
+    cred = index.lookup_user(first.username)
+    assert cred
+    assert cred.password == first.mtxpassword
+    assert not cred.deleted
+
+    async with EngineWrapper.singleton().get_session() as session:
+        second = User(rmuuid=uuid.uuid4(), username=f"idx_{generate_code(6)}", is_rmadmin=True)
+        session.add(second)
+        await session.commit()
+        await session.refresh(second)
+    assert index.lookup_user(second.username) is None
+    assert await index.refresh()
+    cred = index.lookup_user(second.username)
+    assert cred
+    assert cred.is_rmadmin
+
+    await first.delete()
+    assert await index.refresh()
+    cred = index.lookup_user(first.username)
+    assert cred
+    assert cred.deleted
+
+
+@pytest.mark.asyncio
+async def test_snapshot_survives_db_outage(dbinstance: None, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Refresh failures keep the last good data"""
+    _ = dbinstance
+    index = CredentialIndex()
+    await index.load()
+    before = dict(index.users)
+
+    def broken_session() -> None:
+        raise ConnectionError("DB is down")
+
+    monkeypatch.setattr(EngineWrapper, "get_session", broken_session)
+    assert not await index.refresh()
+    assert index.users == before
+
+
+@pytest.mark.asyncio
+async def test_revoke_updates_index(dbinstance: None, testclient: TestClient, unauth_testclient: TestClient) -> None:
+    """Mutation routes update the index directly"""
+    _ = dbinstance
+    payload = {
+        "uuid": str(uuid.uuid4()),
+        "callsign": f"idx_{generate_code(6)}",
+        "x509cert": "-----BEGIN CERTIFICATE-----\\nMIIEwjCC...\\n-----END CERTIFICATE-----\\n",
+    }
+    resp = testclient.post("/api/v1/users/created", json=payload)
+    assert resp.status_code == 200
+    cred = CredentialIndex.singleton().lookup_user(payload["callsign"])
+    assert cred
+    resp = unauth_testclient.post(
+        "/api/v1/mediamtx/auth", json={"user": payload["callsign"], "password": cred.password}
+    )
+    assert resp.status_code == 204
+    resp = testclient.post("/api/v1/users/revoked", json=payload)
+    assert resp.status_code == 200
+    resp = unauth_testclient.post(
+        "/api/v1/mediamtx/auth", json={"user": payload["callsign"], "password": cred.password}
+    )
+    assert resp.status_code == 403
+
+
+def test_rename_drops_old_username() -> None:
+    """Renamed users can not log in with the old name"""
+    index = CredentialIndex()
+    dbuser = User(rmuuid=uuid.uuid4(), username="vanha")
+    index.update_user(dbuser)
+    assert index.lookup_user("vanha")
+    dbuser.username = "uusi"
+    index.update_user(dbuser)
+    assert index.lookup_user("vanha") is None
+    assert index.lookup_user("uusi")
+
+
+@pytest.mark.asyncio
+async def test_change_burst_coalesced(monkeypatch: pytest.MonkeyPatch) -> None:
+    """A burst of changes runs at most two refreshes and only the call that ran them reports it"""
+    index = CredentialIndex()
+    refreshes = []
+
+    async def fake_refresh() -> bool:
+        """Count and yield"""
+        refreshes.append(True)
+        await asyncio.sleep(0.01)
+        return True
+
+    monkeypatch.setattr(index, "refresh", fake_refresh)
+    results = await asyncio.gather(*(index.on_change(Change("users", str(idx))) for idx in range(5)))
+    assert results == [True, False, False, False, False]
+    assert len(refreshes) == 2
+    assert not await index.on_change(Change("somethingelse", "1"))
@@ -0,0 +1,102 @@
+"""Test the shared memory credential table"""
+
+from typing import Generator, Tuple
+import asyncio
+import mmap
+from pathlib import Path
+
+import pytest
+from fastapi.testclient import TestClient
+
+from rmmtxauthz.config import RMMTXSettings
+from rmmtxauthz.credindex import CredentialIndex
+from rmmtxauthz.credshm import SharedCredentials, CredentialTable, build_table
+from rmmtxauthz.db.authlookup import Credential, KIND_USER, KIND_PRODUCT
+
+# pylint: disable=W0621
+
+
+def test_table_roundtrip(tmp_path: Path) -> None:
+    """Every entry is found, a name can be both user and product, unknown names find nothing"""
+    entries = [(f"user{idx}", Credential(KIND_USER, f"pw{idx}", idx % 3 == 0, idx % 5 == 0)) for idx in range(500)]
+    entries.append(("user7", Credential(KIND_PRODUCT, "productpw", False, False)))
+    path = tmp_path / "table"
+    path.write_bytes(build_table(entries, 42))
+    with path.open("rb") as fpntr:
+        table = CredentialTable(mmap.mmap(fpntr.fileno(), 0, access=mmap.ACCESS_READ))
+    assert table.generation == 42
+    assert table.count == 501
+    for name, cred in entries[:500]:
+        assert table.lookup(name)[KIND_USER] == cred
+    assert table.lookup("user7")[KIND_PRODUCT].password == "productpw"  # pragma: allowlist secret
+    assert not table.lookup("nosuchuser")
+    assert not table.stale
+    table.close()
+
+
+@pytest.fixture
+def shared_pair(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> Generator[Tuple[SharedCredentials, SharedCredentials], None, None]:
+    """Two workers sharing a directory"""
+    monkeypatch.setattr(RMMTXSettings.singleton(), "credshm_enabled", True)
+    monkeypatch.setattr("rmmtxauthz.credshm.REOPEN_INTERVAL", 0.0)
+    leader, follower = SharedCredentials(directory=tmp_path), SharedCredentials(directory=tmp_path)
+    assert leader.try_lead()
+    assert not follower.try_lead()
+    yield leader, follower
+    leader.release()
+    follower.release()
+
+
+def test_generation_swap(shared_pair: Tuple[SharedCredentials, SharedCredentials]) -> None:
+    """Follower sees new generations, leadership moves when the leader goes away"""
+    leader, follower = shared_pair
+    assert follower.following and not leader.following
+    assert leader.directory.stat().st_mode & 0o777 == 0o700
+    assert not follower.lookup("koira")
+    index = CredentialIndex(users={"koira": Credential(KIND_USER, "first", False, False)})
+    assert leader.publish(index) == 1
+    assert leader.table_path.stat().st_mode & 0o777 == 0o600
+    assert follower.lookup("koira")[KIND_USER].password == "first"  # pragma: allowlist secret
+    first_table = follower.table
+
+    index.users["koira"] = Credential(KIND_USER, "second", True, False)
+    assert leader.publish(index) == 2
+    assert first_table and first_table.stale
+    cred = follower.lookup("koira")[KIND_USER]
+    assert cred.password == "second" and cred.is_rmadmin  # pragma: allowlist secret
+    assert follower.table and follower.table.generation == 2
+
+    leader.release()
+    assert follower.try_lead()
+    assert follower.publish(index) == 3
+
+
+def test_auth_from_shared_table(
+    unauth_testclient: TestClient,
+    shared_pair: Tuple[SharedCredentials, SharedCredentials],
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """Follower workers answer the auth hook from the shared table without the DB"""
+    leader, follower = shared_pair
+    leader.publish(CredentialIndex(users={"kissa": Credential(KIND_USER, "miau", False, False)}))
+    monkeypatch.setattr(SharedCredentials, "_singleton", follower)
+
+    async def no_db(name: str) -> None:
+        raise AssertionError(f"DB lookup for {name}")
+
+    monkeypatch.setattr("rmmtxauthz.web.mediamtx.db_resolve_credentials", no_db)
+    resp = unauth_testclient.post("/api/v1/mediamtx/auth", json={"user": "kissa", "password": "miau"})
+    assert resp.status_code == 204
+    resp = unauth_testclient.post("/api/v1/mediamtx/auth", json={"user": "kissa", "password": "hau"})
+    assert resp.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_publish_async(shared_pair: Tuple[SharedCredentials, SharedCredentials]) -> None:
+    """Concurrent publishes from the event loop get consecutive generations"""
+    leader, follower = shared_pair
+    index = CredentialIndex(users={"koira": Credential(KIND_USER, "hau", False, False)})
+    assert sorted(await asyncio.gather(*(leader.publish_async(index) for _ in range(3)))) == [1, 2, 3]
+    assert follower.lookup("koira")[KIND_USER].password == "hau"  # pragma: allowlist secret
@@ -0,0 +1,38 @@
+"""Test the gunicorn hooks"""
+
+from typing import Any, List
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from rmmtxauthz import gunicornconf
+
+
+class FakeConfig:  # pylint: disable=too-few-public-methods
+    """The parts of gunicorn Config the hooks use"""
+
+    def __init__(self, bind: List[str]) -> None:
+        self.bind = bind
+
+    def set(self, name: str, value: Any) -> None:
+        """Set a setting"""
+        setattr(self, name, value)
+
+
+def test_uds_bind(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Socket is bound in addition to the command line binds, only once"""
+    server = SimpleNamespace(cfg=FakeConfig(["0.0.0.0:8005"]))
+    gunicornconf.on_starting(server)
+    assert server.cfg.bind == ["0.0.0.0:8005"]
+
+    sockpath = tmp_path / "run" / "auth.sock"
+    monkeypatch.setenv(gunicornconf.UDS_PATH_ENV, str(sockpath))
+    gunicornconf.on_starting(server)
+    gunicornconf.on_starting(server)
+    assert server.cfg.bind == ["0.0.0.0:8005", f"unix:{sockpath}"]
+    assert sockpath.parent.is_dir()
+
+    sockpath.touch(mode=0o600)
+    gunicornconf.when_ready(server)
+    assert sockpath.stat().st_mode & 0o777 == 0o660
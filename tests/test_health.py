@@ -0,0 +1,61 @@
+"""Test the healthcheck tiers"""
+
+from typing import List
+
+import pytest
+from fastapi.testclient import TestClient
+
+from rmmtxauthz.db.user import User
+from rmmtxauthz.mediamtx import MediaMTXControl
+from rmmtxauthz.web import health
+from rmmtxauthz.web.health import HealthProbe
+
+# pylint: disable=W0621
+
+
+@pytest.fixture
+def probe_calls(monkeypatch: pytest.MonkeyPatch) -> List[str]:
+    """Replace the probes with fakes that record calls"""
+    calls: List[str] = []
+
+    async def count(*args: object, **kwargs: object) -> int:
+        _ = args, kwargs
+        calls.append("count")
+        return 42
+
+    async def ping_db() -> None:
+        calls.append("db")
+
+    async def ping_mtx(*args: object) -> None:
+        _ = args
+        calls.append("mtx")
+        raise ConnectionError("nope")
+
+    monkeypatch.setattr(User, "count", count)
+    monkeypatch.setattr(health, "ping_db", ping_db)
+    monkeypatch.setattr(MediaMTXControl, "ping", ping_mtx)
+    monkeypatch.setattr(HealthProbe, "_singleton", HealthProbe())
+    return calls
+
+
+def test_shallow_no_probes(unauth_testclient: TestClient, probe_calls: List[str]) -> None:
+    """Liveness does not touch DB or MediaMTX"""
+    resp = unauth_testclient.get("/api/v1/healthcheck", params={"deep": "false"})
+    assert resp.status_code == 200
+    assert resp.json()["healthy"]
+    assert not probe_calls
+
+
+def test_deep_cached(unauth_testclient: TestClient, probe_calls: List[str]) -> None:
+    """Deep check runs every probe once per TTL and reports failures"""
+    resp = unauth_testclient.get("/api/v1/healthcheck")
+    assert resp.status_code == 200
+    payload = resp.json()
+    assert not payload["healthy"]
+    assert "MediaMTX API" in payload["extra"]
+    assert sorted(probe_calls) == ["count", "db", "mtx"]
+    resp = unauth_testclient.get("/api/v1/healthcheck")
+    assert not resp.json()["healthy"]
+    assert len(probe_calls) == 3
+    result = HealthProbe.singleton().result
+    assert result is not None and result.users_count == 42
@@ -7,6 +7,7 @@ from fastapi.testclient import TestClient
 
 from rmmtxauthz.schema.interop import ProductAddRequest, ProductAuthzResponse
 from rmmtxauthz.db.product import Product
+from rmmtxauthz.db.user import generate_code
 
 LOGGER = logging.getLogger(__name__)
 
@@ -26,6 +27,18 @@ async def test_add(dbinstance: None, testclient: TestClient) -> None:
     assert dbproduct
 
 
+@pytest.mark.asyncio
+async def test_add_deleted(dbinstance: None, testclient: TestClient) -> None:
+    """Adding a product that has been deleted is not reported as success"""
+    _ = dbinstance
+    certcn = f"deleted.{generate_code(6)}.pvarki.fi".lower()
+    dbproduct = await Product.upsert(certcn)
+    await dbproduct.delete()
+    payload = ProductAddRequest(certcn=certcn, x509cert="-----BEGIN CERTIFICATE-----\\n").model_dump()
+    resp = testclient.post("/api/v1/interop/add", json=payload)
+    assert resp.status_code == 404
+
+
 @pytest.mark.asyncio
 async def test_authz(dbinstance: None, product_testclient: TestClient) -> None:
     """Test adding of product"""
@@ -1,11 +1,11 @@
 """Test the mediamtx routes"""
 
-from typing import Generator
+from typing import AsyncGenerator
 import logging
 import uuid
 
 
-import pytest
+import pytest_asyncio
 from fastapi.testclient import TestClient
 
 from rmmtxauthz.db.user import User, generate_code
@@ -17,21 +17,21 @@ LOGGER = logging.getLogger(__name__)
 # pylint: disable=W0621
 
 
-@pytest.fixture(scope="module")
-def valid_user(dbinstance: None) -> Generator[User, None, None]:
+@pytest_asyncio.fixture(scope="module", loop_scope="session")
+async def valid_user(dbinstance: None) -> AsyncGenerator[User, None]:
     """A valid user"""
     _ = dbinstance
-    with EngineWrapper.singleton().get_session() as session:
+    async with EngineWrapper.singleton().get_session() as session:
         dbuser = User(
             rmuuid=str(uuid.uuid4()),
             username=f"koira_{generate_code(4)}",
         )
         session.add(dbuser)
-        session.commit()
-        session.refresh(dbuser)
+        await session.commit()
+        await session.refresh(dbuser)
         yield dbuser
-        session.delete(dbuser)
-        session.commit()
+        await session.delete(dbuser)
+        await session.commit()
 
 
 def test_no_password(unauth_testclient: TestClient) -> None:
@@ -78,3 +78,16 @@ def test_right_password(unauth_testclient: TestClient, valid_user: User) -> None
         "/api/v1/mediamtx/auth", json={"user": valid_user.username, "password": valid_user.mtxpassword}
     )
     assert resp.status_code == 204
+
+
+def test_metrics(unauth_testclient: TestClient, testclient: TestClient, valid_user: User) -> None:
+    """Auth decisions show up in metrics, which need a client certificate"""
+    resp = unauth_testclient.post(
+        "/api/v1/mediamtx/auth", json={"user": valid_user.username, "password": valid_user.mtxpassword}
+    )
+    assert resp.status_code == 204
+    assert unauth_testclient.get("/metrics").status_code == 403
+    resp = testclient.get("/metrics")
+    assert resp.status_code == 200
+    assert 'rmmtxauthz_mtx_auth_duration_seconds_count{branch="check_rmuser",decision="204"}' in resp.text
+    assert 'route="/api/v1/mediamtx/auth"' in resp.text
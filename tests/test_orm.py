@@ -1,12 +1,25 @@
 """Test the direct orm helpers"""
 
+import asyncio
+import time
 import uuid
+from types import SimpleNamespace
+from typing import Any, List
 
 import pytest
+import sqlalchemy as sa
+from prometheus_client import REGISTRY
+from sqlalchemy.ext.asyncio import AsyncConnection
 
-
-from rmmtxauthz.db.user import User, generate_code
-from rmmtxauthz.db.engine import EngineWrapper
+from rmmtxauthz.db.user import User, generate_code, CREATED_PK_INDEX, USERNAME_ACTIVE_INDEX, RMUUID_ACTIVE_INDEX
+from rmmtxauthz.db.product import Product, CERTCN_ACTIVE_INDEX
+from rmmtxauthz.db.engine import EngineWrapper, InstrumentedPool, _before_cursor_execute, _after_cursor_execute
+from rmmtxauthz.config import DBSettings
+from rmmtxauthz.db.errors import Deleted, NotFound
+from rmmtxauthz.db.migrations import current_version, migrate, SCHEMA, SCHEMA_VERSION, VERSION_TABLE
+from rmmtxauthz.db.dbinit import init_db, MIGRATION_LOCK_KEY
+from rmmtxauthz.db import hotlookup
+from rmmtxauthz.db.authlookup import resolve_credentials, KIND_USER, KIND_PRODUCT
 
 
 @pytest.mark.asyncio
@@ -14,10 +27,232 @@ async def test_list_users(dbinstance: None) -> None:
     """Create some users and test the listing"""
     _ = dbinstance
     callsign = f"cs_{generate_code(6)}"
-    with EngineWrapper.singleton().get_session() as session:
+    async with EngineWrapper.singleton().get_session() as session:
         dbuser = User(rmuuid=uuid.uuid4(), username=callsign)
         session.add(dbuser)
-        session.commit()
-        session.refresh(dbuser)
+        await session.commit()
+        await session.refresh(dbuser)
     async for user in dbuser.list():
         assert user.mtxpassword == "REDACTED"  # pragma: allowlist secret
+
+
+@pytest.mark.asyncio
+async def test_resolve_credentials(dbinstance: None) -> None:
+    """Users and products resolve in one statement"""
+    _ = dbinstance
+    name = f"cs_{generate_code(6)}"
+    async with EngineWrapper.singleton().get_session() as session:
+        dbuser = User(rmuuid=uuid.uuid4(), username=name, is_rmadmin=True)
+        dbproduct = Product(certcn=name)
+        session.add(dbuser)
+        session.add(dbproduct)
+        await session.commit()
+    creds = await resolve_credentials(name)
+    assert creds[KIND_USER].password == dbuser.mtxpassword
+    assert creds[KIND_USER].is_rmadmin
+    assert creds[KIND_PRODUCT].password == dbproduct.mtxpassword
+    assert not creds[KIND_PRODUCT].deleted
+    assert not await resolve_credentials(f"nosuch_{generate_code(6)}")
+
+
+@pytest.mark.asyncio
+async def test_upserts(dbinstance: None) -> None:
+    """Upserts create once, return existing rows and refuse revoked users"""
+    _ = dbinstance
+    rmuuid = uuid.uuid4()
+    callsign = f"up_{generate_code(6)}"
+    created = await User.upsert(rmuuid, callsign)
+    assert created.is_rmadmin is False
+    again = await User.upsert(str(rmuuid), callsign)
+    assert again.pk == created.pk
+    assert again.mtxpassword == created.mtxpassword
+    promoted = await User.upsert(rmuuid, callsign, is_rmadmin=True)
+    assert promoted.pk == created.pk and promoted.is_rmadmin is True
+    await promoted.delete()
+    assert promoted.deleted is not None
+    assert (await User.by_pk(promoted.pk, allow_deleted=True)).deleted == promoted.deleted
+    with pytest.raises(Deleted):
+        await User.upsert(rmuuid, callsign, is_rmadmin=False)
+
+    certcn = f"up{generate_code(6)}.pvarki.fi".lower()
+    product = await Product.upsert(certcn)
+    again_product = await Product.upsert(certcn)
+    # Repeat upserts do not touch the row
+    assert (again_product.pk, again_product.updated) == (product.pk, product.updated)
+
+
+@pytest.mark.asyncio
+async def test_migrations(dbinstance: None) -> None:
+    """Schema is at current version with the covering indexes, migrating again is a no-op"""
+    _ = dbinstance
+    engine = EngineWrapper.singleton().engine
+    assert engine
+    async with engine.connect() as connection:
+        assert await current_version(connection) == SCHEMA_VERSION
+        assert await migrate(connection) == SCHEMA_VERSION
+        result = await connection.execute(
+            sa.text("SELECT indexname FROM pg_indexes WHERE schemaname = :schema"), {"schema": SCHEMA}
+        )
+        indexes = {row.indexname for row in result}
+    assert {"ix_users_username_active", "ix_users_rmuuid_active", "ix_products_certcn_active"} <= indexes
+
+
+@pytest.mark.asyncio
+async def test_migrate_unversioned_db(dbinstance: None) -> None:
+    """A DB created before versioning (tables but no version table or indexes) is brought up to date"""
+    _ = dbinstance
+    engine = EngineWrapper.singleton().engine
+    assert engine
+    indexes = (CREATED_PK_INDEX, USERNAME_ACTIVE_INDEX, RMUUID_ACTIVE_INDEX, CERTCN_ACTIVE_INDEX)
+    async with engine.connect() as connection:
+
+        def downgrade(conn: sa.Connection) -> None:
+            """Back to how the tables were before versioning"""
+            VERSION_TABLE.drop(conn)
+            for index in indexes:
+                index.drop(conn, checkfirst=True)
+
+        await connection.run_sync(downgrade)
+        await connection.commit()
+        assert await current_version(connection) == 0
+        assert await migrate(connection) == SCHEMA_VERSION
+        result = await connection.execute(
+            sa.text("SELECT indexname FROM pg_indexes WHERE schemaname = :schema"), {"schema": SCHEMA}
+        )
+        found = {row.indexname for row in result}
+        applied = (await connection.execute(sa.select(VERSION_TABLE.c.version).order_by(VERSION_TABLE.c.version))).all()
+    assert {str(index.name) for index in indexes} <= found
+    assert [row.version for row in applied] == list(range(1, SCHEMA_VERSION + 1))
+
+
+@pytest.mark.asyncio
+async def test_init_db_concurrent(dbinstance: None) -> None:
+    """Concurrent init_db calls take turns on the advisory lock, exactly one applies the pending migration"""
+    _ = dbinstance
+    engine = EngineWrapper.singleton().engine
+    assert engine
+    async with engine.connect() as connection:
+        await connection.execute(sa.delete(VERSION_TABLE).where(VERSION_TABLE.c.version == SCHEMA_VERSION))
+        await connection.commit()
+    assert await asyncio.gather(*(init_db() for _ in range(4))) == [SCHEMA_VERSION] * 4
+    async with engine.connect() as connection:
+        count = await connection.scalar(
+            sa.select(sa.func.count()).select_from(VERSION_TABLE).where(VERSION_TABLE.c.version == SCHEMA_VERSION)
+        )
+    assert count == 1
+    assert await init_db() == SCHEMA_VERSION
+
+
+@pytest.mark.asyncio
+async def test_init_db_failed_migration_unlocks(dbinstance: None, monkeypatch: pytest.MonkeyPatch) -> None:
+    """A migration that errors out releases the advisory lock so the next init_db can proceed"""
+    _ = dbinstance
+    engine = EngineWrapper.singleton().engine
+    assert engine
+    async with engine.connect() as connection:
+        await connection.execute(sa.delete(VERSION_TABLE).where(VERSION_TABLE.c.version == SCHEMA_VERSION))
+        await connection.commit()
+
+    async def broken(connection: AsyncConnection) -> int:
+        """Fail mid-transaction"""
+        await connection.execute(sa.text("SELECT 1/0"))
+        return SCHEMA_VERSION
+
+    monkeypatch.setattr("rmmtxauthz.db.dbinit.migrate", broken)
+    with pytest.raises(sa.exc.DBAPIError):
+        await init_db()
+    monkeypatch.undo()
+    async with engine.connect() as connection:
+        assert await connection.scalar(sa.select(sa.func.pg_try_advisory_lock(MIGRATION_LOCK_KEY)))
+        await connection.execute(sa.select(sa.func.pg_advisory_unlock(MIGRATION_LOCK_KEY)))
+        await connection.commit()
+    assert await init_db() == SCHEMA_VERSION
+
+
+def test_pool_settings_and_idle_ping() -> None:
+    """Pool is sized from settings and only connections idle past ping_idle get pinged"""
+    wrapper = EngineWrapper(
+        settings=DBSettings(nullpool=False, pool_size=3, max_overflow=2, pool_timeout=1.5, ping_idle=5.0)
+    )
+    assert wrapper.engine
+    pool = wrapper.engine.sync_engine.pool
+    assert isinstance(pool, InstrumentedPool)
+    assert pool.size() == 3
+    assert pool.timeout() == 1.5
+
+    pings: List[int] = []
+
+    def ping() -> None:
+        pings.append(1)
+        if len(pings) > 1:
+            raise ConnectionError("gone")
+
+    dbapi_connection = SimpleNamespace(ping=ping)
+    record = SimpleNamespace(info={})
+    wrapper._pool_checkout(dbapi_connection, record, None)  # pylint: disable=W0212
+    wrapper._pool_checkin(dbapi_connection, record)  # pylint: disable=W0212
+    wrapper._pool_checkout(dbapi_connection, record, None)  # pylint: disable=W0212
+    assert not pings
+    record.info["checked_in"] = time.monotonic() - 10
+    wrapper._pool_checkout(dbapi_connection, record, None)  # pylint: disable=W0212
+    assert len(pings) == 1
+    record.info["checked_in"] = time.monotonic() - 10
+    with pytest.raises(sa.exc.DisconnectionError):
+        wrapper._pool_checkout(dbapi_connection, record, None)  # pylint: disable=W0212
+
+
+def test_pool_gauges_idle() -> None:
+    """In use and overflow gauges follow checkouts and read zero once everything is back in the pool"""
+
+    def creator() -> Any:
+        """Fake DBAPI connection"""
+        return SimpleNamespace(rollback=lambda: None, close=lambda: None)
+
+    pool = InstrumentedPool(creator, pool_size=2, max_overflow=1)
+    connections = [pool.connect() for _ in range(3)]
+    assert REGISTRY.get_sample_value("rmmtxauthz_db_pool_in_use") == 3
+    assert REGISTRY.get_sample_value("rmmtxauthz_db_pool_overflow") == 1
+    for connection in connections:
+        connection.close()
+    assert REGISTRY.get_sample_value("rmmtxauthz_db_pool_in_use") == 0
+    assert REGISTRY.get_sample_value("rmmtxauthz_db_pool_overflow") == 0
+    pool.dispose()
+
+
+def test_query_timing_survives_failed_statements() -> None:
+    """A statement that errors out does not shift the timing of the ones after it on the same connection"""
+    conn = SimpleNamespace(info={})
+    failed, succeeded = SimpleNamespace(), SimpleNamespace()
+    _before_cursor_execute(conn, None, "SELECT 1/0", {}, failed, False)
+    # No after_cursor_execute for the failed one
+    _before_cursor_execute(conn, None, "SELECT 1", {}, succeeded, False)
+    started = succeeded.rmmtx_query_started
+    _after_cursor_execute(conn, None, "SELECT 1", {}, succeeded, False)
+    assert succeeded.rmmtx_query_started == started > failed.rmmtx_query_started
+    assert not conn.info
+    _after_cursor_execute(conn, None, "SELECT 1", {}, None, False)
+
+
+@pytest.mark.asyncio
+async def test_hot_lookups(dbinstance: None) -> None:
+    """Hot lookups return the same data as the ORM getters and raise the same way"""
+    _ = dbinstance
+    dbuser = await User.upsert(uuid.uuid4(), f"hot_{generate_code(6)}")
+    dbproduct = await Product.upsert(f"hot.{generate_code(6)}.pvarki.fi")
+    record = await hotlookup.user_by_username(dbuser.username)
+    assert record == await hotlookup.user_by_rmuuid(str(dbuser.rmuuid)) == await hotlookup.user_by_pk(dbuser.pk)
+    assert (record.pk, record.rmuuid, record.mtxpassword) == (dbuser.pk, dbuser.rmuuid, dbuser.mtxpassword)
+    precord = await hotlookup.product_by_cn(dbproduct.certcn)
+    assert precord == await hotlookup.product_by_pk(dbproduct.pk)
+    assert precord.mtxpassword == dbproduct.mtxpassword
+    with pytest.raises(NotFound):
+        await hotlookup.user_by_username(f"nosuch_{generate_code(6)}")
+    await dbuser.delete()
+    with pytest.raises(Deleted):
+        await hotlookup.user_by_username(dbuser.username)
+    assert (await hotlookup.user_by_username(dbuser.username, allow_deleted=True)).deleted is not None
+    engine = EngineWrapper.singleton().engine
+    assert engine
+    assert hotlookup.compiled("user_by_username", engine.dialect) is hotlookup.compiled(
+        "user_by_username", engine.dialect
+    )
@@ -0,0 +1,87 @@
+"""Test roster reconciliation"""
+
+from typing import List
+import uuid
+
+import pytest
+from fastapi.testclient import TestClient
+
+from rmmtxauthz.db.user import User, generate_code
+from rmmtxauthz.db.errors import Deleted
+from rmmtxauthz.db.roster import RosterRow, roster_digests, mismatched_buckets, db_digests, bucket_of
+from rmmtxauthz.db.roster import _plan  # pylint: disable=protected-access
+
+
+def _rmuuid(bucket: str, idx: int) -> uuid.UUID:
+    """Fixed UUID in the given one character bucket"""
+    return uuid.UUID(f"{bucket}0000000-0000-4000-8000-{idx:012d}")
+
+
+def test_digests_and_plan() -> None:
+    """Digests only change for the bucket that changed and the plan finds the differing rows"""
+    rows = [RosterRow(_rmuuid("abc"[idx % 3], idx), f"cs{idx}", idx == 0, False) for idx in range(30)]
+    before = roster_digests(rows, 1)
+    assert sorted(before) == ["a", "b", "c"]
+    assert before == roster_digests(reversed(rows), 1)
+    changed = rows[3]._replace(is_rmadmin=True)
+    after = roster_digests([changed if row is rows[3] else row for row in rows], 1)
+    assert mismatched_buckets(before, after) == ["a"]
+    assert mismatched_buckets(before, {}) == sorted(before)
+
+    # Like reconcile, our side is only the rows of the buckets being fixed
+    ours = {row.rmuuid: row for row in rows[3:] if bucket_of(row.rmuuid, 1) == "a"}
+    extra = RosterRow(_rmuuid("a", 99), "extra", False, False)
+    ours[extra.rmuuid] = extra
+    revoked = rows[3]._replace(revoked=True)
+    missing, different, unknown = _plan([rows[0], rows[1], revoked], ours, 1, ["a"])
+    assert missing == [rows[0]]
+    assert different == [revoked]
+    assert extra.rmuuid in unknown
+    assert set(unknown) == set(ours) - {rows[3].rmuuid}
+
+
+@pytest.mark.asyncio
+async def test_reconcile_roundtrip(dbinstance: None, testclient: TestClient) -> None:
+    """DB digests match the reference implementation, apply makes them match the roster"""
+    _ = dbinstance
+    dbusers: List[User] = [await User.upsert(uuid.uuid4(), f"rs_{generate_code(6)}") for _ in range(5)]
+    ours = await db_digests(2)
+    for dbuser in dbusers:
+        bucket = bucket_of(dbuser.rmuuid, 2)
+        bucket_rows = [
+            RosterRow(user.rmuuid, user.username, user.is_rmadmin, user.deleted is not None)
+            async for user in User.list(include_deleted=True)
+            if bucket_of(user.rmuuid, 2) == bucket
+        ]
+        assert ours[bucket] == roster_digests(bucket_rows, 2)[bucket]
+
+    roster = [
+        RosterRow(user.rmuuid, user.username, user.is_rmadmin, user.deleted is not None)
+        async for user in User.list(include_deleted=True)
+    ]
+    newuser = RosterRow(uuid.uuid4(), f"rs_{generate_code(6)}", False, False)
+    roster = [row._replace(is_rmadmin=True) if row.rmuuid == dbusers[0].rmuuid else row for row in roster]
+    roster = [row._replace(revoked=True) if row.rmuuid == dbusers[1].rmuuid else row for row in roster]
+    roster.append(newuser)
+
+    resp = testclient.post("/api/v1/users/reconcile/digests", json={"buckets": roster_digests(roster, 2)})
+    assert resp.status_code == 200
+    mismatched = resp.json()["mismatched"]
+    assert set(mismatched) == {bucket_of(newuser.rmuuid, 2)} | {bucket_of(user.rmuuid, 2) for user in dbusers[:2]}
+
+    users = [
+        {"uuid": str(row.rmuuid), "callsign": row.callsign, "is_rmadmin": row.is_rmadmin, "revoked": row.revoked}
+        for row in roster
+        if bucket_of(row.rmuuid, 2) in mismatched
+    ]
+    resp = testclient.post("/api/v1/users/reconcile/apply", json={"buckets": mismatched, "users": users})
+    assert resp.status_code == 200
+    payload = resp.json()
+    assert payload["created"] == [str(newuser.rmuuid)]
+    assert set(payload["updated"]) == {str(dbusers[0].rmuuid), str(dbusers[1].rmuuid)}
+    assert (await User.by_rmuuid(dbusers[0].rmuuid)).is_rmadmin is True
+    with pytest.raises(Deleted):
+        await User.by_rmuuid(dbusers[1].rmuuid)
+
+    resp = testclient.post("/api/v1/users/reconcile/digests", json={"buckets": roster_digests(roster, 2)})
+    assert resp.json()["mismatched"] == []
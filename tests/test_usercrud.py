@@ -1,5 +1,6 @@
 """Test the RM CRUD endpoints"""
 
+from typing import Any, Dict, List
 import logging
 import uuid
 
@@ -10,6 +11,7 @@ from libpvarki.schemas.product import UserCRUDRequest
 from rmmtxauthz.db.user import User, generate_code
 from rmmtxauthz.db.errors import Deleted
 from rmmtxauthz.db.engine import EngineWrapper
+from rmmtxauthz.db.userbatch import fold_entries, plan_batch
 
 LOGGER = logging.getLogger(__name__)
 
@@ -80,15 +82,15 @@ async def test_demote_wo_create(dbinstance: None, testclient: TestClient, crudre
     """Test transparent create on demote"""
     _ = dbinstance
     user = crudrequest
-    with EngineWrapper.singleton().get_session() as session:
+    async with EngineWrapper.singleton().get_session() as session:
         dbuser = User(
             rmuuid=user.uuid,
             is_rmadmin=True,
             username=user.callsign,
         )
         session.add(dbuser)
-        session.commit()
-        session.refresh(dbuser)
+        await session.commit()
+        await session.refresh(dbuser)
     resp = testclient.post("/api/v1/users/demoted", json=user.model_dump())
     assert resp.status_code == 200
     dbuser = await User.by_rmuuid(user.uuid)
@@ -115,3 +117,108 @@ async def test_unauth_crud(dbinstance: None, unauth_testclient: TestClient, crud
 
     resp = unauth_testclient.post("/api/v1/users/revoked", json=payload)
     assert resp.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_list_paginated(dbinstance: None, testclient: TestClient) -> None:
+    """Walk all pages, every user seen once and in order, filters apply"""
+    _ = dbinstance
+    created: List[str] = []
+    for idx in range(5):
+        user = UserCRUDRequest(uuid=str(uuid.uuid4()), callsign=f"Sivu_{generate_code(4)}", x509cert="")
+        resp = testclient.post("/api/v1/users/created", json=user.model_dump())
+        assert resp.status_code == 200
+        if idx == 0:
+            resp = testclient.post("/api/v1/users/promoted", json=user.model_dump())
+            assert resp.status_code == 200
+        if idx == 1:
+            resp = testclient.post("/api/v1/users/revoked", json=user.model_dump())
+            assert resp.status_code == 200
+        created.append(user.uuid)
+
+    seen: List[Dict[str, Any]] = []
+    params: Dict[str, Any] = {"limit": 2, "deleted": "include"}
+    while True:
+        resp = testclient.get("/api/v1/users/list", params=params)
+        assert resp.status_code == 200
+        payload = resp.json()
+        assert len(payload["items"]) <= 2
+        seen.extend(payload["items"])
+        if not payload["next_cursor"]:
+            break
+        params["cursor"] = payload["next_cursor"]
+    seen_uuids = [item["rmuuid"] for item in seen]
+    assert len(seen_uuids) == len(set(seen_uuids))
+    assert set(created) <= set(seen_uuids)
+    assert [item["created"] for item in seen] == sorted(item["created"] for item in seen)
+    assert all("mtxpassword" not in item for item in seen)
+
+    resp = testclient.get("/api/v1/users/list", params={"limit": 1000, "is_rmadmin": "true"})
+    admins = {item["rmuuid"] for item in resp.json()["items"]}
+    assert created[0] in admins and created[2] not in admins
+    resp = testclient.get("/api/v1/users/list", params={"limit": 1000, "deleted": "only"})
+    revoked = {item["rmuuid"] for item in resp.json()["items"]}
+    assert created[1] in revoked and created[2] not in revoked
+    resp = testclient.get("/api/v1/users/list", params={"limit": 1000})
+    active = {item["rmuuid"] for item in resp.json()["items"]}
+    assert created[1] not in active and created[2] in active
+
+
+def test_list_bad_cursor(testclient: TestClient, unauth_testclient: TestClient) -> None:
+    """Garbage cursor is a client error, listing requires RM"""
+    resp = testclient.get("/api/v1/users/list", params={"cursor": "bm90IGEgY3Vyc29y"})
+    assert resp.status_code == 400
+    resp = unauth_testclient.get("/api/v1/users/list")
+    assert resp.status_code == 403
+
+
+def test_batch_fold_and_plan() -> None:
+    """Entries fold per user in order and conflicts are reported per entry"""
+    new, old, gone, clash = (uuid.uuid4() for _ in range(4))
+    entries = [
+        ("created", str(new), "Uusi"),
+        ("promoted", str(new), "Uusi"),
+        ("demoted", str(old), "Vanha"),
+        ("revoked", str(gone), "Poissa"),
+        ("created", str(clash), "Vanha"),
+        ("revoked", str(old), "Vanha"),
+        ("promoted", str(old), "Vanha"),
+        ("created", "not-a-uuid", "Rikki"),
+    ]
+    errors: Dict[int, str] = {}
+    pending = fold_entries(entries, errors)
+    assert errors == {6: "revoked earlier in batch", 7: "invalid uuid"}
+    plan = plan_batch(pending, {old: False}, {"Vanha": old}, errors)
+    assert errors[3] == "user not found"
+    assert errors[4] == "username taken"
+    assert plan.set_admin[True] == [(new, "Uusi", True)]
+    assert plan.set_admin[False] == [(old, "Vanha", False)]
+    assert not plan.insert_only
+    assert plan.revoke == [old]
+
+
+@pytest.mark.asyncio
+async def test_batch(dbinstance: None, testclient: TestClient) -> None:
+    """Batch endpoint applies entries in order and reports per entry"""
+    _ = dbinstance
+    users = [UserCRUDRequest(uuid=str(uuid.uuid4()), callsign=f"Era_{generate_code(4)}", x509cert="") for _ in range(3)]
+    entries = [{"operation": "created", "user": user.model_dump()} for user in users]
+    entries.append({"operation": "promoted", "user": users[0].model_dump()})
+    entries.append({"operation": "revoked", "user": users[1].model_dump()})
+    entries.append({"operation": "updated", "user": users[1].model_dump()})
+    resp = testclient.post("/api/v1/users/batch", json={"entries": entries})
+    assert resp.status_code == 200
+    results = resp.json()["results"]
+    assert [result["success"] for result in results] == [True, True, True, True, True, False]
+    assert results[5]["error"] == "revoked earlier in batch"
+
+    assert (await User.by_rmuuid(users[0].uuid)).is_rmadmin is True
+    with pytest.raises(Deleted):
+        await User.by_rmuuid(users[1].uuid)
+    assert (await User.by_rmuuid(users[2].uuid)).is_rmadmin is False
+
+    resp = testclient.post(
+        "/api/v1/users/batch",
+        json={"entries": [{"operation": "demoted", "user": users[1].model_dump()}]},
+    )
+    assert resp.json()["results"][0]["error"] == "user is deleted"